@@ -0,0 +1,152 @@
+import argparse
+import configparser
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from create_menu import Menu, parse_args, validate_args
+from mealplan import MealPlanManager
+from menu import MenuGenerator, render_tasks
+from utils import setup_logging
+
+PROFILE_PREFIX = 'profile:'
+
+
+def read_profiles(path):
+    '''
+    a config file is a single profile, unless it has [profile:name] sections; then every profile section
+    is layered over the file's other sections, e.g. shared [create-menu] settings with one profile per meal type
+    path: config file, or config file#name to select one profile section
+
+    Returns:
+        list of (profile name, parsed options)
+    '''
+    path, _, selected = path.partition('#')
+    config = configparser.ConfigParser(interpolation=None)
+    config.read(path, encoding='utf-8')
+    names = [s[len(PROFILE_PREFIX):] for s in config.sections() if s.startswith(PROFILE_PREFIX)]
+    if selected and selected not in names:
+        raise RuntimeError(f'{path} has no section [{PROFILE_PREFIX}{selected}].')
+    if not names:
+        return [(path, parse_args(['-c', path]))]
+
+    shared = [s for s in config.sections() if not s.startswith(PROFILE_PREFIX)]
+    profiles = []
+    for name in ([selected] if selected else names):
+        # later sections override earlier ones, so the profile section goes last
+        contents = ''.join(__section__(config, s) for s in shared + [PROFILE_PREFIX + name])
+        profiles.append((f'{path}#{name}', parse_args([], config_file_contents=contents)))
+    return profiles
+
+
+def __section__(config, section):
+    lines = [f'[{section}]'] + [f'{k} = {v}' for k, v in config.items(section, raw=True)]
+    return '\n'.join(lines) + '\n'
+
+
+class MenuBatch:
+    """
+    Creates the menus of several profiles in one run.  Profiles connecting to the same server share a
+    TandoorAPI, so recipes, trees and books are fetched once; selections run concurrently and all meal
+    plans and menu files are written together at the end.
+    """
+    def __init__(self, profiles, logger, workers=None):
+        self.logger = logger
+        self.workers = workers or min(len(profiles), os.cpu_count() or 1)
+        self.menus = []
+        apis = {}
+        for name, options in profiles:
+            validate_args(options)
+            key = (options.url, options.token, options.offline, options.cache)
+            menu = Menu(options, tandoor=apis.get(key, None), logger=logger)
+            apis[key] = menu.tandoor
+            self.menus.append((name, menu))
+        self.apis = list(apis.values())
+        self.logger.info(f'Running {len(self.menus)} profiles against {len(self.apis)} servers.')
+
+    def prepare_data(self):
+        # one profile after another, later profiles are served from what earlier ones fetched
+        for name, menu in self.menus:
+            self.logger.debug(f'Preparing data for profile {name}.')
+            menu.prepare_data()
+
+    def select_recipes(self):
+        '''
+        Returns:
+            list of (profile name, menu, selected recipes) for every profile that found a solution
+        '''
+        def select(profile):
+            name, menu = profile
+            if len(menu.recipes) < menu.choices:
+                self.logger.info(f'Not enough recipes to generate a menu for profile {name}.  Only {len(menu.recipes)} recipes to work with.')
+                return None
+            try:
+                return name, menu, menu.select_recipes()
+            except RuntimeError as e:
+                self.logger.info(f'Skipping profile {name}: {e}')
+                return None
+
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            return [s for s in pool.map(select, self.menus) if s]
+
+    def create_meal_plans(self, selections):
+        selections = [s for s in selections if s[1].options.create_mp]
+        # clean up every profile before creating anything, profiles may share a meal type
+        cleaned = set()
+        for name, menu, _ in selections:
+            options = menu.options
+            if options.cleanup_mp and (key := (id(menu.tandoor), options.mp_type, options.cleanup_date)) not in cleaned:
+                cleaned.add(key)
+                MealPlanManager(menu.tandoor, self.logger, history=menu.history).cleanup_uncooked(date=options.cleanup_date, mp_type=options.mp_type)
+
+        for api in self.apis:
+            plans = []
+            for name, menu, recipes in selections:
+                if menu.tandoor is api:
+                    o = menu.options
+                    plans += [{'recipe': r, 'type': o.mp_type, 'date': o.mp_date, 'note': o.mp_note, 'share': o.share_with} for r in recipes]
+            if plans:
+                MealPlanManager(api, self.logger).create_many(plans, max_workers=api.max_concurrency)
+
+    def generate_menu_files(self, selections):
+        generators, tasks = [], []
+        for name, menu, recipes in selections:
+            if menu.options.create_file:
+                generator = MenuGenerator(menu.tandoor, menu.options, self.logger, pantry=menu.pantry, rng=menu.random)
+                generators.append((generator, generator.prepare_menu(recipes)))
+                tasks += generators[-1][1]
+        if not tasks:
+            return
+
+        outputs = [t[3] for t in tasks]
+        if len(set(outputs)) < len(outputs):
+            self.logger.warning('Several profiles write the same menu file, give each profile its own output_dir or file_template.')
+        self.logger.info(f'Generating {len(tasks)} menu files, this may take awhile.')
+        font_sets = [(g.fonts, g.template_dir) for g, _ in generators]
+        results = iter(render_tasks(tasks, font_sets, self.logger))
+        for generator, generator_tasks in generators:
+            generator.save(generator_tasks, [next(results) for _ in generator_tasks])
+
+    def run(self):
+        self.prepare_data()
+        selections = self.select_recipes()
+        for name, menu, recipes in selections:
+            menu.print_selection(recipes, title=f'Your selected recipes for {name} are:')
+        self.create_meal_plans(selections)
+        self.generate_menu_files(selections)
+        for api in self.apis:
+            if api.progress:
+                api.progress.last_step()
+                api.progress.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Create the menus of several profiles, sharing the data fetched from Tandoor.')
+    parser.add_argument('profiles', nargs='+', help='Config files, or file#name for a single [profile:name] section of a file.')
+    parser.add_argument('--workers', type=int, help='Profiles to select recipes for concurrently; defaults to the number of CPUs.')
+    parser.add_argument('--log', default='info', help='Sets the logging level')
+    batch_args = parser.parse_args()
+
+    profiles = []
+    for p in batch_args.profiles:
+        profiles += read_profiles(p)
+    MenuBatch(profiles, setup_logging(log=batch_args.log), workers=batch_args.workers).run()
@@ -0,0 +1,567 @@
+import argparse
+import gc
+import glob
+import json
+import math
+import os
+import random
+import re
+import shelve
+import sqlite3
+import tempfile
+import threading
+import time
+import zlib
+from collections.abc import MutableMapping
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# query results of these types are stored once per entity and referenced by ID
+ENTITY_TYPES = ('recipe', 'food', 'keyword', 'book')
+ENTITY_URLS = {'recipe': 'recipe', 'food': 'food', 'keyword': 'keyword', 'recipe-book': 'book'}
+
+CACHE_FILE = 'caches.sqlite3'
+LEGACY_CACHE_FILE = 'caches.db'
+# entities read per query
+ENTITY_BATCH = 500
+# payloads smaller than this aren't worth compressing
+COMPRESS_THRESHOLD = 1024
+# seconds to wait for another process's write lock
+BUSY_TIMEOUT = 30
+# seconds a process may take to refill an expired key before others take over
+LEASE_SECONDS = 120
+LEASE_POLL = 0.1
+# seconds to wait for another process's refill when there is no expired result to serve, then fetch here as well
+LEASE_WAIT = 5
+# expired entries are kept this many seconds so they can be served while another process refills them
+STALE_SECONDS = 24 * 60 * 60
+
+
+def encode(value):
+    '''
+    encodes a JSON compatible value as msgpack (or JSON when msgpack isn't installed)
+    and compresses it with zstd (or zlib) when it is large enough
+
+    Returns:
+        bytes prefixed with a two byte header of serialization and compression format
+    '''
+    if msgpack:
+        fmt, payload = b'M', msgpack.packb(value, use_bin_type=True)
+    else:
+        fmt, payload = b'J', json.dumps(value, separators=(',', ':')).encode('utf-8')
+    if len(payload) < COMPRESS_THRESHOLD:
+        return fmt + b'N' + payload
+    if zstandard:
+        return fmt + b'S' + zstandard.ZstdCompressor().compress(payload)
+    return fmt + b'Z' + zlib.compress(payload)
+
+
+def decode(blob):
+    fmt, compression, payload = blob[:1], blob[1:2], blob[2:]
+    if compression == b'S':
+        if not zstandard:
+            raise RuntimeError('Cache entry is zstd compressed, install zstandard to read it.')
+        payload = zstandard.ZstdDecompressor().decompress(payload)
+    elif compression == b'Z':
+        payload = zlib.decompress(payload)
+    # decoding only allocates, the cyclic garbage collector just slows it down
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        if fmt == b'M':
+            if not msgpack:
+                raise RuntimeError('Cache entry is msgpack encoded, install msgpack to read it.')
+            return msgpack.unpackb(payload, raw=False, strict_map_key=False)
+        return json.loads(payload)
+    finally:
+        if gc_enabled:
+            gc.enable()
+
+
+class CacheStore(MutableMapping):
+    """
+    Persistent key -> record store.  A record is a dict with an 'expired' datetime, the remaining
+    fields are encoded with encode() into a single sqlite row.  Entities shared by the records of
+    api results are stored one row per id, see put_entities.  Safe to share between processes:
+    every write is atomic, transaction() makes a read-modify-write atomic and leases let a single
+    process refill an expired key.
+    """
+    def __init__(self, path=CACHE_FILE, setup=None):
+        self.path = path
+        # called with the store once it is connected, see open_cache
+        self.setup = setup
+        self.connection = None
+        self.lock = threading.RLock()
+        self.depth = 0
+        # decoded records of this process and their version, saves decoding large records on every read
+        self.loaded = {}
+
+    @property
+    def db(self):
+        # the database is opened on first use, importing a module that uses the store doesn't touch the disk
+        if self.connection is None:
+            with self.lock:
+                if self.connection is None:
+                    self.__connect__()
+        return self.connection
+
+    def __connect__(self):
+        self.connection = sqlite3.connect(self.path, timeout=BUSY_TIMEOUT, check_same_thread=False, isolation_level=None)
+        self.connection.execute(f'PRAGMA busy_timeout = {BUSY_TIMEOUT * 1000}')
+        # write ahead logging lets processes read while another one writes
+        self.connection.execute('PRAGMA journal_mode = WAL')
+        self.connection.execute('PRAGMA synchronous = NORMAL')
+        with self.transaction():
+            self.db.execute('CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, expired REAL, value BLOB NOT NULL, version TEXT)')
+            if 'version' not in [c[1] for c in self.db.execute('PRAGMA table_info(cache)')]:
+                self.db.execute('ALTER TABLE cache ADD COLUMN version TEXT')
+            self.db.execute('CREATE TABLE IF NOT EXISTS lease (key TEXT PRIMARY KEY, owner TEXT NOT NULL, until REAL NOT NULL)')
+            self.db.execute('CREATE TABLE IF NOT EXISTS entity (type TEXT, id TEXT, value BLOB NOT NULL, PRIMARY KEY (type, id)) WITHOUT ROWID')
+            # entities used to be stored as one record per type
+            for key, in self.db.execute("SELECT key FROM cache WHERE key LIKE 'entity:%'").fetchall():
+                try:
+                    self.put_entities(key.split(':', 1)[1], self[key]['data'].values())
+                except KeyError:
+                    pass
+                self.db.execute('DELETE FROM cache WHERE key = ?', (key,))
+        if self.setup:
+            self.setup(self)
+
+    @contextmanager
+    def transaction(self):
+        '''
+        holds the database write lock, reads and writes within are atomic to other processes
+        '''
+        with self.lock:
+            if self.depth == 0:
+                self.db.execute('BEGIN IMMEDIATE')
+            self.depth += 1
+            try:
+                yield self
+            except BaseException:
+                self.depth -= 1
+                if self.depth == 0:
+                    self.db.execute('ROLLBACK')
+                raise
+            self.depth -= 1
+            if self.depth == 0:
+                self.db.execute('COMMIT')
+
+    def __getitem__(self, key):
+        with self.lock:
+            row = self.db.execute('SELECT expired, version FROM cache WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                self.loaded.pop(key, None)
+                raise KeyError(key)
+            # another process may have replaced the record since it was decoded
+            if (loaded := self.loaded.get(key, None)) and loaded[0] == row[1]:
+                return loaded[1]
+            value = self.db.execute('SELECT value FROM cache WHERE key = ?', (key,)).fetchone()
+            if value is None:
+                raise KeyError(key)
+            try:
+                record = decode(value[0])
+            except (RuntimeError, ValueError, zlib.error):
+                # written by an install with other codecs available, fetch it again
+                del self[key]
+                raise KeyError(key)
+            record['expired'] = datetime.max if row[0] is None else datetime.fromtimestamp(row[0])
+            self.loaded[key] = (row[1], record)
+            return record
+
+    def __setitem__(self, key, record):
+        expired = None if record['expired'] == datetime.max else record['expired'].timestamp()
+        value = encode({k: v for k, v in record.items() if k != 'expired'})
+        version = os.urandom(8).hex()
+        with self.lock:
+            self.db.execute('INSERT OR REPLACE INTO cache (key, expired, value, version) VALUES (?, ?, ?, ?)', (key, expired, value, version))
+            self.loaded[key] = (version, record)
+
+    def __delitem__(self, key):
+        with self.lock:
+            self.loaded.pop(key, None)
+            if self.db.execute('DELETE FROM cache WHERE key = ?', (key,)).rowcount == 0:
+                raise KeyError(key)
+
+    def __iter__(self):
+        with self.lock:
+            return iter([row[0] for row in self.db.execute('SELECT key FROM cache')])
+
+    def __len__(self):
+        with self.lock:
+            return self.db.execute('SELECT COUNT(*) FROM cache').fetchone()[0]
+
+    def __contains__(self, key):
+        with self.lock:
+            return self.db.execute('SELECT 1 FROM cache WHERE key = ?', (key,)).fetchone() is not None
+
+    def get_entities(self, entity, ids):
+        '''
+        entity: entity type, ids: list of entity IDs as strings
+
+        Returns:
+            {id: entity} of the ids that are stored
+        '''
+        found = {}
+        with self.lock:
+            for start in range(0, len(ids), ENTITY_BATCH):
+                batch = ids[start:start + ENTITY_BATCH]
+                rows = self.db.execute(f'SELECT id, value FROM entity WHERE type = ? AND id IN ({",".join("?" * len(batch))})', (entity, *batch))
+                for i, value in rows:
+                    try:
+                        found[i] = decode(value)
+                    except (RuntimeError, ValueError, zlib.error):
+                        # written with other codecs available, treated as missing
+                        continue
+        return found
+
+    def put_entities(self, entity, items):
+        '''
+        stores entities one row each, writing a result costs the size of the result rather than of the table
+        items: entity dicts with an 'id'
+        '''
+        with self.lock:
+            self.db.executemany(
+                'INSERT OR REPLACE INTO entity (type, id, value) VALUES (?, ?, ?)',
+                [(entity, str(x['id']), encode(x)) for x in items]
+            )
+
+    def prune(self, referenced):
+        '''
+        referenced: {entity type: set of IDs as strings} to keep, every other entity is deleted
+
+        Returns:
+            number of entities deleted
+        '''
+        with self.transaction():
+            self.db.execute('CREATE TEMP TABLE IF NOT EXISTS referenced (type TEXT, id TEXT, PRIMARY KEY (type, id)) WITHOUT ROWID')
+            self.db.execute('DELETE FROM referenced')
+            self.db.executemany('INSERT OR IGNORE INTO referenced (type, id) VALUES (?, ?)', [(e, i) for e, ids in referenced.items() for i in ids])
+            deleted = self.db.execute(
+                'DELETE FROM entity WHERE NOT EXISTS (SELECT 1 FROM referenced r WHERE r.type = entity.type AND r.id = entity.id)'
+            ).rowcount
+            self.db.execute('DELETE FROM referenced')
+        return deleted
+
+    def acquire_lease(self, key, seconds=LEASE_SECONDS):
+        '''
+        Returns:
+            True when this thread now holds the lease to refill key, False while another one does
+        '''
+        now = time.time()
+        with self.lock:
+            return self.db.execute(
+                'INSERT INTO lease (key, owner, until) VALUES (?, ?, ?) ON CONFLICT(key) DO UPDATE '
+                'SET owner = excluded.owner, until = excluded.until WHERE lease.until < ? OR lease.owner = excluded.owner',
+                (key, self.__owner__(), now + seconds, now)
+            ).rowcount == 1
+
+    def release_lease(self, key):
+        with self.lock:
+            self.db.execute('DELETE FROM lease WHERE key = ? AND owner = ?', (key, self.__owner__()))
+
+    @staticmethod
+    def __owner__():
+        return f'{os.getpid()}:{threading.get_ident()}'
+
+    def expire(self, now=None):
+        now = (now or datetime.now()).timestamp()
+        with self.transaction():
+            self.db.execute('DELETE FROM cache WHERE expired < ?', (now - STALE_SECONDS,))
+            self.db.execute('DELETE FROM lease WHERE until < ?', (now,))
+            self.loaded = {}
+
+    def sync(self):
+        # every write is committed immediately
+        pass
+
+    def close(self):
+        # the next use connects again, e.g. after changing path
+        with self.lock:
+            if self.connection is not None:
+                self.connection.close()
+            self.connection = None
+            self.loaded = {}
+
+
+def retire_legacy(legacy_path=LEGACY_CACHE_FILE):
+    '''
+    sets the files of the legacy shelve cache aside; its keys hashed the arguments of a request without
+    the method, so its entries can't be found under the keys used now and are fetched again instead
+
+    Returns:
+        number of files set aside
+    '''
+    # .migrated files were set aside by earlier versions
+    files = [f for f in glob.glob(f'{legacy_path}*') if not f.endswith(('.old', '.migrated'))]
+    for f in files:
+        os.rename(f, f'{f}.old')
+    return len(files)
+
+
+def entity_type(url, *args, **kwargs):
+    '''
+    url: tandoor api url of a request
+
+    Returns:
+        the entity type returned by the endpoint or None when results aren't entities
+    '''
+    if match := re.search(r'/api/([a-z-]+)/', url if isinstance(url, str) else ''):
+        return ENTITY_URLS.get(match.group(1), None)
+    return None
+
+
+def load_result(key, stale=False):
+    '''
+    key: cache key of a query result
+    stale: return the result even when it has expired
+
+    Returns:
+        the unexpired result with entity references resolved, raises KeyError on a miss
+    '''
+    record = caches[key]
+    if record['expired'] < datetime.now() and not stale:
+        raise KeyError(key)
+    if not (entity := record.get('entity', None)):
+        return record['data']
+
+    ids = [str(i) for i in record['ids']]
+    table = caches.get_entities(entity, ids)
+    # a missing entity is treated as a miss, the query is fetched again
+    data = [table[i] for i in ids]
+    return data if record['many'] else data[0]
+
+
+def store_result(key, data, expired, entity=None):
+    '''
+    stores a query result, results of entity types are stored as a list of IDs into the entity table
+    key: cache key of a query result
+    data: result to store
+    expired: (datetime) expiration of the result
+    entity: entity type of the result
+    '''
+    many = isinstance(data, list)
+    items = data if many else [data]
+    if entity not in ENTITY_TYPES or not all(isinstance(x, dict) and 'id' in x for x in items):
+        caches[key] = {'data': data, 'expired': expired}
+        return
+
+    # the result and its entities are written together
+    with caches.transaction():
+        caches.put_entities(entity, items)
+        caches[key] = {'entity': entity, 'ids': [x['id'] for x in items], 'many': many, 'expired': expired}
+
+
+def load_or_fetch(key, loader, expire_after, entity=None, wait=None):
+    '''
+    key: cache key of a query result
+    loader: fetches the result on a miss
+    expire_after: (timedelta) how long a fetched result is cached
+    entity: entity type of the result
+    wait: seconds to wait for another process refilling key before fetching it here, LEASE_WAIT by default
+
+    Returns:
+        the cached result or the result of loader.  Of all processes missing the same key only the one
+        holding its lease calls loader, the others serve the expired result meanwhile or wait a little for the
+        new one; a lease outlives a process that hangs or dies, so waiting for it to end could take LEASE_SECONDS.
+    '''
+    deadline = time.monotonic() + (LEASE_WAIT if wait is None else wait)
+    leased = False
+    while True:
+        with caches_lock:
+            try:
+                return load_result(key)
+            except KeyError:
+                pass
+            if leased := caches.acquire_lease(key):
+                break
+            try:
+                return load_result(key, stale=True)
+            except KeyError:
+                pass
+        if time.monotonic() >= deadline:
+            break
+        time.sleep(LEASE_POLL)
+
+    try:
+        data = loader()
+        with caches_lock:
+            store_result(key, data, datetime.now() + expire_after, entity=entity)
+        return data
+    finally:
+        if leased:
+            with caches_lock:
+                caches.release_lease(key)
+
+
+def prune_entities(store=None):
+    '''
+    removes entities that are no longer referenced by any query result
+    store: CacheStore, the shared store by default
+    '''
+    store = store or caches
+    referenced = {e: set() for e in ENTITY_TYPES}
+    with caches_lock, store.transaction():
+        for key in list(store):
+            if entity := (record := store.get(key, {})).get('entity', None):
+                referenced[entity] |= {str(i) for i in record['ids']}
+        store.prune(referenced)
+
+
+def benchmark(num_recipes=20000, repeat=3):
+    '''
+    compares disk size and load time of a full recipe library stored in the legacy shelve format
+    and in the current store format
+    '''
+    def _recipe(i):
+        return {
+            'id': i,
+            'name': f'Recipe {i} ' + ' '.join(random.choice(['Old', 'Fashioned', 'Sour', 'Spritz', 'Negroni', 'Mule']) for _ in range(3)),
+            'description': 'Lorem ipsum dolor sit amet, consectetur adipiscing elit. ' * random.randint(0, 4),
+            'image': f'https://tandoor.example/media/recipes/{i}.png',
+            'keywords': [{'id': k, 'label': f'keyword {k}', 'name': f'keyword {k}', 'description': ''} for k in random.sample(range(500), 5)],
+            'working_time': random.randint(0, 60),
+            'waiting_time': random.randint(0, 60),
+            'created_by': 1,
+            'created_at': (datetime.now() - timedelta(days=random.randint(0, 2000))).isoformat(),
+            'updated_at': datetime.now().isoformat(),
+            'internal': True,
+            'servings': random.randint(1, 4),
+            'servings_text': '',
+            'rating': random.choice([None, 1, 2, 3, 4, 5]),
+            'last_cooked': random.choice([None, datetime.now().isoformat()]),
+            'new': False,
+            'recent': '',
+        }
+
+    recipes = [_recipe(i) for i in range(num_recipes)]
+    record = {'data': recipes, 'expired': datetime.now() + timedelta(days=1)}
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        legacy_path = os.path.join(tmp, 'legacy.db')
+        with shelve.open(legacy_path) as legacy:
+            legacy['recipes'] = record
+        timings = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            with shelve.open(legacy_path, flag='r') as legacy:
+                legacy['recipes']['data']
+            timings.append(time.perf_counter() - start)
+        results['shelve/pickle'] = (sum(os.path.getsize(f) for f in glob.glob(f'{legacy_path}*')), min(timings))
+
+        store_path = os.path.join(tmp, 'store.sqlite3')
+        store = CacheStore(store_path)
+        store['recipes'] = record
+        store.close()
+        timings = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            store = CacheStore(store_path)
+            store['recipes']['data']
+            store.close()
+            timings.append(time.perf_counter() - start)
+        results[f'{"msgpack" if msgpack else "json"}/{"zstd" if zstandard else "zlib"}'] = (os.path.getsize(store_path), min(timings))
+
+    print(f'{num_recipes} recipes')
+    for name, (size, seconds) in results.items():
+        print(f'{name:>16}: {size / 1024 / 1024:8.2f} MiB on disk, loaded in {seconds * 1000:8.1f} ms')
+    return results
+
+
+def __stress_worker__(path, keys, seconds, ttl):
+    global caches
+    caches = CacheStore(path)
+    fetched, served, errors = 0, 0, 0
+    stop = time.monotonic() + seconds
+    while time.monotonic() < stop:
+        key = random.choice(keys)
+        ids = range(keys.index(key) * 50, keys.index(key) * 50 + 100)
+
+        def _loader():
+            nonlocal fetched
+            fetched += 1
+            # a slow request, long enough for other processes to pile up on the same key
+            time.sleep(0.05)
+            return [{'id': i, 'name': f'Recipe {i}', 'fetched': time.time()} for i in ids]
+
+        data = load_or_fetch(key, _loader, timedelta(seconds=ttl), entity='recipe')
+        served += 1
+        errors += [x['id'] for x in data] != list(ids)
+    caches.close()
+    return fetched, served, errors
+
+
+def stress(processes=8, seconds=10, num_keys=4, ttl=2):
+    '''
+    runs processes that read the same few, quickly expiring, keys from one store, then checks the store
+
+    Returns:
+        True when the store is intact and every process read complete results
+    '''
+    import multiprocessing
+    keys = [f'stress:{k}' for k in range(num_keys)]
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'stress.sqlite3')
+        # create the tables before the processes race to
+        store = CacheStore(path)
+        len(store)
+        store.close()
+        start = time.perf_counter()
+        with multiprocessing.get_context('spawn').Pool(processes) as pool:
+            results = pool.starmap(__stress_worker__, [(path, keys, seconds, ttl)] * processes)
+        elapsed = time.perf_counter() - start
+
+        store = CacheStore(path)
+        intact = store.db.execute('PRAGMA integrity_check').fetchone()[0] == 'ok'
+        dangling = sum(1 for k in keys if k in store and len(store.get_entities('recipe', ids := [str(i) for i in store[k]['ids']])) < len(ids))
+        store.close()
+
+    fetched, served, errors = (sum(r[i] for r in results) for i in range(3))
+    # a refill per key for every time it expires, whatever the number of processes
+    windows = num_keys * math.ceil(elapsed / ttl)
+    print(f'{processes} processes, {served} reads in {elapsed:.1f} s')
+    print(f'{fetched} fetches for {windows} expirations, {errors} incomplete reads, {dangling} dangling results, integrity {"ok" if intact else "FAILED"}')
+    return intact and not errors and not dangling
+
+
+def open_cache(path=CACHE_FILE, legacy_path=LEGACY_CACHE_FILE):
+    '''
+    Returns:
+        the CacheStore at path, on first use it sets the legacy cache aside, drops expired entries and prunes entities
+    '''
+    def _setup(store):
+        retire_legacy(legacy_path)
+        store.expire()
+        prune_entities(store)
+    return CacheStore(path, setup=_setup)
+
+
+caches = open_cache()
+caches_lock = threading.RLock()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Maintain the Tandoor API cache.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    bench = subparsers.add_parser('benchmark', help='Compare disk size and load time against the legacy format.')
+    bench.add_argument('--recipes', type=int, default=20000, help='Number of recipes in the generated library.')
+    stress_test = subparsers.add_parser('stress', help='Run many processes against one store at once and check it afterwards.')
+    stress_test.add_argument('processes', type=int, nargs='?', default=8, help='Number of processes.')
+    stress_test.add_argument('--seconds', type=int, default=10, help='Seconds to run.')
+    stress_test.add_argument('--keys', type=int, default=4, help='Number of keys the processes share.')
+    stress_test.add_argument('--ttl', type=float, default=2, help='Seconds until a key expires.')
+    args = parser.parse_args()
+
+    if args.command == 'benchmark':
+        benchmark(args.recipes)
+    elif args.command == 'stress':
+        exit(0 if stress(args.processes, args.seconds, args.keys, args.ttl) else 1)
@@ -0,0 +1,153 @@
+import json
+import os
+import tempfile
+import threading
+import time
+from collections import defaultdict, deque
+from datetime import datetime
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+import requests
+
+CASSETTE_VERSION = 1
+# response headers worth replaying, the rest only differ between runs
+REPLAY_HEADERS = ('Content-Type', 'Retry-After')
+
+
+def interaction_key(method, url, params=None, body=None):
+    '''
+    Returns:
+        the request as a string that doesn't depend on parameter order, with and without its body
+    '''
+    _, _, path, query, _ = urlsplit(url)
+    query = parse_qsl(query, keep_blank_values=True)
+    for k, v in (params or {}).items():
+        query += [(k, str(x)) for x in (v if isinstance(v, (list, tuple)) else [v])]
+    request = f'{method} {urlunsplit(("", "", path, urlencode(sorted(query)), ""))}'
+    return request, f'{request} {json.dumps(body, sort_keys=True, default=str)}'
+
+
+class Cassette:
+    """
+    Records every request TandoorAPI sends with its response and timing, or replays a recording
+    in place of the server.  Identical requests are replayed in the order they were recorded.
+    """
+    def __init__(self, path, mode, url=None, latency=0):
+        self.path = path
+        self.mode = mode
+        self.latency = float(latency or 0)
+        self.lock = threading.Lock()
+        self.interactions = []
+        self.started = time.monotonic()
+        self.stats = defaultdict(lambda: [0, 0.0])
+        self.misses = 0
+        self.url = url
+        if mode == 'replay':
+            with open(path, 'r', encoding='utf-8') as f:
+                cassette = json.load(f)
+            if cassette.get('version', None) != CASSETTE_VERSION:
+                raise RuntimeError(f'{path} is cassette version {cassette.get("version", None)}, version {CASSETTE_VERSION} is required.')
+            self.url = cassette['url']
+            self.requests, self.bodies = defaultdict(deque), defaultdict(deque)
+            for i in cassette['interactions']:
+                i['keys'] = interaction_key(i['method'], i['url'], body=i['body'])
+                self.requests[i['keys'][0]].append(i)
+                self.bodies[i['keys'][1]].append(i)
+
+    def send(self, session, method, url, **kwargs):
+        '''
+        sends the request with session, or replays it, and counts it
+
+        Returns:
+            requests.Response
+        '''
+        start = time.monotonic()
+        if self.mode == 'replay':
+            response = self.replay(method, url, **kwargs)
+        else:
+            response = session.request(method, url, **kwargs)
+            self.record(method, url, kwargs, response, time.monotonic() - start)
+        with self.lock:
+            stats = self.stats[method]
+            stats[0] += 1
+            stats[1] += time.monotonic() - start
+        return response
+
+    def record(self, method, url, kwargs, response, elapsed):
+        request, _ = interaction_key(method, url, kwargs.get('params', None))
+        with self.lock:
+            self.interactions.append({
+                'method': method,
+                'url': request.split(' ', 1)[1],
+                'body': kwargs.get('json', None),
+                'status': response.status_code,
+                'headers': {h: response.headers[h] for h in REPLAY_HEADERS if h in response.headers},
+                'content': response.content.decode('utf-8', errors='replace'),
+                'elapsed': round(elapsed, 4)
+            })
+
+    def replay(self, method, url, **kwargs):
+        request, body = interaction_key(method, url, kwargs.get('params', None), kwargs.get('json', None))
+        with self.lock:
+            # the exact request, else the same url with another body such as a meal plan for another day
+            queue = self.bodies.get(body, None) or self.requests.get(request, None)
+            interaction = None
+            if queue:
+                interaction = queue[0]
+                # used up in both queues, the last response of a request keeps being replayed once the others are
+                for q in (self.requests[interaction['keys'][0]], self.bodies[interaction['keys'][1]]):
+                    if len(q) > 1:
+                        q.remove(interaction)
+            else:
+                self.misses += 1
+        response = requests.Response()
+        response.url = url
+        if interaction is None:
+            response.status_code = 404
+            response._content = json.dumps({'detail': f'{request} is not in cassette {self.path}.'}).encode('utf-8')
+            return response
+        if self.latency:
+            time.sleep(interaction['elapsed'] * self.latency)
+        response.status_code = interaction['status']
+        response.headers.update(interaction['headers'])
+        response._content = interaction['content'].encode('utf-8')
+        return response
+
+    def summary(self):
+        '''
+        Returns:
+            request count and time by method, replay misses and the time since the cassette was opened
+        '''
+        with self.lock:
+            count = sum(s[0] for s in self.stats.values())
+            seconds = sum(s[1] for s in self.stats.values())
+            methods = ', '.join(f'{m} {s[0]} in {s[1]:.2f} s' for m, s in sorted(self.stats.items()))
+        misses = f', {self.misses} not in the cassette' if self.mode == 'replay' else ''
+        return f'{count} requests in {seconds:.2f} s ({methods or "none"}){misses}; {time.monotonic() - self.started:.2f} s since start.'
+
+    def save(self):
+        '''
+        writes the recorded requests to the cassette file
+
+        Returns:
+            number of requests saved
+        '''
+        if self.mode != 'record':
+            return 0
+        with self.lock:
+            cassette = {
+                'version': CASSETTE_VERSION,
+                'created': datetime.now().isoformat(),
+                'url': self.url,
+                'interactions': list(self.interactions)
+            }
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(self.path)), prefix=f'.{os.path.basename(self.path)}.')
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump(cassette, f)
+            os.chmod(temp_path, 0o644)
+            os.replace(temp_path, self.path)
+        except BaseException:
+            os.remove(temp_path)
+            raise
+        return len(cassette['interactions'])
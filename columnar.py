@@ -0,0 +1,135 @@
+import math
+import mmap
+import os
+import struct
+import tempfile
+from datetime import datetime, timezone
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from models import ColumnarRecipe
+
+COLUMNAR_MAGIC = b'TMCOL\x00\x00\x01'
+# magic, recipe count, keyword count, string heap size
+HEADER = struct.Struct('<8sQQQ')
+# name, typecode and whether the column has one entry per recipe (n), per recipe plus one (n+1) or per keyword (m)
+COLUMNS = (
+    ('ids', 'q', 'n'),
+    ('ratings', 'd', 'n'),
+    ('created', 'd', 'n'),
+    ('cooked', 'd', 'n'),
+    ('updated', 'd', 'n'),
+    ('servings', 'q', 'n'),
+    ('new', 'q', 'n'),
+    ('keyword_offsets', 'q', 'n+1'),
+    ('keyword_ids', 'q', 'm'),
+    ('name_offsets', 'q', 'n+1'),
+    ('description_offsets', 'q', 'n+1'),
+)
+
+
+def __timestamp__(date):
+    return math.nan if date is None else date.timestamp()
+
+
+def write_columns(path, recipes):
+    '''
+    writes recipes as fixed-width columns, keywords as CSR lists and names and descriptions
+    into an offset indexed string heap, every column 8 byte aligned so it can be mapped directly
+    recipes: list of Recipes
+    '''
+    keyword_offsets, keyword_ids = [0], []
+    for r in recipes:
+        keyword_ids += r.keywords
+        keyword_offsets.append(len(keyword_ids))
+    # all names followed by all descriptions, string i spans offsets[i] to offsets[i + 1]
+    heap = bytearray()
+    name_offsets, description_offsets = [], []
+    for offsets, texts in ((name_offsets, [r.name for r in recipes]), (description_offsets, [r.description for r in recipes])):
+        for text in texts:
+            offsets.append(len(heap))
+            heap += (text or '').encode('utf-8')
+        offsets.append(len(heap))
+
+    values = {
+        'ids': [r.id for r in recipes],
+        'ratings': [math.nan if r.rating is None else float(r.rating) for r in recipes],
+        'created': [__timestamp__(r.createdon) for r in recipes],
+        'cooked': [__timestamp__(r.cookedon) for r in recipes],
+        'updated': [__timestamp__(getattr(r, 'updatedon', None)) for r in recipes],
+        'servings': [int(r.servings or 0) for r in recipes],
+        'new': [int(bool(r.new)) for r in recipes],
+        'keyword_offsets': keyword_offsets,
+        'keyword_ids': keyword_ids,
+        'name_offsets': name_offsets,
+        'description_offsets': description_offsets,
+    }
+
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), prefix=f'.{os.path.basename(path)}.')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(HEADER.pack(COLUMNAR_MAGIC, len(recipes), len(keyword_ids), len(heap)))
+            for name, typecode, _ in COLUMNS:
+                f.write(struct.pack(f'<{len(values[name])}{typecode}', *values[name]))
+            f.write(heap)
+        os.chmod(temp_path, 0o644)
+        os.replace(temp_path, path)
+    except BaseException:
+        os.remove(temp_path)
+        raise
+
+
+class RecipeColumns:
+    """
+    Read only, memory mapped view of a columnar recipe file.  Columns are NumPy arrays when NumPy
+    is installed, memoryviews otherwise; nothing is parsed until it is read and concurrent processes
+    share the same pages.
+    """
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.count, keyword_count, heap_size = HEADER.unpack_from(self.map, 0)
+        if magic != COLUMNAR_MAGIC:
+            raise RuntimeError(f'{path} is not a columnar recipe file.')
+
+        offset = HEADER.size
+        sizes = {'n': self.count, 'n+1': self.count + 1, 'm': keyword_count}
+        for name, typecode, size in COLUMNS:
+            setattr(self, name, self.__column__(typecode, offset, sizes[size]))
+            offset += 8 * sizes[size]
+        self.heap = memoryview(self.map)[offset:offset + heap_size]
+
+    def __column__(self, typecode, offset, count):
+        if numpy is not None:
+            return numpy.frombuffer(self.map, dtype=numpy.dtype(typecode).newbyteorder('<'), count=count, offset=offset)
+        return memoryview(self.map)[offset:offset + 8 * count].cast(typecode)
+
+    def __len__(self):
+        return self.count
+
+    def __string__(self, offsets, i):
+        return bytes(self.heap[int(offsets[i]):int(offsets[i + 1])]).decode('utf-8')
+
+    def name(self, i):
+        return self.__string__(self.name_offsets, i)
+
+    def description(self, i):
+        return self.__string__(self.description_offsets, i)
+
+    def keywords(self, i):
+        return [int(k) for k in self.keyword_ids[int(self.keyword_offsets[i]):int(self.keyword_offsets[i + 1])]]
+
+    @staticmethod
+    def date(value):
+        return None if math.isnan(value) else datetime.fromtimestamp(float(value), tz=timezone.utc)
+
+    def recipes(self):
+        '''
+        Returns:
+            list of ColumnarRecipes, their fields are read from the columns when first used
+        '''
+        return [ColumnarRecipe(self, i) for i in range(self.count)]
@@ -1,15 +1,31 @@
+import copy
+import hashlib
 import json
 import os
+import random
+import threading
+import time
+from datetime import date, datetime, timedelta
 
 import configargparse
 import yaml
 
+from cache import caches, caches_lock, load_result, store_result
+from columnar import RecipeColumns, write_columns
+from indexes import BookIndex, HistoryIndex, IngredientIndex, Pantry
 from mealplan import MealPlanManager
 from menu import MenuGenerator
 from models import Book, Food, Keyword, Recipe
+from profiling import Profiler
+from snapshot import import_snapshot, read_snapshot, write_snapshot
 from solver import RecipePicker
 from tandoor_api import TandoorAPI
-from utils import format_date, setup_logging, str2bool
+from utils import format_date, persistent_key, setup_logging, str2bool
+
+
+CONSTRAINT_TYPES = ['book', 'food', 'keyword', 'rating', 'cookedon', 'createdon', 'onhand', 'cookcount', 'planned']
+# constraints that only depend on the recipes, on hand and cooking history ones also depend on foods and logs
+CACHED_CONSTRAINT_TYPES = ['book', 'food', 'keyword', 'rating', 'cookedon', 'createdon']
 
 
 class Menu:
@@ -21,22 +37,62 @@ class Menu:
     rating_constraints = None
     cookedon_constraints = None
     createdon_constraints = None
+    onhand_constraints = None
+    cookcount_constraints = None
+    planned_constraints = None
 
-    def __init__(self, options):
+    def __init__(self, options, tandoor=None, logger=None):
         self.options = options
         self.include_children = self.options.include_children
-        self.logger = setup_logging(log=self.options.log)
-        self.tandoor = TandoorAPI(self.options.url, self.options.token, self.logger, cache=int(self.options.cache))
+        self.logger = logger or setup_logging(log=self.options.log)
+        # menus created from the same server can share one api, and with it everything it has fetched
+        self.tandoor = tandoor or TandoorAPI(
+            self.options.url, self.options.token, self.logger,
+            cache=int(self.options.cache),
+            rate_limit=float(self.options.rate_limit),
+            max_concurrency=int(self.options.max_concurrency),
+            retries=int(self.options.retries),
+            snapshot=self.options.offline and read_snapshot(self.options.offline),
+            record=self.options.record,
+            replay=self.options.replay,
+            replay_latency=float(self.options.replay_latency)
+        )
         self.choices = int(self.options.choices)
         self.recipes = []
+        self.profiler = Profiler(self.options.profile, self.logger)
+        # makes the solver's random weights and substitutes, and with them the menu, reproducible
+        # without touching the random module's state
+        self.random = random.Random(self.options.seed)
 
         self.__format_constraints__()
-
-    def __format_constraints__(self):
-        constraints = ['book', 'food', 'keyword', 'rating', 'cookedon', 'createdon']
-        for c in constraints:
-            setattr(self, f'{c}_constraints', [json.loads(x.replace("'", '"')) for x in getattr(self.options, c, [])])
+        self.ingredient_index = None
+        self.book_index = None
+        # see __data_version__
+        self.data_version = None
+        self.pantry = None
+        self.history = None
+        # meal plans of the last selection by recipe id, see reroll
+        self.plans = {}
+        self.__indexes__()
+
+    def __indexes__(self):
+        # indexes the options or constraints need and that don't exist yet
+        if not self.ingredient_index and (self.options.food_index or self.onhand_constraints):
+            self.ingredient_index = IngredientIndex(self.tandoor, self.logger, include_children=self.include_children)
+        if not self.book_index and self.options.book_index and self.book_constraints:
+            self.book_index = BookIndex(self.tandoor, self.logger, max_age=timedelta(minutes=int(self.options.cache)))
+        if not self.history and (self.options.history_index or self.cookcount_constraints or self.planned_constraints):
+            self.history = HistoryIndex(self.tandoor, self.logger)
+
+    def __format_constraints__(self, constraints=None):
+        # constraints: {constraint type: list of constraints}, the options' constraints by default
+        for c in CONSTRAINT_TYPES:
+            values = getattr(self.options, c, None) if constraints is None else constraints.get(c, None)
+            # dicts are copied, preparing a constraint replaces its condition
+            setattr(self, f'{c}_constraints', [json.loads(x.replace("'", '"')) if isinstance(x, str) else dict(x) for x in values or []])
             for x in getattr(self, f'{c}_constraints', []):
+                # as configured, before relative dates are resolved
+                x['source'] = json.dumps([c, x], sort_keys=True)
                 x['count'] = int(x['count'])
                 if y := x.get('cooked', None):
                     x['cooked'], x['cooked_after'] = format_date(y)
@@ -45,17 +101,34 @@ class Menu:
 
     def prepare_recipes(self):
         if not self.options.recipes and not self.options.filters and not self.options.plan_type:
-            for r in self.tandoor.get_recipes(all_recipes=True):
-                self.recipes.append(Recipe(r))
+            if self.options.columnar and self.__columnar_fresh__(self.options.columnar):
+                self.recipes = RecipeColumns(self.options.columnar).recipes()
+                self.logger.debug(f'Mapped {len(self.recipes)} recipes from {self.options.columnar}.')
+            else:
+                for r in self.tandoor.get_recipes(all_recipes=True):
+                    self.recipes.append(Recipe(r))
+                if self.options.columnar:
+                    write_columns(self.options.columnar, self.recipes)
         else:
             for r in self.tandoor.get_recipes(params=self.options.recipes, filters=self.options.filters):
                 self.recipes.append(Recipe(r))
-            for r in self.tandoor.get_mealplan_recipes(mealtype_id=self.options.plan_type, date=args.mp_date, params=self.options.recipes):
+            for r in self.tandoor.get_mealplan_recipes(mealtype_id=self.options.plan_type, date=self.options.mp_date, params=self.options.recipes):
                 self.recipes.append(Recipe(r))
-        self.recipes = list(set(menu.recipes))
+        self.recipes = list(set(self.recipes))
+
+    def __columnar_fresh__(self, path):
+        # columns are reused for as long as the recipe list itself would be cached
+        if not os.path.exists(path):
+            return False
+        if self.options.offline:
+            return True
+        age = time.time() - os.path.getmtime(path)
+        return int(self.options.cache) > 0 and age < int(self.options.cache) * 60
 
     def prepare_books(self):
-        for constraint in self.book_constraints:
+        for constraint in self.__phases__('book', self.book_constraints):
+            if constraint.get('resolved', None) is not None:
+                continue
             if not isinstance(c := constraint['condition'], list):
                 constraint['condition'] = [c]
             if not isinstance(c := constraint.get('except', []), list):
@@ -72,9 +145,14 @@ class Menu:
             constraint['except'] = book_list
 
             found_recipes = []
-            for bk in constraint['condition']:
-                for r in self.tandoor.get_book_recipes(bk):
-                    found_recipes.append(Recipe(r))
+            if self.book_index:
+                self.book_index.sync(constraint['condition'] + constraint['except'])
+                recipe_ids = self.book_index.recipes_in(constraint['condition'], exclude=constraint['except'])
+                found_recipes = [r for r in self.recipes if r.id in recipe_ids]
+            else:
+                for bk in constraint['condition']:
+                    for r in self.tandoor.get_book_recipes(bk):
+                        found_recipes.append(Recipe(r))
 
             if cooked := constraint.get('cooked', None):
                 found_recipes = Recipe.recipesWithDate(found_recipes, 'cookedon', cooked, constraint.get('cooked_after', False))
@@ -84,7 +162,9 @@ class Menu:
             constraint['condition'] = found_recipes
 
     def prepare_foods(self):
-        for constraint in self.food_constraints:
+        for constraint in self.__phases__('food', self.food_constraints):
+            if constraint.get('resolved', None) is not None:
+                continue
             if not isinstance(c := constraint['condition'], list):
                 constraint['condition'] = [c]
             if not isinstance(c := constraint.get('except', []), list):
@@ -100,14 +180,20 @@ class Menu:
                 food_list.append(Food(self.tandoor.get_food(fd)))
             constraint['except'] = food_list
 
-            # recipe api doesn't include ingredients, so get a list of ingredients with the food
-            params = {
-                'foods_or': [f.id for f in constraint['condition']],
-                'foods_or_not': [f.id for f in constraint['except']]
-            }
             found_recipes = []
-            for r in self.tandoor.get_recipes(params=params):
-                found_recipes.append(Recipe(r))
+            if self.ingredient_index:
+                self.ingredient_index.update(self.recipes)
+                recipe_ids = self.ingredient_index.recipes_with_foods(constraint['condition'])
+                recipe_ids -= self.ingredient_index.recipes_with_foods(constraint['except'])
+                found_recipes = [r for r in self.recipes if r.id in recipe_ids]
+            else:
+                # recipe api doesn't include ingredients, so get a list of ingredients with the food
+                params = {
+                    'foods_or': [f.id for f in constraint['condition']],
+                    'foods_or_not': [f.id for f in constraint['except']]
+                }
+                for r in self.tandoor.get_recipes(params=params):
+                    found_recipes.append(Recipe(r))
             if cooked := constraint.get('cooked', None):
                 found_recipes = Recipe.recipesWithDate(found_recipes, 'cookedon', cooked, constraint.get('cooked_after', False))
             if created := constraint.get('created', None):
@@ -117,7 +203,9 @@ class Menu:
 
     def prepare_keywords(self):
         # TODO add 'except' condition to list of keywords
-        for constraint in self.keyword_constraints:
+        for constraint in self.__phases__('keyword', self.keyword_constraints):
+            if constraint.get('resolved', None) is not None:
+                continue
             if not isinstance(c := constraint['condition'], list):
                 constraint['condition'] = [c]
             if not isinstance(c := constraint.get('except', []), list):
@@ -128,71 +216,455 @@ class Menu:
                     kw_tree += self.tandoor.get_keyword_tree(kw)
             constraint['condition'] = list(set([Keyword(k) for k in kw_tree]))
 
+    def prepare_pantry(self):
+        with self.profiler.phase('pantry'):
+            if not self.pantry and (self.options.pantry or self.onhand_constraints):
+                self.pantry = Pantry(self.tandoor, self.logger, seed=self.options.seed)
+            if self.onhand_constraints:
+                self.ingredient_index.update(self.recipes)
+
+    def prepare_history(self):
+        if self.cookcount_constraints or self.planned_constraints:
+            with self.profiler.phase('history'):
+                self.history.sync()
+
     def prepare_data(self):
         self.prepare_recipes()
+        self.prepare_constraints()
+
+    def prepare_constraints(self):
+        self.__load_resolved__()
         self.prepare_keywords()
         self.prepare_foods()
         self.prepare_books()
+        self.prepare_pantry()
+        self.prepare_history()
+
+    def __phases__(self, kind, constraints):
+        # every constraint is profiled as a phase of its own, the body of the loop runs inside it
+        for i, c in enumerate(constraints):
+            with self.profiler.phase(f'{kind} constraint {i}'):
+                yield c
+
+    def __data_version__(self):
+        # changes whenever a recipe is added, removed, updated, cooked or rated
+        if self.data_version is None:
+            sha = hashlib.sha1()
+            # values are normalized, recipes read from columns have UTC dates and float ratings
+            for r in sorted(self.recipes, key=lambda r: r.id):
+                values = [int(r.id), *(d and d.timestamp() for d in (r.updatedon, r.cookedon)), None if r.rating is None else float(r.rating)]
+                sha.update(f'{"|".join(str(x) for x in values)}\n'.encode('utf-8'))
+            self.data_version = sha.hexdigest()
+        return self.data_version
+
+    def __load_resolved__(self):
+        '''
+        reads the recipes of constraints resolved by an earlier run from the cache; results are kept for as
+        long as API results, for the same recipes and, since relative dates move, only on the same day
+        '''
+        if not int(self.options.cache) or self.options.export_snapshot:
+            # a snapshot has to hold every request that resolving the constraints makes
+            return
+        version, today = self.__data_version__(), date.today().isoformat()
+        resolved = 0
+        for c in CACHED_CONSTRAINT_TYPES:
+            for x in getattr(self, f'{c}_constraints'):
+                # indexes may resolve a constraint differently than the server
+                options = [self.include_children, bool(self.options.food_index), bool(self.options.book_index)]
+                x['key'] = f"constraint:{persistent_key(json.dumps([x['source'], version, today, *options]))}"
+                try:
+                    with caches_lock:
+                        x['resolved'] = set(load_result(x['key']))
+                    resolved += 1
+                except KeyError:
+                    x['resolved'] = None
+        if resolved:
+            self.logger.debug(f'Read {resolved} resolved constraints from the cache.')
+
+    def __resolved__(self, constraint):
+        '''
+        Returns:
+            list of the recipes a constraint was resolved to, None when it isn't resolved yet
+        '''
+        if (ids := constraint.get('resolved', None)) is None:
+            return None
+        return [r for r in self.recipes if r.id in ids]
+
+    def __resolve__(self, constraint, recipes):
+        constraint['resolved'] = {r.id for r in recipes}
+        if key := constraint.get('key', None):
+            with caches_lock:
+                store_result(key, sorted(constraint['resolved']), datetime.now() + timedelta(minutes=int(self.options.cache)))
+
+    def with_constraints(self, constraints=None, choices=None, seed=None):
+        '''
+        constraints: {constraint type: list of constraints} in the format of the options, the options' constraints by default
+        choices: number of recipes to choose, the options' choices by default
+        seed: seed for random choices, the options' seed by default
+
+        Returns:
+            a Menu with the recipes, api and indexes of this one and the constraints prepared
+        '''
+        menu = copy.copy(self)
+        menu.recipe_picker = None
+        menu.plans = {}
+        menu.choices = int(self.choices if choices is None else choices)
+        # every menu gets its own generator, the same seed always creates the same menu
+        menu.random = random.Random(self.options.seed if seed is None else seed)
+        menu.__format_constraints__(constraints)
+        menu.__indexes__()
+        menu.__load_resolved__()
+        menu.prepare_keywords()
+        menu.prepare_foods()
+        menu.prepare_books()
+        menu.prepare_pantry()
+        # the history is shared with this menu and synced once, later calls return right away
+        menu.prepare_history()
+        return menu
+
+    def export_snapshot(self):
+        # everything a run needs beyond prepare_data: the meal type and, optionally, recipe details for the menu file
+        if self.options.mp_type:
+            self.tandoor.get_meal_type(self.options.mp_type)
+        if self.options.snapshot_details:
+            for r in self.recipes:
+                self.tandoor.get_recipe_details(r.id)
+        count = write_snapshot(self.options.export_snapshot, self.tandoor)
+        self.logger.info(f'Saved {count} requests to snapshot {self.options.export_snapshot}.')
+
+    def import_snapshot(self):
+        count = import_snapshot(read_snapshot(self.options.import_snapshot), self.options.cache)
+        self.logger.info(f'Imported {count} requests from snapshot {self.options.import_snapshot} into the cache.')
 
     def select_recipes(self):
-        self.recipe_picker = RecipePicker(self.recipes, self.choices, logger=self.logger)
+        self.build_picker()
+        return self.recipe_picker.solve()
+
+    def build_picker(self):
+        self.recipe_picker = RecipePicker(
+            self.recipes, self.choices, logger=self.logger, rng=self.random, profiler=self.profiler
+        )
         # add keyword constraints
-        for c in self.keyword_constraints:
+        for c in self.__phases__('keyword', self.keyword_constraints):
             exclude = str2bool(c.get('exclude', False))
-            found_recipes = Recipe.recipesWithKeyword(self.recipes, c['condition'])
-            if cooked := c.get('cooked', None):
-                found_recipes = Recipe.recipesWithDate(found_recipes, 'cookedon', cooked, c.get('cooked_after', False))
-            if created := c.get('created', None):
-                found_recipes = Recipe.recipesWithDate(found_recipes, 'createdon', created, c.get('created_after', False))
+            if (found_recipes := self.__resolved__(c)) is None:
+                found_recipes = Recipe.recipesWithKeyword(self.recipes, c['condition'])
+                if cooked := c.get('cooked', None):
+                    found_recipes = Recipe.recipesWithDate(found_recipes, 'cookedon', cooked, c.get('cooked_after', False))
+                if created := c.get('created', None):
+                    found_recipes = Recipe.recipesWithDate(found_recipes, 'createdon', created, c.get('created_after', False))
+                self.__resolve__(c, found_recipes)
             self.recipe_picker.add_keyword_constraint(found_recipes, c['count'], c['operator'], exclude=exclude)
 
         # add food constraints
-        for c in self.food_constraints:
+        for c in self.__phases__('food', self.food_constraints):
             exclude = str2bool(c.get('exclude', False))
-            self.recipe_picker.add_food_constraint(c['condition'], c['count'], c['operator'], exclude=exclude)
+            if (found_recipes := self.__resolved__(c)) is None:
+                found_recipes = c['condition']
+                self.__resolve__(c, found_recipes)
+            self.recipe_picker.add_food_constraint(found_recipes, c['count'], c['operator'], exclude=exclude)
 
         # add book constraints
-        for c in self.book_constraints:
+        for c in self.__phases__('book', self.book_constraints):
             exclude = str2bool(c.get('exclude', False))
-            self.recipe_picker.add_book_constraint(c['condition'], c['count'], c['operator'], exclude=exclude)
+            if (found_recipes := self.__resolved__(c)) is None:
+                found_recipes = c['condition']
+                self.__resolve__(c, found_recipes)
+            self.recipe_picker.add_book_constraint(found_recipes, c['count'], c['operator'], exclude=exclude)
 
         # add rating contraints
-        for c in self.rating_constraints:
+        for c in self.__phases__('rating', self.rating_constraints):
+            exclude = str2bool(c.get('exclude', False))
+            if (found_recipes := self.__resolved__(c)) is None:
+                found_recipes = self.recipes
+                if cooked := c.get('cooked', None):
+                    found_recipes = Recipe.recipesWithDate(found_recipes, 'cookedon', cooked, after=c.get('cooked_after', False))
+                if created := c.get('created', None):
+                    found_recipes = Recipe.recipesWithDate(found_recipes, 'createdon', created, after=c.get('created_after', False))
+                found_recipes = Recipe.recipesWithRating(found_recipes, c.get('condition'))
+                self.__resolve__(c, found_recipes)
+            self.recipe_picker.add_rating_constraints(found_recipes, c['count'], c['operator'], exclude=exclude)
+
+        # add cookedon constraints
+        for c in self.__phases__('cookedon', self.cookedon_constraints):
+            exclude = str2bool(c.get('exclude', False))
+            if (found_recipes := self.__resolved__(c)) is None:
+                d, a = format_date(c['condition'])
+                found_recipes = Recipe.recipesWithDate(self.recipes, 'cookedon', d, after=a)
+                if created := c.get('created', None):
+                    found_recipes = Recipe.recipesWithDate(found_recipes, 'createdon', created, after=c.get('created_after', False))
+                self.__resolve__(c, found_recipes)
+            self.recipe_picker.add_cookedon_constraints(found_recipes, c['count'], c['operator'], exclude=exclude)
+
+        # add createdon constraints
+        for c in self.__phases__('createdon', self.createdon_constraints):
+            exclude = str2bool(c.get('exclude', False))
+            if (found_recipes := self.__resolved__(c)) is None:
+                d, a = format_date(c['condition'])
+                found_recipes = Recipe.recipesWithDate(self.recipes, 'createdon', d, after=a)
+                if cookedon := c.get('cookedon', None):
+                    found_recipes = Recipe.recipesWithDate(found_recipes, 'cookedon', cookedon, after=c.get('cookedon_after', False))
+                self.__resolve__(c, found_recipes)
+            self.recipe_picker.add_createdon_constraints(found_recipes, c['count'], c['operator'], exclude=exclude)
+
+        # add onhand constraints
+        for c in self.__phases__('onhand', self.onhand_constraints):
             exclude = str2bool(c.get('exclude', False))
-            found_recipes = self.recipes
+            found_recipes = [r for r in self.recipes if self.pantry.can_cook(self.ingredient_index.foods_of(r.id))]
             if cooked := c.get('cooked', None):
                 found_recipes = Recipe.recipesWithDate(found_recipes, 'cookedon', cooked, after=c.get('cooked_after', False))
             if created := c.get('created', None):
                 found_recipes = Recipe.recipesWithDate(found_recipes, 'createdon', created, after=c.get('created_after', False))
-            self.recipe_picker.add_rating_constraints(Recipe.recipesWithRating(found_recipes, c.get('condition')), c['count'], c['operator'], exclude=exclude)
+            self.recipe_picker.add_onhand_constraints(found_recipes, c['count'], c['operator'], exclude=exclude)
 
-        # add cookedon constraints
-        for c in self.cookedon_constraints:
+        # add cooking history constraints
+        for c in self.__phases__('cookcount', self.cookcount_constraints):
             exclude = str2bool(c.get('exclude', False))
-            d, a = format_date(c['condition'])
-            found_recipes = Recipe.recipesWithDate(self.recipes, 'cookedon', d, after=a)
+            since, _ = format_date(c['condition'])
+            found_recipes = [r for r in self.recipes if self.history.times_cooked(r.id, since) < int(c.get('times', 1))]
             if created := c.get('created', None):
                 found_recipes = Recipe.recipesWithDate(found_recipes, 'createdon', created, after=c.get('created_after', False))
-            self.recipe_picker.add_cookedon_constraints(found_recipes, c['count'], c['operator'], exclude=exclude)
+            self.recipe_picker.add_cookcount_constraints(found_recipes, c['count'], c['operator'], exclude=exclude)
 
-        # add createdon constraints
-        for c in self.createdon_constraints:
+        for c in self.__phases__('planned', self.planned_constraints):
             exclude = str2bool(c.get('exclude', False))
-            d, a = format_date(c['condition'])
-            found_recipes = Recipe.recipesWithDate(self.recipes, 'createdon', d, after=a)
-            if cookedon := c.get('cookedon', None):
-                found_recipes = Recipe.recipesWithDate(found_recipes, 'cookedon', cookedon, after=c.get('cookedon_after', False))
-            self.recipe_picker.add_createdon_constraints(found_recipes, c['count'], c['operator'], exclude=exclude)
+            since, _ = format_date(c['condition'])
+            planned = self.history.planned_between(since, meal_type=c.get('meal_type', None))
+            found_recipes = [r for r in self.recipes if r.id in planned]
+            self.recipe_picker.add_planned_constraints(found_recipes, c['count'], c['operator'], exclude=exclude)
+        return self.recipe_picker
+
+    def __selection_key__(self):
+        # one selection per server, config file and meal type
+        return f'selection:{persistent_key(json.dumps([self.tandoor.url, os.path.abspath(self.options.my_config), self.options.mp_type]))}'
+
+    def save_selection(self, recipes, plans={}):
+        '''
+        remembers the selection, and the meal plans created for it, so that recipes can be rerolled later
+        plans: {recipe id: meal plan id}
+        '''
+        selection = {
+            'recipes': [r.id for r in recipes],
+            'rejected': sorted(self.recipe_picker.rejected) if self.recipe_picker else [],
+            'plans': {str(k): v for k, v in plans.items()}
+        }
+        with caches_lock:
+            caches[self.__selection_key__()] = {'data': selection, 'expired': datetime.max}
+
+    def load_selection(self):
+        with caches_lock:
+            record = caches.get(self.__selection_key__(), None)
+        if not record:
+            raise RuntimeError('There is no earlier selection to reroll, create a menu first.')
+        selection = record['data']
+        return selection['recipes'], set(selection['rejected']), {int(k): v for k, v in selection['plans'].items()}
+
+    def reroll(self, rejected):
+        '''
+        replaces recipes of the last selection, keeping the others and the constraints they were chosen with
+        rejected: IDs of the recipes to replace; recipes rejected before aren't chosen again
+
+        Returns:
+            the new selection in the order of the last one and {replaced recipe id: new recipe}
+        '''
+        previous, earlier, self.plans = self.load_selection()
+        recipes = {r.id: r for r in self.recipes}
+        if unknown := set(rejected) - set(previous):
+            self.logger.warning(f'Recipes {sorted(unknown)} are not in the last selection.')
+        # recipes that no longer match the filters are replaced as well
+        previous = [i for i in previous if i in recipes]
+        picker = self.build_picker()
+        picker.selected = [recipes[i] for i in previous]
+        picker.rejected = earlier
+        selection = picker.reroll(rejected)
+        replaced = {old: new for old, new in zip(previous, selection) if old != new.id}
+        self.logger.info(f'Rerolled {len(replaced)} of {len(selection)} recipes.')
+        return selection, replaced
+
+    def print_selection(self, recipes, title='Your selected recipes are:'):
+        self.logger.info(f'Selected {len(recipes)} recipes for the menu.')
+        if self.logger.loglevel == 10:
+            for r in recipes:
+                date_cooked = (x := getattr(r, 'cookedon', None)) and x.strftime("%Y-%m-%d") or "Never"
+                self.logger.debug(f'Selected recipe {r} for the menu with rating {r.rating}. Created on: {r.createdon.strftime("%Y-%m-%d")} and last cooked {date_cooked}')
+                kw_list = []
+                for kw in r.keywords:
+                    kw_list.append(kw)
+                self.logger.debug(f'Selected recipe {r} contains keywords {kw_list}.')
+
+        print(f'\n\n###########################\n{title}')
+        for r in recipes:
+            if self.tandoor.url:
+                print(f'Recipe: <{r.id}> {r.name}: {self.tandoor.url.replace("/api/","/view/recipe/")}{r.id}')
+            else:
+                # without a server there is nothing to link to
+                print(f'Recipe: <{r.id}> {r.name}')
 
-        return self.recipe_picker.solve()
+        print('###########################\n')
 
-    def generate_menu_file(self):
+    def generate_menu_file(self, recipes):
         self.logger.info('Generating menu file, this may take awhile.')
-        menu = MenuGenerator(self.tandoor, self.options, self.logger)
+        menu = MenuGenerator(self.tandoor, self.options, self.logger, pantry=self.pantry, rng=self.random)
         menu.write_menu(recipes)
 
 
-def parse_args():
+class MenuSession:
+    """
+    The steps of creating a menu for use from another program: load() fetches the recipes once and
+    select() can then be called as often as needed, each time with other constraints if wanted, without
+    fetching anything again.  create_meal_plans() and render() work on the last selection.
+    """
+    def __init__(self, options, tandoor=None, logger=None):
+        # options are validated once by whoever parsed them, see from_config
+        self.options = options
+        self.menu = Menu(options, tandoor=tandoor, logger=logger)
+        self.tandoor = self.menu.tandoor
+        self.logger = self.menu.logger
+        # preparing constraints shares the api's and indexes' state, solving doesn't
+        self.lock = threading.Lock()
+        self.loaded = False
+        self.selected = None
+        self.recipes = []
+        self.replaced = None
+
+    @classmethod
+    def from_config(cls, path='config.ini', logger=None, **options):
+        '''
+        path: config file
+        options: options overriding the config file, e.g. choices=7 or keyword=[...]
+
+        Returns:
+            a MenuSession with the options of the config file
+        '''
+        args = parse_args(['-c', path])
+        for k, v in options.items():
+            setattr(args, k, v)
+        validate_args(args)
+        return cls(args, logger=logger)
+
+    def load(self):
+        with self.lock:
+            if not self.loaded:
+                # constraints are prepared by every select, for the constraints it is given
+                with self.menu.profiler.phase('recipes'):
+                    self.menu.prepare_recipes()
+                self.menu.prepare_history()
+                self.loaded = True
+        return self
+
+    def select(self, constraints=None, choices=None, seed=None):
+        '''
+        constraints: {constraint type: list of constraints}, e.g. {'keyword': [{'condition': 73, 'count': 1, 'operator': '>='}]};
+            the session's constraints by default
+        choices: number of recipes to choose
+        seed: seed for random choices
+
+        Returns:
+            list of selected Recipes
+        '''
+        self.load()
+        with self.lock:
+            menu = self.menu.with_constraints(constraints, choices=choices, seed=seed)
+        if len(menu.recipes) < menu.choices:
+            raise RuntimeError(f'Not enough recipes to generate a menu.  Only {len(menu.recipes)} recipes to work with.')
+        recipes = menu.build_picker().solve()
+        self.selected, self.recipes, self.replaced = menu, recipes, None
+        return recipes
+
+    def reroll(self, rejected):
+        '''
+        rejected: IDs of recipes of the last saved selection to replace
+
+        Returns:
+            list of selected Recipes, see Menu.reroll
+        '''
+        self.load()
+        with self.lock:
+            menu = self.menu.with_constraints()
+        recipes, replaced = menu.reroll(rejected)
+        self.selected, self.recipes, self.replaced = menu, recipes, replaced
+        return recipes
+
+    def create_meal_plans(self):
+        '''
+        creates meal plans of the last selection with the session's meal plan options, after a reroll
+        only the plans of replaced recipes are changed; the selection is saved for later rerolls either way
+
+        Returns:
+            {recipe id: meal plan id}
+        '''
+        if self.selected is None:
+            raise RuntimeError('Select recipes before creating meal plans.')
+        with self.menu.profiler.phase('meal plans'):
+            return self.__create_meal_plans__()
+
+    def __create_meal_plans__(self):
+        options, plans = self.options, {}
+        if options.create_mp:
+            mpm = MealPlanManager(self.tandoor, self.logger, history=self.menu.history)
+            if self.replaced is not None:
+                # only the plans of rerolled recipes change
+                plans = mpm.replace_recipes(self.selected.plans, self.replaced, options.mp_type, date=options.mp_date, note=options.mp_note, share=options.share_with)
+            elif options.reconcile_mp:
+                plans = mpm.reconcile(
+                    self.recipes, options.mp_type, options.mp_date, note=options.mp_note, share=options.share_with,
+                    cleanup_date=options.cleanup_date if options.cleanup_mp else None, max_workers=self.tandoor.max_concurrency
+                )
+            else:
+                if options.cleanup_mp:
+                    mpm.cleanup_uncooked(date=options.cleanup_date, mp_type=options.mp_type)
+                created = mpm.create_from_recipes(self.recipes, options.mp_type, date=options.mp_date, note=options.mp_note, share=options.share_with)
+                plans = {r.id: p['id'] for r, p in zip(self.recipes, created)}
+        elif self.replaced is not None:
+            plans = {k: v for k, v in self.selected.plans.items() if k not in self.replaced}
+        self.selected.save_selection(self.recipes, plans)
+        return plans
+
+    def render(self):
+        if self.selected is None:
+            raise RuntimeError('Select recipes before creating a menu file.')
+        with self.menu.profiler.phase('render'):
+            self.selected.generate_menu_file(self.recipes)
+
+    def close(self):
+        if self.tandoor.progress:
+            self.tandoor.progress.last_step()
+            self.tandoor.progress.close()
+        self.menu.profiler.close()
+
+    def run(self):
+        for arg in self.options._get_kwargs():
+            self.logger.debug(f'Argument {arg[0]}: {arg[1]}')
+        try:
+            self.__run__()
+        finally:
+            self.close()
+
+    def __run__(self):
+        if self.options.import_snapshot:
+            self.menu.import_snapshot()
+            return
+        self.load()
+        if self.options.export_snapshot:
+            self.menu.prepare_constraints()
+            self.menu.export_snapshot()
+            return
+
+        if len(self.menu.recipes) < self.menu.choices:
+            self.logger.info(f"Not enough recipes to generate a menu.  Only {len(self.menu.recipes)} recipes to work with.")
+            return
+        if self.options.reroll:
+            self.reroll(self.options.reroll)
+        else:
+            self.select()
+
+        self.selected.print_selection(self.recipes)
+        self.create_meal_plans()
+        if self.options.create_file:
+            self.render()
+
+
+def parse_args(argv=None, config_file_contents=None):
     parser = configargparse.ArgParser(
         config_file_parser_class=configargparse.ConfigparserConfigFileParser,
         description='Create a custom menu from recipes in Tandoor with defined criteria.'
@@ -201,8 +673,20 @@ def parse_args():
     parser.add_argument('-c', '--my-config', is_config_file=True, default='config.ini', help='Specify configuration file.')
     parser.add_argument('--log', default='info', help='Sets the logging level')
     parser.add_argument('--cache', default='240', help='Minutes to cache Tandoor API results; 0 to disable.')
-    parser.add_argument('--url', type=str, required=True, help='The full url of the Tandoor server, including protocol, name, port and path')
-    parser.add_argument('--token', type=str, required=True, help='Tandoor API token.')
+    parser.add_argument('--url', type=str, help='(required) The full url of the Tandoor server, including protocol, name, port and path')
+    parser.add_argument('--token', type=str, help='(required) Tandoor API token.')
+    parser.add_argument('--rate_limit', default='0', help='Maximum Tandoor API requests per second; 0 for no limit.')
+    parser.add_argument('--max_concurrency', default='1', help='Maximum concurrent Tandoor API requests; lowered automatically when the server slows down.')
+    parser.add_argument('--retries', default='3', help='Times to retry a request when the server responds 429, or 503 to a request that is safe to repeat.')
+    parser.add_argument('--export_snapshot', type=str, help='Save the data needed to create a menu to a snapshot file and exit.')
+    parser.add_argument('--snapshot_details', action='store_true', default=False, help='Include recipe details, required to create menu files offline.')
+    parser.add_argument('--import_snapshot', type=str, help='Load a snapshot file into the cache and exit.')
+    parser.add_argument('--columnar', type=str, help='Keep all recipes in a memory mapped columnar file for faster startup.')
+    parser.add_argument('--offline', type=str, help='Create the menu from a snapshot file without connecting to Tandoor.')
+    parser.add_argument('--record', type=str, help='Record every Tandoor API request and response to a cassette file.')
+    parser.add_argument('--replay', type=str, help='Replay the responses of a cassette file instead of connecting to Tandoor.')
+    parser.add_argument('--profile', type=str, help='Profile every phase of the run and save the profiles and a flame graph of samples to this directory.')
+    parser.add_argument('--replay_latency', default='0', help='Delay replayed responses by this factor of their recorded time; 0 for no delay.')
     # solver related switches
     parser.add_argument('--recipes', type=yaml.safe_load, help='recipes to choose from; search parameters, see /docs/api/ for full list of parameters')
     parser.add_argument('--filters', nargs='*', default=[], help='Array of CustomFilter IDs')
@@ -214,31 +698,49 @@ def parse_args():
     parser.add_argument('--rating', nargs='*', default=[], help='condition = number between 0 and 5')
     parser.add_argument('--cookedon', nargs='*', default=[], help="condition = date in YYYY-MM-DD format (use 'XXdays' for relative date XX days ago)")
     parser.add_argument('--createdon', nargs='*', default=[], help="condition = date in YYYY-MM-DD format (use 'XXdays' for relative date XX days ago)")
+    parser.add_argument('--onhand', nargs='*', default=[], help="Recipes that can be made with foods on hand or their on hand substitutes, e.g. [{'count':'5', 'operator':'=='}]")
+    parser.add_argument('--cookcount', nargs='*', default=[], help="Recipes cooked fewer than 'times' since the condition date, e.g. [{'condition':'30days', 'times':'2', 'count':'5', 'operator':'=='}]")
+    parser.add_argument('--planned', nargs='*', default=[], help="Recipes in a meal plan since the condition date, e.g. [{'condition':'7days', 'count':'0', 'operator':'=='}]")
+    parser.add_argument('--history_index', action='store_true', default=False, help='Answer cooking history questions, including meal plan cleanup, from a local index of cook logs and meal plans.')
     parser.add_argument('--include_children', action='store_true', default=True, help='For keywords and foods, child objects also satisfy the condition.')
+    parser.add_argument('--food_index', action='store_true', default=False, help='Resolve food conditions from a local ingredient index instead of a server search.')
+    parser.add_argument('--book_index', action='store_true', default=False, help='Resolve book conditions from a local index of the recipe IDs in each book.')
+    parser.add_argument('--pantry', action='store_true', default=False, help='Resolve on hand substitutes from a single snapshot of all foods.')
+    parser.add_argument('--seed', type=int, help='Seed for random choices; the same seed and data create the same menu.')
+    parser.add_argument('--reroll', nargs='*', type=int, default=[], help='Replace these recipe IDs of the last menu, keeping the rest; only their meal plans are updated.')
     # mealplan related switches
     parser.add_argument('--create_mp', action='store_true', default=False, help='Add mealplans for chosen recipes.')
     parser.add_argument('--share_with', nargs='*', default=[], help='Share mealplan with ID(s).')
     parser.add_argument('--mp_date', type=str, default='0days', help='Date to create mealplan in YYYY-MM-DD format or XXdays.')
+    parser.add_argument('--reconcile_mp', action='store_true', default=False, help='Only create, change and delete the meal plans that differ from the selected recipes.')
     parser.add_argument('--mp_type', help='ID of meal play type; seperate mealplan types are strongly encouraged.')
     parser.add_argument('--mp_note', type=str, default='Created by: Tandoor Menu Generator.')
     parser.add_argument('--cleanup_mp', action='store_true', default=False, help='Delete uncooked mealplans at next execution.')
     parser.add_argument('--cleanup_date', type=str, default='-7days', help='Starting date to cleanup uncooked mealplans in YYYY-MM-DD format or -XXdays.')
     # menu file creation related switches
     parser.add_argument('--create_file', action='store_true', default=False, help='Create a menu from an SVG template.')
-    parser.add_argument('--file_format', type=str, default='PNG', help='File format to save the menu. Options: GIF, JPG, PNG, PDF.')
+    parser.add_argument('--file_format', nargs='*', default=['PNG'], help='One or more file formats to save the menu. Options: GIF, JPG, PNG, PDF.')
+    parser.add_argument('--file_dpi', nargs='*', default=[72], help='One or more resolutions to render GIF, JPG and PNG files.')
     parser.add_argument('--output_dir', type=str, help='Defaults to template dir.  Full path required.')
-    parser.add_argument('--file_template', type=str, help='Name of SVG file located in templates/ directory.')
+    parser.add_argument('--file_template', nargs='*', default=[], help='One or more names of SVG files located in templates/ directory.')
     parser.add_argument('--fonts', nargs='*', default=[], help='Non-system fonts required for the SVG template.')
     parser.add_argument('--replace_text', type=yaml.safe_load, help='Text to search for in the template and replace with menu details.')
     parser.add_argument('--seperator', type=str, default=' - ', help='seperator to use when concatanating ingredients.')
 
-    args = parser.parse_args()
+    args = parser.parse_args(argv, config_file_contents=config_file_contents)
     args.seperator = args.seperator.replace("'", "").replace('"', '')
     return args
 
 
 def validate_args(args):
     valid = True
+    if not args.offline and not args.replay and not (args.url and args.token):
+        raise RuntimeError('"url" and "token" are required unless running "offline" or from a "replay".')
+    if args.record and args.replay:
+        raise RuntimeError('"record" and "replay" can not be used together.')
+    if args.offline and args.create_mp:
+        print('Meal plans can not be created offline, "create_mp" is disabled.')
+        args.create_mp = False
     args.mp_date, _ = format_date(args.mp_date, future=True)
     if args.create_mp:
         if not bool(args.mp_date) & bool(args.mp_type):
@@ -261,41 +763,4 @@ def validate_args(args):
 if __name__ == "__main__":
     args = parse_args()
     validate_args(args)
-    menu = Menu(args)
-    for arg in args._get_kwargs():
-        menu.logger.debug(f'Argument {arg[0]}: {arg[1]}')
-    menu.prepare_data()
-
-    if len(menu.recipes) < menu.choices:
-        menu.logger.info(f"Not enough recipes to generate a menu.  Only {len(menu.recipes)} recipes to work with.")
-        exit()
-
-    recipes = menu.select_recipes()
-
-    menu.logger.info(f'Selected {len(recipes)} recipes for the menu.')
-    if menu.logger.loglevel == 10:
-        for r in recipes:
-            date_cooked = (x := getattr(r, 'cookedon', None)) and x.strftime("%Y-%m-%d") or "Never"
-            menu.logger.debug(f'Selected recipe {r} for the menu with rating {r.rating}. Created on: {r.createdon.strftime("%Y-%m-%d")} and last cooked {date_cooked}')
-            kw_list = []
-            for kw in r.keywords:
-                kw_list.append(kw)
-            menu.logger.debug(f'Selected recipe {r} contains keywords {kw_list}.')
-
-    print('\n\n###########################\nYour selected recipes are:')
-    for r in recipes:
-        print(f'Recipe: <{r.id}> {r.name}: {menu.tandoor.url.replace("/api/","/view/recipe/")}{r.id}')
-
-    print('###########################\n')
-    if args.create_mp:
-        mpm = MealPlanManager(menu.tandoor, menu.logger)
-        if args.cleanup_mp:
-            mpm.cleanup_uncooked(date=args.cleanup_date, mp_type=args.mp_type)
-        mpm.create_from_recipes(recipes, args.mp_type, date=args.mp_date, note=args.mp_note, share=args.share_with)
-
-    if args.create_file:
-        menu.generate_menu_file()
-
-    if menu.tandoor.progress:
-        menu.tandoor.progress.last_step()
-        menu.tandoor.progress.close()
+    MenuSession(args).run()
@@ -0,0 +1,204 @@
+import argparse
+import json
+import random
+import re
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+from urllib.parse import urlsplit
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# fields kept of the items of a list endpoint, a nested spec projects the field's own items;
+# single objects such as recipe details are never projected
+RECIPE = {
+    'id': None, 'name': None, 'description': None, 'new': None, 'servings': None, 'keywords': {'id': None, 'name': None},
+    'last_cooked': None, 'created_at': None, 'updated_at': None, 'rating': None
+}
+PROJECTIONS = {
+    'recipe': RECIPE,
+    'keyword': {'id': None, 'name': None, 'parent': None},
+    'food': {
+        'id': None, 'name': None, 'shopping': None, 'recipe': None, 'food_onhand': None, 'ignore_shopping': None, 'parent': None,
+        'substitute': None, 'substitute_onhand': None, 'substitute_siblings': None, 'substitute_children': None
+    },
+    'recipe-book-entry': {'id': None, 'book': None, 'recipe': None, 'recipe_content': RECIPE},
+    'meal-plan': {
+        'id': None, 'title': None, 'recipe': RECIPE, 'servings': None, 'note': None, 'shared': None,
+        'from_date': None, 'to_date': None, 'meal_type': None
+    },
+    'cook-log': {'id': None, 'recipe': None, 'created_at': None},
+}
+WHITESPACE = re.compile(r'[ \t\n\r]*')
+decoder = json.JSONDecoder()
+
+
+def projection(url):
+    '''
+    Returns:
+        the fields kept of the items returned by url, None when the response is decoded as is
+    '''
+    if match := re.search(r'/api/([a-z-]+)/(\d*)', urlsplit(url).path):
+        return None if match.group(2) else PROJECTIONS.get(match.group(1), None)
+    return None
+
+
+def project(value, spec):
+    if isinstance(value, list):
+        return [project(v, spec) for v in value]
+    if not isinstance(value, dict):
+        return value
+    return {k: value[k] if s is None else project(value[k], s) for k, s in spec.items() if k in value}
+
+
+def decode(content, url):
+    '''
+    decodes a response body, keeping only the fields the models read of every item of a list or page
+    content: (bytes) response body
+    url: request url, selects the fields to keep
+
+    Returns:
+        the decoded response
+    '''
+    if (spec := projection(url)) is None:
+        return orjson.loads(content) if orjson else json.loads(content)
+    if orjson:
+        # a single pass in C is faster than decoding item by item, the full page is dropped right away
+        data = orjson.loads(content)
+        if isinstance(data, dict) and isinstance(data.get('results', None), list):
+            data['results'] = project(data['results'], spec)
+            return data
+        return project(data, spec) if isinstance(data, list) else data
+    return __stream__(content.decode('utf-8') if isinstance(content, bytes) else content, spec)
+
+
+def __skip__(text, i):
+    return WHITESPACE.match(text, i).end()
+
+
+def __stream__(text, spec):
+    # decodes a list, or a page's results, one item at a time so that only one full item exists at once
+    i = __skip__(text, 0)
+    if text.startswith('[', i):
+        return __array__(text, i, spec)[0]
+    if not text.startswith('{', i):
+        return decoder.decode(text)
+    page = {}
+    i = __skip__(text, i + 1)
+    if text.startswith('}', i):
+        return page
+    while True:
+        key, i = decoder.raw_decode(text, i)
+        i = __skip__(text, __skip__(text, i) + 1)
+        if key == 'results' and text.startswith('[', i):
+            page[key], i = __array__(text, i, spec)
+        else:
+            page[key], i = decoder.raw_decode(text, i)
+        i = __skip__(text, i)
+        if text.startswith('}', i):
+            return page
+        i = __skip__(text, i + 1)
+
+
+def __array__(text, i, spec):
+    items = []
+    i = __skip__(text, i + 1)
+    if text.startswith(']', i):
+        return items, i + 1
+    while True:
+        item, i = decoder.raw_decode(text, i)
+        items.append(project(item, spec))
+        i = __skip__(text, i)
+        if text.startswith(']', i):
+            return items, i + 1
+        i = __skip__(text, i + 1)
+
+
+def benchmark(num_recipes=20000, page_size=100, repeat=3):
+    '''
+    compares CPU time and peak memory of fetching a full recipe library page by page, decoded as is
+    and decoded with projection, with the standard library and with orjson when installed
+    '''
+    def _recipe(i):
+        text = 'Lorem ipsum dolor sit amet, consectetur adipiscing elit. '
+        return {
+            'id': i,
+            'name': f'Recipe {i}',
+            'description': text * random.randint(0, 4),
+            'image': f'https://tandoor.example/media/recipes/{i}.png',
+            'keywords': [{'id': k, 'label': f'keyword {k}', 'name': f'keyword {k}', 'description': ''} for k in random.sample(range(500), 5)],
+            'steps': [{'id': s, 'instruction': text * 3, 'ingredients': [
+                {'id': n, 'food': {'id': n, 'name': f'food {n}', 'food_onhand': False}, 'unit': {'id': 1, 'name': 'g'}, 'amount': 10, 'note': ''}
+                for n in random.sample(range(2000), 6)
+            ]} for s in range(3)],
+            'nutrition': {'calories': 100, 'carbohydrates': 10, 'fats': 5, 'proteins': 5, 'source': text},
+            'working_time': random.randint(0, 60),
+            'waiting_time': random.randint(0, 60),
+            'created_by': 1,
+            'created_at': (datetime.now() - timedelta(days=random.randint(0, 2000))).isoformat(),
+            'updated_at': datetime.now().isoformat(),
+            'servings': random.randint(1, 4),
+            'rating': random.choice([None, 1, 2, 3, 4, 5]),
+            'last_cooked': random.choice([None, datetime.now().isoformat()]),
+            'new': False,
+        }
+
+    url = 'https://tandoor.example/api/recipe/'
+    pages = []
+    for start in range(0, num_recipes, page_size):
+        results = [_recipe(i) for i in range(start, min(start + page_size, num_recipes))]
+        pages.append(json.dumps({'count': num_recipes, 'next': None, 'previous': None, 'results': results}).encode('utf-8'))
+    del results
+
+    global orjson
+    installed = orjson
+    methods = {
+        'json': lambda page: json.loads(page),
+        'json projected': lambda page: decode(page, url),
+    }
+    if installed:
+        methods['orjson'] = lambda page: installed.loads(page)
+        methods['orjson projected'] = lambda page: decode(page, url)
+
+    results = {}
+    for name, method in methods.items():
+        orjson = installed if name.startswith('orjson') else None
+
+        def _fetch():
+            recipes = []
+            for page in pages:
+                recipes += method(page)['results']
+            return recipes
+
+        timings = []
+        for _ in range(repeat):
+            start = time.process_time()
+            _fetch()
+            timings.append(time.process_time() - start)
+        tracemalloc.start()
+        recipes = _fetch()
+        kept, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        del recipes
+        results[name] = (min(timings), peak, kept)
+    orjson = installed
+
+    print(f'{num_recipes} recipes in {len(pages)} pages, {sum(len(p) for p in pages) / 1024 / 1024:.2f} MiB of JSON')
+    for name, (seconds, peak, kept) in results.items():
+        print(f'{name:>16}: {seconds * 1000:8.1f} ms CPU, {peak / 1024 / 1024:8.2f} MiB peak, {kept / 1024 / 1024:8.2f} MiB kept')
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Decode Tandoor API responses.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    bench = subparsers.add_parser('benchmark', help='Compare CPU time and memory of decoding a full library with and without projection.')
+    bench.add_argument('--recipes', type=int, default=20000, help='Number of recipes in the generated library.')
+    bench.add_argument('--page_size', type=int, default=100, help='Recipes per page.')
+    args = parser.parse_args()
+
+    if args.command == 'benchmark':
+        benchmark(args.recipes, args.page_size)
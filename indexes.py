@@ -0,0 +1,344 @@
+import random
+from bisect import bisect_left, bisect_right
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+from cache import caches, caches_lock
+
+
+class IngredientIndex:
+    """
+    Local food -> recipe index built from recipe details and kept in the cache store.
+    Recipes are only re-read from the server when they have been updated since they were indexed.
+    """
+    key = 'index:ingredients'
+
+    def __init__(self, api, logger, include_children=True):
+        self.api = api
+        self.logger = logger
+        self.include_children = include_children
+        self.synced = False
+        with caches_lock:
+            self.recipes = dict(caches.get(self.key, {}).get('data', {}))
+        self.foods = self.__food_map__()
+
+    def __food_map__(self):
+        foods = {}
+        for recipe_id, entry in self.recipes.items():
+            for f in entry['foods']:
+                foods.setdefault(f, set()).add(int(recipe_id))
+        return foods
+
+    def update(self, recipes):
+        '''
+        indexes any recipe that is new or updated since it was last indexed
+        recipes: list of Recipes
+
+        Returns:
+            number of recipes (re)indexed
+        '''
+        if self.synced:
+            return 0
+        stale = [r for r in recipes if (e := self.recipes.get(str(r.id))) is None or self.__indexed__(e) != self.__updated__(r)]
+        if stale and self.api.offline:
+            self.logger.warning(f'Running offline, {len(stale)} recipes missing from the ingredient index are ignored.')
+            stale = []
+        self.logger.debug(f'Indexing ingredients of {len(stale)} of {len(recipes)} recipes.')
+        for r in stale:
+            # details are only needed for the index, don't keep a second copy in the cache
+            self.add(r.id, self.__updated__(r), self.api.get_recipe_details(r.id, ttl=False))
+        if stale:
+            self.foods = self.__food_map__()
+            self.save()
+        self.synced = True
+        return len(stale)
+
+    def add(self, recipe_id, updated, details):
+        foods = {i['food']['id'] for s in details.get('steps', []) for i in s.get('ingredients', []) if i.get('food')}
+        self.recipes[str(recipe_id)] = {'updated': updated, 'foods': sorted(foods)}
+
+    def save(self):
+        # keep what other processes indexed meanwhile, entries of this process are at least as recent
+        with caches_lock, caches.transaction():
+            self.recipes = {**caches.get(self.key, {}).get('data', {}), **self.recipes}
+            caches[self.key] = {'data': self.recipes, 'expired': datetime.max}
+
+    def food_tree(self, foods):
+        '''
+        foods: list of Foods
+
+        Returns:
+            set of food IDs including descendants when include_children is enabled
+        '''
+        food_ids = {f.id for f in foods}
+        if self.include_children:
+            for f in foods:
+                food_ids |= {x['id'] for x in self.api.get_food_tree(f.id, params={})}
+        return food_ids
+
+    def foods_of(self, recipe_id):
+        '''
+        Returns:
+            list of IDs of the foods in a recipe, None when the recipe isn't indexed
+        '''
+        if (entry := self.recipes.get(str(recipe_id), None)) is None:
+            return None
+        return entry['foods']
+
+    def recipes_with_foods(self, foods):
+        '''
+        foods: list of Foods
+
+        Returns:
+            set of IDs of recipes that contain any of the foods or their descendants
+        '''
+        recipe_ids = set()
+        for f in self.food_tree(foods):
+            recipe_ids |= self.foods.get(f, set())
+        return recipe_ids
+
+    @staticmethod
+    def __updated__(recipe):
+        # the same moment compares equal whatever its time zone, columnar recipes are read back in UTC
+        return recipe.updatedon and recipe.updatedon.timestamp()
+
+    @staticmethod
+    def __indexed__(entry):
+        # entries indexed before timestamps were used hold an ISO date
+        if isinstance(updated := entry['updated'], str):
+            return datetime.fromisoformat(updated).timestamp()
+        return updated
+
+
+class BookIndex:
+    """
+    Local book -> recipe ID index kept in the cache store.  Only the IDs of a book's entries and of
+    its filter's results are stored; a book is read again once it is older than max_age.
+    """
+    key = 'index:books'
+
+    def __init__(self, api, logger, max_age=timedelta(minutes=240)):
+        self.api = api
+        self.logger = logger
+        self.max_age = max_age
+        with caches_lock:
+            self.books = dict(caches.get(self.key, {}).get('data', {}))
+
+    def sync(self, books):
+        '''
+        reads the entries of every book that isn't indexed or is out of date, books concurrently
+        books: list of Books
+
+        Returns:
+            number of books (re)read
+        '''
+        oldest = (datetime.now() - self.max_age).timestamp()
+        stale = {b.id: b for b in books if (e := self.books.get(str(b.id))) is None or e['synced'] < oldest or e['filter'] != b.filter}
+        if stale and self.api.offline:
+            self.logger.warning(f'Running offline, {len(stale)} books missing from the book index are ignored.')
+            stale = {}
+        if not stale:
+            return 0
+        self.logger.debug(f'Indexing {len(stale)} of {len(books)} books.')
+        with ThreadPoolExecutor(max_workers=self.api.max_concurrency) as pool:
+            for book, entries in zip(stale.values(), pool.map(self.__members__, stale.values())):
+                self.books[str(book.id)] = entries
+        self.save()
+        return len(stale)
+
+    def __members__(self, book):
+        entries = {e['recipe'] if isinstance(e['recipe'], int) else e['recipe']['id'] for e in self.api.get_book_entries(book.id)}
+        filtered = {r['id'] for r in self.api.get_recipes(filters=book.filter)} if book.filter else set()
+        return {'entries': sorted(entries), 'filter': book.filter, 'filtered': sorted(filtered), 'synced': datetime.now().timestamp()}
+
+    def save(self):
+        # keep books other processes indexed meanwhile
+        with caches_lock, caches.transaction():
+            self.books = {**caches.get(self.key, {}).get('data', {}), **self.books}
+            caches[self.key] = {'data': self.books, 'expired': datetime.max}
+
+    def recipes_of(self, book):
+        '''
+        Returns:
+            set of IDs of the recipes in a book or in the results of its filter, empty when the book isn't indexed
+        '''
+        entry = self.books.get(str(book.id), {})
+        return set(entry.get('entries', [])) | set(entry.get('filtered', []))
+
+    def recipes_in(self, books, exclude=[]):
+        '''
+        books: list of Books, exclude: list of Books
+
+        Returns:
+            set of IDs of the recipes in any of books and in none of exclude
+        '''
+        recipe_ids = set().union(*[self.recipes_of(b) for b in books])
+        return recipe_ids.difference(*[self.recipes_of(b) for b in exclude])
+
+
+class HistoryIndex:
+    """
+    Local, time sorted index of cook logs and meal plans kept in the cache store and synced incrementally,
+    answers recency questions with a binary search instead of a server search.
+    """
+    key = 'index:history'
+    # meal plans of the last days are read again on every sync, they may still be moved or deleted
+    replan_days = 14
+    # how far back the first sync reads meal plans
+    history_days = 365
+
+    def __init__(self, api, logger):
+        self.api = api
+        self.logger = logger
+        self.synced = False
+        with caches_lock:
+            data = caches.get(self.key, {}).get('data', {})
+        # [timestamp, recipe id, cook log id] and [timestamp, recipe id, meal plan id, meal type id], oldest first
+        self.cooked = data.get('cooked', [])
+        self.planned = data.get('planned', [])
+        self.planned_until = data.get('planned_until', None)
+        self.__by_recipe__()
+
+    def __by_recipe__(self):
+        self.cooked_at = {}
+        for ts, recipe_id, _ in self.cooked:
+            self.cooked_at.setdefault(recipe_id, []).append(ts)
+
+    def sync(self):
+        '''
+        adds cook logs since the newest one indexed and re-reads recent meal plans
+
+        Returns:
+            number of new cook logs
+        '''
+        if self.synced:
+            return 0
+        if self.api.offline:
+            self.logger.warning('Running offline, the cooking history is not synced.')
+            self.synced = True
+            return 0
+
+        known = {c[2] for c in self.cooked}
+        since = datetime.fromtimestamp(self.cooked[-1][0]).astimezone() if self.cooked else None
+        new = [c for c in self.api.get_cook_log(since=since) if c['id'] not in known and c.get('recipe', None)]
+        self.cooked = sorted(self.cooked + [[self.__timestamp__(c['created_at']), self.__id__(c['recipe']), c['id']] for c in new])
+
+        today = datetime.now().astimezone().replace(hour=0, minute=0, second=0, microsecond=0)
+        start = today - timedelta(days=self.history_days)
+        if self.planned_until:
+            start = max(start, datetime.fromtimestamp(self.planned_until).astimezone() - timedelta(days=self.replan_days))
+        plans = self.api.get_meal_plan_range(start, today + timedelta(days=self.replan_days), ttl=False)
+        kept = [p for p in self.planned if p[0] < start.timestamp()]
+        self.planned = sorted(kept + [
+            [self.__timestamp__(p['from_date']), self.__id__(p['recipe']), p['id'], self.__id__(p['meal_type'])]
+            for p in plans if p.get('recipe', None)
+        ])
+        self.planned_until = today.timestamp()
+
+        self.__by_recipe__()
+        self.save()
+        self.synced = True
+        self.logger.debug(f'Cooking history has {len(self.cooked)} cook logs ({len(new)} new) and {len(self.planned)} meal plans.')
+        return len(new)
+
+    def save(self):
+        with caches_lock, caches.transaction():
+            caches[self.key] = {'data': {'cooked': self.cooked, 'planned': self.planned, 'planned_until': self.planned_until}, 'expired': datetime.max}
+
+    @staticmethod
+    def __timestamp__(value):
+        date = datetime.fromisoformat(value)
+        return (date if date.tzinfo else date.astimezone()).timestamp()
+
+    @staticmethod
+    def __id__(value):
+        return value['id'] if isinstance(value, dict) else value
+
+    def cooked_since(self, since):
+        '''
+        Returns:
+            set of recipe IDs cooked since the datetime since
+        '''
+        return {c[1] for c in self.cooked[bisect_left(self.cooked, [since.timestamp()]):]}
+
+    def times_cooked(self, recipe_id, since):
+        '''
+        Returns:
+            number of times recipe_id was cooked since the datetime since
+        '''
+        times = self.cooked_at.get(recipe_id, [])
+        return len(times) - bisect_left(times, since.timestamp())
+
+    def planned_between(self, since, until=None, meal_type=None):
+        '''
+        Returns:
+            set of recipe IDs in a meal plan from since up to until, optionally of a single meal type
+        '''
+        start = bisect_left(self.planned, [since.timestamp()])
+        end = bisect_right(self.planned, [until.timestamp(), float('inf')]) if until else len(self.planned)
+        return {p[1] for p in self.planned[start:end] if meal_type is None or p[3] == meal_type}
+
+
+class Pantry:
+    """
+    Snapshot of all foods with their on hand flag and substitute settings, fetched once per run
+    so that on hand substitutes resolve locally.
+    """
+    def __init__(self, api, logger, seed=None):
+        self.logger = logger
+        self.foods = {f['id']: f for f in api.get_foods()}
+        self.children = {}
+        for f in self.foods.values():
+            if parent := self.__parent__(f):
+                self.children.setdefault(parent, []).append(f['id'])
+        # seeded so that substitutes, and with them menus, are reproducible
+        self.random = random.Random(seed)
+        self.logger.debug(f'Loaded pantry of {len(self.foods)} foods, {sum(f["food_onhand"] for f in self.foods.values())} on hand.')
+
+    def onhand(self, food_id):
+        return bool((f := self.foods.get(food_id, None)) and f['food_onhand'])
+
+    def descendants(self, food_id):
+        found = []
+        for child in self.children.get(food_id, []):
+            found += [child] + self.descendants(child)
+        return found
+
+    def substitutes(self, food_id):
+        '''
+        mirrors the substitutes api: explicit substitutes plus siblings and children when enabled
+
+        Returns:
+            list of IDs of on hand substitutes of the food
+        '''
+        if (food := self.foods.get(food_id, None)) is None:
+            return []
+        candidates = [s['id'] for s in food.get('substitute', None) or []]
+        if food.get('substitute_siblings', False) and (parent := self.__parent__(food)):
+            candidates += self.children.get(parent, [])
+        if food.get('substitute_children', False):
+            candidates += self.descendants(food_id)
+        return sorted({c for c in candidates if c != food_id and self.onhand(c)})
+
+    def substitute(self, food):
+        '''
+        food: food json of an ingredient
+
+        Returns:
+            the food json, or a random on hand substitute when the food isn't on hand
+        '''
+        if food['food_onhand'] or not (substitutes := self.substitutes(food['id'])):
+            return food
+        return self.foods[self.random.choice(substitutes)]
+
+    def can_cook(self, food_ids):
+        '''
+        Returns:
+            True when every food is on hand or has an on hand substitute
+        '''
+        return food_ids is not None and all(self.onhand(f) or self.substitutes(f) for f in food_ids)
+
+    @staticmethod
+    def __parent__(food):
+        parent = food.get('parent', None)
+        return parent['id'] if isinstance(parent, dict) else parent
@@ -1,26 +1,138 @@
+from concurrent.futures import ThreadPoolExecutor
+
+
 class MealPlanManager:
-    def __init__(self, api, logger):
+    def __init__(self, api, logger, history=None):
         self.api = api
         self.logger = logger
+        # a HistoryIndex answers which recipes were cooked without searching the server
+        self.history = history
 
     def create_from_recipes(self, recipes, mp_type, date, note=None, share=[]):
-        for r in recipes:
-            self.create(r, mp_type, date, note, share)
+        return [self.create(r, mp_type, date, note, share) for r in recipes]
+
+    def replace_recipes(self, plans, replaced, mp_type, date, note=None, share=[]):
+        '''
+        plans: {recipe id: meal plan id} of the last selection
+        replaced: {recipe id: new recipe}
+        changes the recipe of the affected meal plans in place, leaving every other plan alone;
+        a replaced recipe without a meal plan gets a new one
+
+        Returns:
+            {recipe id: meal plan id} of the new selection
+        '''
+        plans = dict(plans)
+        self.logger.info(f'Updating {len(replaced)} meal plans.')
+        for old, recipe in replaced.items():
+            if (plan_id := plans.pop(old, None)) is not None:
+                self.api.update_meal_plan(plan_id, recipe=recipe, title=recipe.name, servings=recipe.servings)
+            else:
+                plan_id = self.create(recipe, mp_type, date, note, share)['id']
+            plans[recipe.id] = plan_id
+        return plans
+
+    def create_many(self, plans, max_workers=1):
+        '''
+        plans: list of dicts with the arguments of create: recipe, type, date, note and share
+        writes the meal plans concurrently, the api keeps the requests within its limits
+        '''
+        self.logger.info(f'Creating {len(plans)} meal plans.')
+        with ThreadPoolExecutor(max_workers=max(1, max_workers)) as pool:
+            for f in [pool.submit(self.create, **p) for p in plans]:
+                f.result()
 
     def cleanup_uncooked(self, date, mp_type):
         # get all plans of meal type
         plans = [mp for mp in self.api.get_meal_plans(date, ttl=False) if mp['meal_type']['id'] == mp_type]
         # get all recipes cooked since cleanup date
-        cooked_recipes = self.api.get_recipes(params={'cookedon': date.strftime('%Y-%m-%d')}, cache=False)
+        cooked_recipes = self.__cooked_since__(date)
         # for each plan containing a recipe not cooked since cleanup date - delete the plan
-        plans_to_delete = [p for p in plans if p['recipe']['id'] not in [y['id'] for y in cooked_recipes]]
+        plans_to_delete = [p for p in plans if p['recipe']['id'] not in cooked_recipes]
         self.logger.info(f'Deleting {len(plans_to_delete)} meal plans that were not cooked.')
         for plan in plans_to_delete:
             self.api.delete_meal_plan(plan['id'])
 
+    def __cooked_since__(self, date):
+        if self.history:
+            self.history.sync()
+            return self.history.cooked_since(date)
+        return {y['id'] for y in self.api.get_recipes(params={'cookedon': date.strftime('%Y-%m-%d')}, cache=False)}
+
+    def reconcile(self, recipes, mp_type, date, note=None, share=[], cleanup_date=None, max_workers=1):
+        '''
+        brings the meal plans of a meal type in line with recipes with as few writes as possible: plans that
+        already match a recipe are kept, uncooked plans since cleanup_date are changed to the other recipes
+        and deleted when left over, and only what is still missing is created
+        cleanup_date: None to leave existing plans alone, only keeping those that match
+
+        Returns:
+            {recipe id: meal plan id}
+        '''
+        start = min(date, cleanup_date) if cleanup_date else date
+        existing = self.api.get_meal_plans(start, ttl=False) if cleanup_date else self.api.get_meal_plan_range(date, date, ttl=False)
+        # plans without a recipe, such as notes, are the user's own and left alone
+        existing = [p for p in existing if self.__id__(p['meal_type']) == mp_type and p.get('recipe', None)]
+
+        matching = {}
+        for p in existing:
+            matching.setdefault(self.__plan_key__(p), []).append(p)
+        plans, unmatched, kept = {}, [], set()
+        for r in recipes:
+            if found := matching.get(self.__recipe_key__(r, date, note, share), None):
+                plan = found.pop()
+                plans[r.id] = plan['id']
+                kept.add(plan['id'])
+            else:
+                unmatched.append(r)
+
+        reusable = []
+        if cleanup_date:
+            cooked = self.__cooked_since__(cleanup_date)
+            reusable = [p for p in existing if p['id'] not in kept and self.__id__(p['recipe']) not in cooked]
+        updates = list(zip(unmatched, reusable))
+        creates, deletes = unmatched[len(updates):], reusable[len(updates):]
+        self.logger.info(
+            f'Reconciling meal plans: {len(plans)} unchanged, {len(updates)} updated, {len(creates)} created and {len(deletes)} deleted.'
+        )
+
+        with ThreadPoolExecutor(max_workers=max(1, max_workers)) as pool:
+            written = [(r, pool.submit(self.update, p['id'], r, date, note, share)) for r, p in updates]
+            written += [(r, pool.submit(self.create, r, mp_type, date, note, share)) for r in creates]
+            deleted = [pool.submit(self.api.delete_meal_plan, p['id']) for p in deletes]
+            for r, f in written:
+                plans[r.id] = f.result()['id']
+            for f in deleted:
+                f.result()
+        return plans
+
+    @staticmethod
+    def __id__(value):
+        return value['id'] if isinstance(value, dict) else value
+
+    def __plan_key__(self, plan):
+        # dates may come with a time, servings as a decimal string
+        shared = tuple(sorted(int(self.__id__(u)) for u in plan.get('shared', None) or []))
+        return (self.__id__(plan['recipe']), plan['from_date'][:10], float(plan['servings'] or 0), plan.get('note', None) or '', shared)
+
+    @staticmethod
+    def __recipe_key__(recipe, date, note, share):
+        return (recipe.id, date.strftime('%Y-%m-%d'), float(recipe.servings or 0), note or '', tuple(sorted(int(x) for x in share)))
+
+    def update(self, plan_id, recipe, date, note, share):
+        self.logger.debug(f'Attempting to change mealplan {plan_id} to recipe {recipe.name} on {date.strftime("%Y-%m-%d")}')
+        return self.api.update_meal_plan(
+            plan_id,
+            title=recipe.name,
+            recipe=recipe,
+            servings=recipe.servings,
+            note=note,
+            date=date,
+            shared=[{'id': x} for x in share]
+        )
+
     def create(self, recipe, type, date, note, share):
         self.logger.debug(f'Attempting to create mealplan of type {type} for recipe {recipe.name} on {date.strftime("%Y-%m-%d")}')
-        self.api.create_meal_plan(
+        return self.api.create_meal_plan(
             title=recipe.name,
             recipe=recipe,
             servings=recipe.servings,
@@ -1,66 +1,299 @@
+import atexit
 import json
 import os
+import random
 import re
+import tempfile
+import threading
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
-from shutil import copy2
+from io import BytesIO
 
+from pulp import LpMinimize, LpProblem, LpVariable, lpSum, value
+from pulp.apis import PULP_CBC_CMD
 from reportlab.graphics import renderPDF, renderPM
 from reportlab.pdfbase import pdfmetrics
 from reportlab.pdfbase.ttfonts import TTFont
-from svglib.svglib import svg2rlg
+from svglib.svglib import SvgRenderer, load_svg_file
 
+from cache import caches, caches_lock
 from utils import printable_date
 
+# worker processes are started on the first parallel render and kept for every later one, see render_tasks
+render_pool = None
+render_pool_lock = threading.Lock()
+# font sets registered in this process
+registered_fonts = set()
+
+
+class CompiledTemplate:
+    """
+    Template split once into literal segments around every occurrence of the placeholders,
+    rendering splices all replacements in a single pass.
+    """
+    def __init__(self, segments, slots):
+        self.segments = segments
+        self.slots = slots
+
+    @classmethod
+    def compile(cls, template, placeholders):
+        segments, slots, pos = [], [], 0
+        if placeholders := sorted({p for p in placeholders if p}, key=len, reverse=True):
+            # longest first so a placeholder containing another one wins
+            for match in re.finditer('|'.join(re.escape(p) for p in placeholders), template):
+                segments.append(template[pos:match.start()])
+                slots.append(match.group(0))
+                pos = match.end()
+        segments.append(template[pos:])
+        return cls(segments, slots)
+
+    def render(self, replacements):
+        parts = []
+        for segment, slot in zip(self.segments, self.slots):
+            parts.append(segment)
+            parts.append(replacements.get(slot, slot))
+        parts.append(self.segments[-1])
+        return ''.join(parts)
+
+
+class TextSlot:
+    """
+    Placeholder text of one recipe in the template, its length is the space available.
+    """
+    def __init__(self, name, lines):
+        self.name = name
+        self.lines = lines
+        self.name_capacity = len(name)
+        self.line_capacities = tuple(len(x) for x in lines)
+
+
+class RecipeText:
+    """
+    Name and ingredients of a recipe tokenized once, with token lengths precomputed for layout.
+    """
+    def __init__(self, name, ingredients, seperator):
+        self.name = name
+        self.seperator = seperator
+        self.ingredients = [i.split() for i in ingredients]
+        self.ingredient_lengths = [len(' '.join(i)) for i in self.ingredients]
+        self.layouts = {}
+
+    def layout(self, capacities):
+        """
+        Fills ingredients into lines of the given capacities, trailing ingredients are dropped
+        until the remaining ones fit.
+
+        Returns:
+            tuple of the text of each line and number of characters truncated
+        """
+        if capacities not in self.layouts:
+            for count in range(len(self.ingredients), -1, -1):
+                if (lines := self.__fill__(self.ingredients[:count], capacities)) is not None:
+                    self.layouts[capacities] = (lines, sum(self.ingredient_lengths[count:]))
+                    break
+        return self.layouts[capacities]
+
+    def cost(self, slot):
+        return max(0, len(self.name) - slot.name_capacity) + self.layout(slot.line_capacities)[1]
+
+    def __fill__(self, ingredients, capacities):
+        # tokens are words of the ingredients, None marks a seperator between ingredients
+        tokens = []
+        for i, words in enumerate(ingredients):
+            if i:
+                tokens.append(None)
+            tokens += words
+        seperator_length = len(self.seperator)
+
+        lines = []
+        pos = 0
+        for capacity in capacities:
+            pieces, length = [], 0
+            while pos < len(tokens):
+                if (token := tokens[pos]) is None:
+                    if not pieces:
+                        # a line never starts with a seperator
+                        pos += 1
+                        continue
+                    piece_length = seperator_length
+                else:
+                    # words are joined by a space unless they follow a seperator
+                    space = bool(pieces) and tokens[pos - 1] is not None
+                    piece_length = len(token) + space
+                if length + piece_length > capacity:
+                    break
+                pieces.append(self.seperator if token is None else ' ' * space + token)
+                length += piece_length
+                pos += 1
+            lines.append(''.join(pieces).strip())
+        return lines if pos >= len(tokens) else None
+
+
+def assign_slots(texts, slots):
+    """
+    Assigns recipes to template slots minimizing the characters truncated, as a bipartite matching.
+    Keeps the order of the recipes when it doesn't cost any truncation.
+
+    Returns:
+        list with the RecipeText assigned to each slot, None for an empty slot
+    """
+    costs = {(i, j): t.cost(s) for i, t in enumerate(texts) for j, s in enumerate(slots)}
+    if all(costs[(i, i)] == 0 for i in range(min(len(texts), len(slots)))):
+        return [texts[j] if j < len(texts) else None for j in range(len(slots))]
+
+    problem = LpProblem('SlotAssignment', LpMinimize)
+    x = LpVariable.dicts('Assign', list(costs), cat='Binary')
+    # a tiny penalty for moving a recipe so ties keep the original order
+    problem += lpSum((costs[(i, j)] + (0 if i == j else 0.001)) * x[(i, j)] for i, j in costs)
+    for i in range(len(texts)):
+        problem += lpSum(x[(i, j)] for j in range(len(slots))) <= 1
+    for j in range(len(slots)):
+        problem += lpSum(x[(i, j)] for i in range(len(texts))) <= 1
+    problem += lpSum(x.values()) == min(len(texts), len(slots))
+    problem.solve(PULP_CBC_CMD(msg=False))
+
+    assigned = [None] * len(slots)
+    for (i, j), var in x.items():
+        if value(var) == 1:
+            assigned[j] = texts[i]
+    return assigned
+
+
+def register_fonts(fonts, template_dir):
+    for f in fonts:
+        font = TTFont(f['name'], os.path.join(template_dir, f['file']))
+        pdfmetrics.registerFont(font)
+
+
+def render_drawing(drawing, fmt, dpi=72):
+    if fmt.lower() == 'pdf':
+        return renderPDF.drawToString(drawing)
+    return renderPM.drawToString(drawing, fmt=fmt, dpi=dpi)
+
+
+def register_font_sets(font_sets):
+    for fonts, template_dir in font_sets:
+        if (key := json.dumps([fonts, template_dir], sort_keys=True)) not in registered_fonts:
+            register_fonts(fonts, template_dir)
+            registered_fonts.add(key)
+
+
+def render_task(font_sets, drawing, fmt, dpi):
+    # workers outlive a single menu, fonts of templates they haven't rendered yet are registered first
+    register_font_sets(font_sets)
+    return render_drawing(drawing, fmt, dpi)
+
+
+def get_render_pool():
+    global render_pool
+    with render_pool_lock:
+        if render_pool is None:
+            render_pool = ProcessPoolExecutor(max_workers=os.cpu_count() or 1)
+            atexit.register(render_pool.shutdown)
+    return render_pool
+
+
+def render_tasks(tasks, font_sets, logger):
+    '''
+    tasks: list of (drawing, format, dpi, output file)
+    font_sets: list of (fonts, template dir) the drawings need
+
+    Returns:
+        list of file contents in the order of tasks
+    '''
+    # rasterizing is CPU bound, render in parallel when there is more than one file and more than one CPU
+    if len(tasks) < 2 or (os.cpu_count() or 1) < 2:
+        for _, _, _, output_file in tasks:
+            logger.debug(f'Rendering {output_file}.')
+        return [render_drawing(drawing, fmt, dpi) for drawing, fmt, dpi, _ in tasks]
+
+    logger.debug(f'Rendering {len(tasks)} files in parallel.')
+    pool = get_render_pool()
+    futures = [pool.submit(render_task, font_sets, drawing, fmt, dpi) for drawing, fmt, dpi, _ in tasks]
+    return [f.result() for f in futures]
+
 
 class MenuGenerator:
-    def __init__(self, api, options, logger):
+    def __init__(self, api, options, logger, pantry=None, rng=None):
         self.options = options
         self.api = api
         self.logger = logger
+        self.pantry = pantry
+        self.random = rng or random
         self.template_dir = os.path.join(os.getcwd(), 'templates')
         self.output_dir = options.output_dir or self.template_dir
-        self.input_file = options.file_template
-        self.temp_file = os.path.join(self.output_dir, 'temp.svg')
-        self.output_file = self.input_file.split('.')[0]
-        self.ext = options.file_format
+        self.templates = options.file_template if isinstance(options.file_template, list) else [options.file_template]
+        self.formats = options.file_format if isinstance(options.file_format, list) else [options.file_format]
+        self.dpis = [int(d) for d in getattr(options, 'file_dpi', None) or [72]]
         self.fonts = [json.loads(f.replace("'", '"')) for f in options.fonts]
         self.replace_text = options.replace_text
         self.seperator = options.seperator
 
     def write_menu(self, recipes):
-        template = self.open_template()
+        tasks = self.prepare_menu(recipes)
+        self.save(tasks, self.render(tasks))
+
+    def prepare_menu(self, recipes):
+        '''
+        fills the templates with recipes and archives the resulting SVGs
+
+        Returns:
+            list of (drawing, format, dpi, output file) render tasks
+        '''
         if any('ingredients' in r for r in self.options.replace_text['recipe_text']):
             for r in recipes:
-                r.addDetails(self.api)
-        template = self.find_and_replace(recipes, template)
-        self.write_temp_template(template)
-        self.convert_svg()
-        self.cleanup()
-
-    def convert_svg(self):
-        # Register font files
+                r.addDetails(self.api, pantry=self.pantry, rng=self.random)
+        self.register_fonts()
+
+        # each template is parsed once, every format and resolution is rendered from that drawing
+        tasks = []
+        for template in self.templates:
+            svg = self.find_and_replace(recipes, self.compile_template(template)).encode('utf-8')
+            self.archive(svg, template)
+            drawing = self.convert_svg(svg, template)
+            for fmt in self.formats:
+                for dpi in ([72] if fmt.lower() == 'pdf' else self.dpis):
+                    tasks.append((drawing, fmt, dpi, self.output_path(template, fmt, dpi)))
+        return tasks
+
+    def save(self, tasks, results):
+        for output_file, data in zip([t[3] for t in tasks], results):
+            self.write_file(output_file, data)
+            self.archive(data, output_file)
+
+    def register_fonts(self):
         for f in self.fonts:
             self.logger.debug(f'Loading font {f["name"]} from {os.path.join(self.template_dir, f["file"])}.')
-            font = TTFont(f['name'], os.path.join(self.template_dir, f['file']))
-            pdfmetrics.registerFont(font)
-            self.logger.debug(f'Font {font.fontName} loaded succesfully.')
-
-        # Load the SVG file as a ReportLab graphics object
-        drawing = svg2rlg(self.temp_file)
-
-        temp_output = os.path.join(os.getcwd(), f'temp.{self.ext}')
-        if self.ext.lower() == 'pdf':
-            output_file = os.path.join(self.output_dir, f'{self.output_file}.{self.ext}')
-            self.logger.debug(f'Writing PDF to {output_file}.')
-            renderPDF.drawToFile(drawing, temp_output)
-        else:
-            output_file = os.path.join(self.output_dir, f'{self.output_file}.{self.ext}')
-            self.logger.debug(f'Writing {self.ext} to {output_file}.')
-            renderPM.drawToFile(drawing, temp_output, fmt=self.ext)
-        self.logger.debug(f'Moving file {temp_output} to {output_file}.')
-        os.rename(temp_output, output_file)
-        os.chmod(output_file, 0o755)
-        self.archive(output_file)
+        register_fonts(self.fonts, self.template_dir)
+
+    def convert_svg(self, svg, template):
+        # Load the SVG as a ReportLab graphics object, references are resolved relative to the template
+        svg_root = load_svg_file(BytesIO(svg))
+        if svg_root is None:
+            raise RuntimeError(f'Unable to parse template {template} after replacing text.')
+        return SvgRenderer(os.path.join(self.template_dir, template)).render(svg_root)
+
+    def render(self, tasks):
+        return render_tasks(tasks, [(self.fonts, self.template_dir)], self.logger)
+
+    def output_path(self, template, fmt, dpi):
+        name = os.path.splitext(template)[0]
+        if len(self.dpis) > 1 and fmt.lower() != 'pdf':
+            name = f'{name}-{dpi}dpi'
+        return os.path.join(self.output_dir, f'{name}.{fmt}')
+
+    def write_file(self, output_file, data):
+        # write next to the target and swap it in, readers never see a partial file
+        self.logger.debug(f'Writing {output_file}.')
+        fd, temp_output = tempfile.mkstemp(dir=os.path.dirname(output_file), prefix=f'.{os.path.basename(output_file)}.')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.chmod(temp_output, 0o755)
+            os.replace(temp_output, output_file)
+        except BaseException:
+            os.remove(temp_output)
+            raise
 
     def find_and_replace(self, recipes, template):
         def _escape_svg_text(text):
@@ -72,128 +305,88 @@ class MenuGenerator:
                 "'": '&apos;'
             }
             return re.sub(r'[\&\<\>\"\']', lambda match: escapes[match.group(0)], text)
+        replacements = {}
         if date_text := self.replace_text.get('date_text', None):
             date, ordinal = printable_date(self.options.mp_date, format=date_text.get('format', None))
 
             # update dates if they exist
             if d := date_text.get('date', None):
-                template = re.sub(re.escape(d), date, template)
+                replacements[d] = date
             if d := date_text.get('ordinal', None):
-                template = re.sub(re.escape(d), ordinal, template)
+                replacements[d] = ordinal
         # create replacement dict
-        replacement_dict = self.prepare_replacement(recipes)
-
-        for k, v in replacement_dict.items():
+        for k, v in self.prepare_replacement(recipes).items():
             self.api.update_progress()
-            template = re.sub(re.escape(k), _escape_svg_text(v), template)
+            replacements[k] = _escape_svg_text(v)
 
-        return template
+        return template.render(replacements)
 
     def prepare_replacement(self, recipes):
-        def _length_replace_ing(x):
-            return len(' '.join(x['ingredients']))
-
-        def _length_recipe_ing(x):
-            return len(self.options.seperator.join(x))
-
-        def _chunk_ingredients(before, after):
-            pairs = []
-            seperator = self.options.seperator.replace(" ", "~|~")
-            after = f' {seperator} '.join(after).split()
-            for x in before:
-                chunk = ''
-                while after and len(x) >= len(chunk + after[0]):
-                    next_chunk = after.pop(0)
-                    if chunk == '':
-                        if next_chunk == seperator:
-                            next_chunk = after.pop(0)
-                        chunk += next_chunk
-                    else:
-                        chunk += (" " + next_chunk.replace('~|~', ' ')).replace("  ", " ")
-
-                if chunk:
-                    pairs.append((x, chunk))
-                else:
-                    pairs.append((x, ''))
-            return pairs
-
-        # create temporary array to assign before/after values
-        temp_text = []
-        for x in range(len(self.options.replace_text['recipe_text'])):
-            before = self.options.replace_text['recipe_text'][x]
-            before['after_name'] = recipes[x].name
-            before['after_ing'] = [x.name for x in recipes[x].ingredients]
-            temp_text.append(before)
-
-        # confirm that all after strings are shorter than before strings.
-        for y in range(len(temp_text)):
-            text_fits = len(temp_text[y]['name']) >= len(temp_text[y]['after_name']) and _length_replace_ing(temp_text[y]) >= _length_recipe_ing(temp_text[y]['after_ing'])
-            if not text_fits:
-                truncate_text = True
-                # if there are no other slots that the name and ingredients fit - just truncate the text
-                if (
-                    any(len(t['name']) >= len(temp_text[y]['after_name']) for t in temp_text) and
-                    any(_length_replace_ing(t) >= _length_recipe_ing(temp_text[y]['after_ing']) for t in temp_text)
-                ):
-                    for z in range(len(temp_text)):
-                        # if swapping the recipes between two positions fits the text then do that
-                        if (
-                            len(temp_text[z]['name']) > len(temp_text[y]['after_name']) and _length_replace_ing(temp_text[z]) >= _length_recipe_ing(temp_text[y]['after_ing']) and
-                            len(temp_text[y]['name']) > len(temp_text[z]['after_name']) and _length_replace_ing(temp_text[y]) >= _length_recipe_ing(temp_text[z]['after_ing'])
-                        ):
-                            tmp_name = temp_text[y]['after_name']
-                            tmp_ing = temp_text[y]['after_ing']
-                            temp_text[y]['after_name'] = temp_text[z]['after_name']
-                            temp_text[y]['after_ing'] = temp_text[z]['after_ing']
-                            temp_text[z]['after_name'] = tmp_name
-                            temp_text[z]['after_ing'] = tmp_ing
-                            truncate_text = False
-                if truncate_text:
-                    temp_text[y]['after_name'] = temp_text[y]['after_name'][:len(temp_text[y]['name'])]
-                    new_ing = []
-                    while temp_text[y]['after_ing'] and _length_replace_ing(temp_text[y]) > _length_recipe_ing(new_ing):
-                        new_ing.append(temp_text[y]['after_ing'].pop(0))
-                    temp_text[y]['after_ing'] = new_ing
+        slots = [
+            TextSlot(t['name'], t.get('ingredients', []))
+            for t in self.options.replace_text['recipe_text']
+        ]
+        texts = [RecipeText(r.name, [i.name for i in r.ingredients], self.options.seperator) for r in recipes]
 
         # create replacement dict in the form of key:value = before:after
         replacements = {}
-        for y in temp_text:
-            replacements[y['name']] = y['after_name']
-            after_chunks = _chunk_ingredients(y['ingredients'], y['after_ing'])
-            for pair in after_chunks:
-                replacements[pair[0]] = pair[1]
+        for slot, text in zip(slots, assign_slots(texts, slots)):
+            if text is None:
+                replacements[slot.name] = ''
+                replacements.update({line: '' for line in slot.lines})
+                continue
+            replacements[slot.name] = text.name[:slot.name_capacity]
+            replacements.update(zip(slot.lines, text.layout(slot.line_capacities)[0]))
         return replacements
 
-    def open_template(self):
-        # Open file and read contents
-        self.logger.debug(f'Opening template from {os.path.join(self.template_dir, self.input_file)}.')
-        with open(os.path.join(self.template_dir, self.input_file)) as f:
-            return f.read()
+    def placeholders(self):
+        placeholders = [v for k, v in (self.replace_text.get('date_text', None) or {}).items() if k in ('date', 'ordinal')]
+        for r in self.replace_text.get('recipe_text', None) or []:
+            placeholders.append(r['name'])
+            placeholders += r.get('ingredients', [])
+        return sorted(set(placeholders))
+
+    def compile_template(self, template):
+        # the parsed template is kept across runs until the template file or the placeholders change
+        path = os.path.join(self.template_dir, template)
+        key = f'template:{path}'
+        mtime = os.path.getmtime(path)
+        placeholders = self.placeholders()
+        with caches_lock:
+            if (c := caches.get(key, {}).get('data', None)) and c['mtime'] == mtime and c['placeholders'] == placeholders:
+                self.logger.debug(f'Using compiled template {path}.')
+                return CompiledTemplate(c['segments'], c['slots'])
 
-    def write_temp_template(self, template):
-        self.logger.debug(f'Writing temporary template to {self.temp_file}.')
-        with open(self.temp_file, 'w') as f:
-            f.write(template)
+        compiled = CompiledTemplate.compile(self.open_template(template), placeholders)
+        with caches_lock:
+            caches[key] = {
+                'data': {'mtime': mtime, 'placeholders': placeholders, 'segments': compiled.segments, 'slots': compiled.slots},
+                'expired': datetime.max
+            }
+            caches.sync()
+        return compiled
 
-    def cleanup(self):
-        self.archive(self.temp_file, target_name=self.input_file)
-        self.logger.debug(f'Removing temporary file {self.temp_file}.')
-        os.remove(self.temp_file)
+    def open_template(self, template):
+        # Open file and read contents
+        self.logger.debug(f'Opening template from {os.path.join(self.template_dir, template)}.')
+        with open(os.path.join(self.template_dir, template)) as f:
+            return f.read()
 
-    def archive(self, file, target_name=None):
-        if not target_name:
-            target_name = file
+    def archive(self, data, target_name):
         if self.logger.loglevel == 10:
             archive_dir = os.path.join(self.template_dir, 'archive')
-            if not os.path.exists(archive_dir):
-                os.makedirs(archive_dir)
+            os.makedirs(archive_dir, exist_ok=True)
             filename, ext = os.path.splitext(os.path.basename(target_name))
             archive_file = (a_file := f"{filename}-{(datetime.now().strftime('%y%m%d'))}")
             count = 1
-            while os.path.exists(os.path.join(archive_dir, f"{archive_file}{ext}")):
-                archive_file = a_file + '_' + str(count)
-                count += 1
-            # os.rename(self.temp_file, os.path.join(archive_dir, "{archive_file}.{ext}"))
-            af = os.path.join(archive_dir, f"{archive_file}{ext}")
-            self.logger.debug(f'Archiving file {file} to {af}.')
-            copy2(file, af)
+            while True:
+                af = os.path.join(archive_dir, f"{archive_file}{ext}")
+                try:
+                    # exclusive create, concurrent runs never overwrite each others archive
+                    with open(af, 'xb') as f:
+                        f.write(data)
+                    break
+                except FileExistsError:
+                    archive_file = a_file + '_' + str(count)
+                    count += 1
+            self.logger.debug(f'Archived {target_name} to {af}.')
@@ -40,6 +40,10 @@ class Recipe(SetEnabledObjects):
         except (ValueError, TypeError):
             self.cookedon = None
         self.createdon = datetime.fromisoformat(json_recipe['created_at'])
+        try:
+            self.updatedon = datetime.fromisoformat(json_recipe['updated_at'])
+        except (KeyError, ValueError, TypeError):
+            self.updatedon = None
         self.rating = json_recipe['rating']
         self.ingredients = []  # List of Ingredient objects5
 
@@ -89,16 +93,51 @@ class Recipe(SetEnabledObjects):
         else:
             return [r for r in recipes if getattr(r, 'rating', 0) >= rating]
 
-    def addDetails(self, api):
+    def addDetails(self, api, pantry=None, rng=random):
         recipe = api.get_recipe_details(self.id)
-        for f in [i['food'] for s in recipe['steps'] for i in s['ingredients']]:
-            if not f['food_onhand']:
+        # a recipe can be rendered more than once, e.g. by a MenuSession
+        self.ingredients = []
+        for f in [i['food'] for s in recipe['steps'] for i in s['ingredients'] if i['food']]:
+            if pantry:
+                f = pantry.substitute(f)
+            elif not f['food_onhand']:
                 onhand_substitutes = api.get_food_substitutes(f['id'], substitute='food')
                 if onhand_substitutes:
-                    f = api.get_food(random.choice(onhand_substitutes)['id'])
+                    f = api.get_food(rng.choice(onhand_substitutes)['id'])
             self.ingredients.append(Food(f))
 
 
+class ColumnarRecipe(Recipe):
+    """
+    Recipe backed by a row of RecipeColumns, fields are read from the columns when first used.
+    """
+    fields = {
+        'name': lambda c, i: c.name(i),
+        'description': lambda c, i: c.description(i),
+        'new': lambda c, i: bool(c.new[i]),
+        'servings': lambda c, i: int(c.servings[i]),
+        'keywords': lambda c, i: c.keywords(i),
+        'cookedon': lambda c, i: c.date(c.cooked[i]),
+        'createdon': lambda c, i: c.date(c.created[i]),
+        'updatedon': lambda c, i: c.date(c.updated[i]),
+        'rating': lambda c, i: None if (x := float(c.ratings[i])) != x else x,
+    }
+
+    def __init__(self, columns, index):
+        self.id = int(columns.ids[index])
+        self.columns = columns
+        self.index = index
+        self.ingredients = []
+
+    def __getattr__(self, name):
+        # only called for fields that haven't been read yet
+        if name not in ColumnarRecipe.fields or 'columns' not in self.__dict__:
+            raise AttributeError(name)
+        value = ColumnarRecipe.fields[name](self.columns, self.index)
+        setattr(self, name, value)
+        return value
+
+
 class Keyword(SetEnabledObjects):
     def __init__(self, json_kw):
         self.id = json_kw['id']
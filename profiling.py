@@ -0,0 +1,121 @@
+import atexit
+import cProfile
+import os
+import pstats
+import re
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager, nullcontext
+
+# seconds between samples of the sampling profiler
+SAMPLE_INTERVAL = 0.005
+# a phase that isn't profiled, shared so that profiling costs nothing when it is off
+NOT_PROFILED = nullcontext()
+
+
+class Profiler:
+    """
+    Profiles the phases of a run: every phase is profiled with cProfile and saved as
+    <directory>/<nn>-<phase>.pstats, and all threads are sampled into <directory>/stacks.collapsed,
+    one line per stack as read by flame graph tools (flamegraph.pl, speedscope), rooted at the phase.
+    Without a directory phases are not profiled at all.
+    """
+    def __init__(self, directory=None, logger=None, interval=SAMPLE_INTERVAL):
+        self.directory = directory
+        self.logger = logger
+        self.interval = interval
+        self.profiles = {}
+        self.local = threading.local()
+        # open phases of every thread by thread id, outermost first; replaced rather than changed, under lock
+        self.current = {}
+        self.lock = threading.Lock()
+        self.stacks = Counter()
+        self.sampler = None
+        self.stopped = threading.Event()
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+            self.sampler = threading.Thread(target=self.__sample__, name='profiler', daemon=True)
+            self.sampler.start()
+            atexit.register(self.close)
+
+    def phase(self, name):
+        '''
+        Returns:
+            context manager that profiles what runs inside it as phase name
+        '''
+        if not self.directory:
+            return NOT_PROFILED
+        return self.__phase__(name)
+
+    @contextmanager
+    def __phase__(self, name):
+        ident = threading.get_ident()
+        with self.lock:
+            outer = self.current.get(ident, ())
+            self.current[ident] = outer + (name,)
+        # one cProfile per thread at a time, a phase inside another is profiled as part of the outer one;
+        # threads in the same phase each get their own, they are added up when saved
+        profile = None
+        if not getattr(self.local, 'active', False):
+            profile = cProfile.Profile()
+            with self.lock:
+                self.profiles.setdefault(name, []).append(profile)
+            self.local.active = True
+            profile.enable()
+        try:
+            yield
+        finally:
+            if profile:
+                profile.disable()
+                self.local.active = False
+            with self.lock:
+                if outer:
+                    self.current[ident] = outer
+                else:
+                    del self.current[ident]
+
+    def __sample__(self):
+        me, main = threading.get_ident(), threading.main_thread().ident
+        while not self.stopped.wait(self.interval):
+            with self.lock:
+                current = dict(self.current)
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                # threads without phases of their own, such as the api's workers, work for the main thread
+                phase = ';'.join(current.get(ident, None) or current.get(main, ())) or 'other'
+                stack = []
+                while frame:
+                    code = frame.f_code
+                    stack.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})')
+                    frame = frame.f_back
+                self.stacks[';'.join([phase] + stack[::-1])] += 1
+
+    def close(self):
+        '''
+        stops sampling and writes the profiles
+
+        Returns:
+            list of (phase, seconds) in the order the phases first ran
+        '''
+        if not self.directory or self.stopped.is_set():
+            return []
+        self.stopped.set()
+        self.sampler.join()
+        start = time.monotonic()
+        phases = []
+        for i, (name, profiles) in enumerate(self.profiles.items()):
+            path = os.path.join(self.directory, f'{i:02d}-{re.sub(r"[^A-Za-z0-9]+", "_", name).strip("_")}.pstats')
+            stats = pstats.Stats(*profiles)
+            stats.dump_stats(path)
+            phases.append((name, stats.total_tt))
+        with open(os.path.join(self.directory, 'stacks.collapsed'), 'w', encoding='utf-8') as f:
+            for stack, count in self.stacks.items():
+                f.write(f'{stack} {count}\n')
+        if self.logger:
+            for name, seconds in phases:
+                self.logger.info(f'Profiled {name}: {seconds:.3f} s.')
+            self.logger.info(f'Saved {len(phases)} profiles and {sum(self.stacks.values())} samples to {self.directory} in {time.monotonic() - start:.2f} s.')
+        return phases
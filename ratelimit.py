@@ -0,0 +1,90 @@
+import threading
+import time
+from email.utils import parsedate_to_datetime
+
+
+class RateLimiter:
+    """
+    Token bucket limiting requests per second, with a cap on concurrent requests that adapts to
+    observed latency: it grows while responses stay fast and halves when they slow down or the
+    server asks to back off.
+    """
+    def __init__(self, rate=0, max_concurrency=1, burst=None):
+        self.rate = float(rate or 0)
+        self.burst = burst or max(1, self.rate)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.max_concurrency = max(1, int(max_concurrency))
+        self.concurrency = self.max_concurrency
+        self.active = 0
+        self.paused_until = 0
+        # exponentially weighted latency and the fastest it has been, the baseline to compare against
+        self.latency = None
+        self.baseline = None
+        self.successes = 0
+        self.condition = threading.Condition()
+
+    def acquire(self):
+        with self.condition:
+            while True:
+                now = time.monotonic()
+                if self.rate:
+                    self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                    self.updated = now
+                if now < self.paused_until:
+                    wait = self.paused_until - now
+                elif self.active >= self.concurrency:
+                    wait = None
+                elif self.rate and self.tokens < 1:
+                    wait = (1 - self.tokens) / self.rate
+                else:
+                    self.tokens -= 1 if self.rate else 0
+                    self.active += 1
+                    return
+                self.condition.wait(wait)
+
+    def release(self, latency=None, throttled=False):
+        with self.condition:
+            self.active -= 1
+            if throttled:
+                self.__decrease__()
+            elif latency is not None:
+                self.latency = latency if self.latency is None else 0.8 * self.latency + 0.2 * latency
+                self.baseline = self.latency if self.baseline is None else min(self.baseline, self.latency)
+                if self.latency > 2 * self.baseline:
+                    self.__decrease__()
+                else:
+                    # additive increase, one more concurrent request per window of fast responses
+                    self.successes += 1
+                    if self.successes >= self.concurrency and self.concurrency < self.max_concurrency:
+                        self.concurrency += 1
+                        self.successes = 0
+            self.condition.notify_all()
+
+    def pause(self, seconds):
+        with self.condition:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+            self.condition.notify_all()
+
+    def __decrease__(self):
+        self.concurrency = max(1, self.concurrency // 2)
+        self.successes = 0
+
+
+def retry_after(response, default):
+    '''
+    response: http response asking the client to back off
+
+    Returns:
+        seconds to wait from the Retry-After header, given in seconds or as an http date
+    '''
+    if (value := response.headers.get('Retry-After', None)) is None:
+        return default
+    try:
+        return max(0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return default
@@ -0,0 +1,68 @@
+import os
+import tempfile
+from datetime import datetime, timedelta
+
+from cache import caches, caches_lock, decode, encode, store_result
+from utils import persistent_key
+
+SNAPSHOT_MAGIC = b'TMSNAP'
+SNAPSHOT_VERSION = 1
+
+
+def write_snapshot(path, api):
+    '''
+    saves every API result fetched by api during this run into a single versioned file
+
+    Returns:
+        number of requests saved
+    '''
+    entries = api.memo.entries()
+    snapshot = {
+        'version': SNAPSHOT_VERSION,
+        'created': datetime.now().isoformat(),
+        'url': api.url,
+        'requests': entries
+    }
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), prefix=f'.{os.path.basename(path)}.')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(SNAPSHOT_MAGIC + encode(snapshot))
+        os.chmod(temp_path, 0o644)
+        os.replace(temp_path, path)
+    except BaseException:
+        os.remove(temp_path)
+        raise
+    return len(entries)
+
+
+def read_snapshot(path):
+    '''
+    Returns:
+        the snapshot dict, raises RuntimeError when the file isn't a snapshot this version can read
+    '''
+    with open(path, 'rb') as f:
+        blob = f.read()
+    if not blob.startswith(SNAPSHOT_MAGIC):
+        raise RuntimeError(f'{path} is not a menu snapshot.')
+    snapshot = decode(blob[len(SNAPSHOT_MAGIC):])
+    if snapshot.get('version', None) != SNAPSHOT_VERSION:
+        raise RuntimeError(f'{path} is snapshot version {snapshot.get("version", None)}, version {SNAPSHOT_VERSION} is required.')
+    return snapshot
+
+
+def import_snapshot(snapshot, ttl):
+    '''
+    loads the results of a snapshot into the cache store so that the next runs start warm
+    ttl: minutes to cache the results
+
+    Returns:
+        number of requests imported
+    '''
+    if not ttl or int(ttl) <= 0:
+        raise RuntimeError('Importing a snapshot requires the cache to be enabled.')
+    expired = datetime.now() + timedelta(minutes=int(ttl))
+    with caches_lock:
+        for e in snapshot['requests']:
+            store_result(persistent_key(e['key']), e['data'], expired, entity=e['entity'])
+        caches.sync()
+    return len(snapshot['requests'])
@@ -1,8 +1,11 @@
 import random
+from collections import defaultdict
 
-from pulp import LpMaximize, LpProblem, LpVariable, lpSum, value
+from pulp import LpInteger, LpMaximize, LpProblem, LpVariable, lpSum, value
 from pulp.apis import PULP_CBC_CMD
 
+from profiling import Profiler
+
 
 class RecipePicker:
     solver = None
@@ -11,134 +14,197 @@ class RecipePicker:
     logger = None
     # TODO add names to constaints - include them in logging
 
-    def __init__(self, recipes, numrecipes, logger=None):
+    def __init__(self, recipes, numrecipes, logger=None, rng=None, profiler=None):
         self.logger = logger
+        self.profiler = profiler or Profiler()
         self.recipes = recipes
         self.numrecipes = numrecipes
-
-        self.solver = LpProblem("RecipePicker", LpMaximize)
-        self.recipe_vars = LpVariable.dicts("Recipe", [r.id for r in self.recipes], cat='Binary')
-        self.solver += lpSum(self.recipe_vars.values()) == self.numrecipes
+        # a private generator keeps concurrent pickers from sharing, and reseeding, the module's random state
+        self.random = rng or random
+        self.ids = {r.id for r in self.recipes}
+        # constraints are collected as (recipe ids, operator, count) and only become a model when solving
+        self.constraints = [(frozenset(self.ids), '==', self.numrecipes)]
+        # the last solution and what reroll() fixed about the next one
+        self.selected = []
+        self.rejected = set()
+        self.fixed = []
 
         # introduce randomness to recipe selection
-        self.solver += lpSum((10 * random.random()) * self.recipe_vars[r.id] for r in self.recipes)
-
-    def select_recipes(self, num_recipes):
-        self.solver += lpSum(self.recipes[i] for i in range(len(self.recipes))) <= self.numrecipes, "MaxRecipes"
-        self.logger.info(f'Selecting {self.numrecipes} recipes with {self.numcriteria} selection criteria.')
-        self.solver.solve()
-        selected = [self.recipes[i] for i in range(len(self.recipes)) if self.recipes[i].varValue == 1]
-        return selected
+        self.weights = {r.id: 10 * self.random.random() for r in self.recipes}
 
     def add_food_constraint(self, found_recipes, numrecipes, operator, exclude=False):
-        found_recipes = list(set(self.recipes) & set(found_recipes))
-        if exclude:
-            found_recipes = list(set(self.recipes) - set(found_recipes))
-        if operator == ">=":
-            self.solver += lpSum(self.recipe_vars[i] for i in [r.id for r in found_recipes]) >= numrecipes
-        elif operator == "<=":
-            self.solver += lpSum(self.recipe_vars[i] for i in [r.id for r in found_recipes]) <= numrecipes
-        elif operator == "==":
-            self.solver += lpSum(self.recipe_vars[i] for i in [r.id for r in found_recipes]) == numrecipes
-        else:
-            raise ValueError(f'Invalid constraint operator: {operator}')
-        self.logger.debug(f'Added constraint {operator} {numrecipes}.  Found {len(found_recipes)} recipes that contain the selected food(s).')
-        self.numcriteria += 1
+        self.__add_constraint__(found_recipes, numrecipes, operator, exclude, 'contain the selected food(s)', operators=('>=', '<=', '=='))
 
     def add_book_constraint(self, found_recipes, numrecipes, operator, exclude=False):
-        found_recipes = list(set(self.recipes) & set(found_recipes))
-        if exclude:
-            found_recipes = list(set(self.recipes) - set(found_recipes))
-        if operator == ">=":
-            self.solver += lpSum(self.recipe_vars[i] for i in [r.id for r in found_recipes]) >= numrecipes
-        elif operator == "<=":
-            self.solver += lpSum(self.recipe_vars[i] for i in [r.id for r in found_recipes]) <= numrecipes
-        elif operator == "==":
-            self.solver += lpSum(self.recipe_vars[i] for i in [r.id for r in found_recipes]) == numrecipes
-        else:
-            raise ValueError(f'Invalid constraint operator: {operator}')
-        self.logger.debug(f'Added constraint {operator} {numrecipes}.  Found {len(found_recipes)} recipes that are contained in the selected book(s).')
-        self.numcriteria += 1
+        self.__add_constraint__(found_recipes, numrecipes, operator, exclude, 'are contained in the selected book(s)', operators=('>=', '<=', '=='))
 
     def add_keyword_constraint(self, found_recipes, numrecipes, operator, exclude=False):
-        if exclude:
-            found_recipes = list(set(self.recipes) - set(found_recipes))
-
-        if operator == ">=":
-            self.solver += lpSum(self.recipe_vars[i] for i in [r.id for r in found_recipes]) >= numrecipes
-        elif operator == "<=":
-            self.solver += lpSum(self.recipe_vars[i] for i in [r.id for r in found_recipes]) <= numrecipes
-        elif operator == "==":
-            self.solver += lpSum(self.recipe_vars[i] for i in [r.id for r in found_recipes]) == numrecipes
-        elif operator == "!=":
-            self.solver += lpSum(self.recipe_vars[i] for i in [r.id for r in found_recipes]) != numrecipes
-        else:
-            raise ValueError(f'Invalid constraint operator: {operator}')
-        self.logger.debug(f'Added constraint {operator} {numrecipes}.  Found {len(found_recipes)} recipes that contain the selected keyword(s).')
-        self.numcriteria += 1
+        self.__add_constraint__(found_recipes, numrecipes, operator, exclude, 'contain the selected keyword(s)')
 
     # TODO add between constraint
     def add_rating_constraints(self, found_recipes, numrecipes, operator, exclude=False):
-        if exclude:
-            found_recipes = list(set(self.recipes) - set(found_recipes))
-
-        if operator == ">=":
-            self.solver += lpSum(self.recipe_vars[i] for i in [r.id for r in found_recipes]) >= numrecipes
-        elif operator == "<=":
-            self.solver += lpSum(self.recipe_vars[i] for i in [r.id for r in found_recipes]) <= numrecipes
-        elif operator == "==":
-            self.solver += lpSum(self.recipe_vars[i] for i in [r.id for r in found_recipes]) == numrecipes
-        elif operator == "!=":
-            self.solver += lpSum(self.recipe_vars[i] for i in [r.id for r in found_recipes]) != numrecipes
-        else:
-            raise ValueError(f'Invalid constraint operator: {operator}')
-        self.logger.debug(f'Added constraint {operator} {numrecipes}.  Found {len(found_recipes)} recipes that contain the selected rating.')
-        self.numcriteria += 1
+        self.__add_constraint__(found_recipes, numrecipes, operator, exclude, 'contain the selected rating')
 
     # TODO add between constraint
     def add_createdon_constraints(self, found_recipes, numrecipes, operator, exclude=False):
-        if exclude:
-            found_recipes = list(set(self.recipes) - set(found_recipes))
-
-        if operator == ">=":
-            self.solver += lpSum(self.recipe_vars[i] for i in [r.id for r in found_recipes]) >= numrecipes
-        elif operator == "<=":
-            self.solver += lpSum(self.recipe_vars[i] for i in [r.id for r in found_recipes]) <= numrecipes
-        elif operator == "==":
-            self.solver += lpSum(self.recipe_vars[i] for i in [r.id for r in found_recipes]) == numrecipes
-        elif operator == "!=":
-            self.solver += lpSum(self.recipe_vars[i] for i in [r.id for r in found_recipes]) != numrecipes
-        else:
-            raise ValueError(f'Invalid constraint operator: {operator}')
-        self.logger.debug(f'Added constraint {operator} {numrecipes}.  Found {len(found_recipes)} recipes that contain the selected createdon criteria.')
-        self.numcriteria += 1
+        self.__add_constraint__(found_recipes, numrecipes, operator, exclude, 'contain the selected createdon criteria')
 
     # TODO add between constraint
-    # TODO simplify number of methods that are essentially identical
     def add_cookedon_constraints(self, found_recipes, numrecipes, operator, exclude=False):
-        if exclude:
-            found_recipes = list(set(self.recipes) - set(found_recipes))
-
-        if operator == ">=":
-            self.solver += lpSum(self.recipe_vars[i] for i in [r.id for r in found_recipes]) >= numrecipes
-        elif operator == "<=":
-            self.solver += lpSum(self.recipe_vars[i] for i in [r.id for r in found_recipes]) <= numrecipes
-        elif operator == "==":
-            self.solver += lpSum(self.recipe_vars[i] for i in [r.id for r in found_recipes]) == numrecipes
-        elif operator == "!=":
-            self.solver += lpSum(self.recipe_vars[i] for i in [r.id for r in found_recipes]) != numrecipes
-        else:
+        self.__add_constraint__(found_recipes, numrecipes, operator, exclude, 'contain the selected cookedon criteria')
+
+    def add_onhand_constraints(self, found_recipes, numrecipes, operator, exclude=False):
+        self.__add_constraint__(found_recipes, numrecipes, operator, exclude, 'can be made with foods on hand', operators=('>=', '<=', '=='))
+
+    def add_cookcount_constraints(self, found_recipes, numrecipes, operator, exclude=False):
+        self.__add_constraint__(found_recipes, numrecipes, operator, exclude, 'were cooked fewer times than the selected number', operators=('>=', '<=', '=='))
+
+    def add_planned_constraints(self, found_recipes, numrecipes, operator, exclude=False):
+        self.__add_constraint__(found_recipes, numrecipes, operator, exclude, 'are in a meal plan since the selected date', operators=('>=', '<=', '=='))
+
+    def __add_constraint__(self, found_recipes, numrecipes, operator, exclude, description, operators=('>=', '<=', '==', '!=')):
+        if operator not in operators:
             raise ValueError(f'Invalid constraint operator: {operator}')
-        self.logger.debug(f'Added constraint {operator} {numrecipes}.  Found {len(found_recipes)} recipes that contain the selected cookedon criteria.')
+        found = {r.id for r in found_recipes} & self.ids
+        if exclude:
+            found = self.ids - found
+        self.constraints.append((frozenset(found), operator, int(numrecipes)))
+        self.logger.debug(f'Added constraint {operator} {numrecipes}.  Found {len(found)} recipes that {description}.')
         self.numcriteria += 1
 
+    def __presolve__(self):
+        '''
+        fixes recipes the constraints leave no choice about, then removes empty, duplicate and redundant rows
+
+        Returns:
+            ids fixed to 1, ids fixed to 0 and the remaining rows as (free ids, operator, count)
+        '''
+        rows = []
+        for ids, operator, count in self.constraints + self.fixed:
+            if operator == '!=':
+                # the solver has never enforced these, keep it that way rather than change which menus are found
+                self.logger.warning(f'Constraints with operator != are not supported and are ignored, {count} of {len(ids)} recipes.')
+                continue
+            rows.append((ids, operator, count))
+
+        ones, zeros = set(), set()
+        changed = True
+        while changed:
+            changed = False
+            for ids, operator, count in rows:
+                free = ids - ones - zeros
+                count -= len(ids & ones)
+                if (operator != '>=' and count < 0) or (operator != '<=' and count > len(free)):
+                    self.__infeasible__()
+                if free and operator != '>=' and count == 0:
+                    zeros |= free
+                    changed = True
+                elif free and operator != '<=' and count == len(free):
+                    ones |= free
+                    changed = True
+
+        selectable = self.numrecipes - len(ones)
+        tightest = {}
+        for ids, operator, count in rows:
+            free = ids - ones - zeros
+            count -= len(ids & ones)
+            # a row that can't bind: nothing left in it, at most everything, at least nothing or at most the menu size
+            if not free or (operator == '<=' and count >= min(len(free), selectable)) or (operator == '>=' and count <= 0):
+                continue
+            key = (free, operator)
+            if key not in tightest:
+                tightest[key] = count
+            elif operator == '==' and tightest[key] != count:
+                self.__infeasible__()
+            else:
+                tightest[key] = min(tightest[key], count) if operator == '<=' else max(tightest[key], count)
+        return ones, zeros, [(free, operator, count) for (free, operator), count in tightest.items()]
+
+    def __infeasible__(self):
+        self.logger.info('!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!')
+        self.logger.info('No solution found, adjustment of criteria required.')
+        self.logger.info('!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!')
+        raise RuntimeError('No solution found.')
+
     def solve(self):
         self.logger.debug(f'Solving to choose {self.numrecipes} with {self.numcriteria} unique criteria.')
-        debug = self.logger.loglevel == 10
-        self.solver.solve(PULP_CBC_CMD(msg=debug))
-        if self.solver.status != 1:
-            self.logger.info('!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!')
-            self.logger.info('No solution found, adjustment of criteria required.')
-            self.logger.info('!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!')
-            raise RuntimeError('No solution found.')
-        return [r for r in self.recipes if value(self.recipe_vars[r.id]) == 1]
+        with self.profiler.phase('presolve'):
+            ones, zeros, rows = self.__presolve__()
+        selectable = self.numrecipes - len(ones)
+
+        with self.profiler.phase('model'):
+            # recipes in exactly the same rows are interchangeable to the constraints, one integer counts each class
+            membership = defaultdict(list)
+            for i, (ids, _, _) in enumerate(rows):
+                for r in ids:
+                    membership[r].append(i)
+            classes = defaultdict(list)
+            for r in self.recipes:
+                if r.id not in ones and r.id not in zeros:
+                    classes[tuple(membership[r.id])].append(r.id)
+
+            self.solver = LpProblem("RecipePicker", LpMaximize)
+            counts, objective, columns = {}, [], 0
+            for c, (signature, members) in enumerate(classes.items()):
+                # heaviest first; with increments ordered by weight, choosing k of a class earns its k heaviest weights
+                members.sort(key=lambda r: self.weights[r], reverse=True)
+                if len(members) == 1:
+                    counts[signature] = LpVariable(f'Recipe_{members[0]}', cat='Binary')
+                    objective.append(self.weights[members[0]] * counts[signature])
+                    columns += 1
+                    continue
+                bound = min(len(members), selectable)
+                counts[signature] = LpVariable(f'Class_{c}', lowBound=0, upBound=bound, cat=LpInteger)
+                increments = [LpVariable(f'Class_{c}_{k}', lowBound=0, upBound=1) for k in range(bound)]
+                self.solver += counts[signature] == lpSum(increments)
+                objective += [self.weights[r] * x for r, x in zip(members, increments)]
+                columns += 1 + bound
+            self.solver += lpSum(objective)
+            for i, (_, operator, count) in enumerate(rows):
+                expression = lpSum(x for signature, x in counts.items() if i in signature)
+                if operator == '>=':
+                    self.solver += expression >= count
+                elif operator == '<=':
+                    self.solver += expression <= count
+                else:
+                    self.solver += expression == count
+
+        self.logger.info(
+            f'Presolve reduced the model from {len(self.recipes)} variables and {len(self.constraints)} constraints '
+            f'to {columns} variables in {len(classes)} classes and {len(rows)} constraints; '
+            f'{len(ones)} recipes fixed in and {len(zeros)} fixed out.'
+        )
+
+        selected = set(ones)
+        if counts:
+            debug = self.logger.loglevel == 10
+            with self.profiler.phase('solve'):
+                self.solver.solve(PULP_CBC_CMD(msg=debug))
+            if self.solver.status != 1:
+                self.__infeasible__()
+            for signature, x in counts.items():
+                selected.update(classes[signature][:round(value(x))])
+        self.selected = [r for r in self.recipes if r.id in selected]
+        return self.selected
+
+    def reroll(self, rejected, kept=None):
+        '''
+        replaces recipes of the last solution and keeps the others, with the same constraints and weights
+        rejected: IDs of recipes to replace, they aren't chosen again by this picker
+        kept: IDs of recipes to keep, the rest of the last solution by default
+
+        Returns:
+            the last solution with the rejected recipes replaced, in the same order
+        '''
+        previous = [r.id for r in self.selected]
+        self.rejected |= set(rejected)
+        kept = (set(previous) if kept is None else set(kept)) & self.ids - self.rejected
+        # kept recipes are fixed in, rejected ones out; presolve leaves a model of only the open slots
+        self.fixed = [(frozenset(kept), '==', len(kept)), (frozenset(self.rejected), '==', 0)]
+        self.logger.debug(f'Rerolling {self.numrecipes - len(kept)} recipes, keeping {len(kept)}.')
+        solution = {r.id: r for r in self.solve()}
+        # recipes still chosen keep their place, new ones take the places of the recipes they replace
+        replacements = iter([r for i, r in solution.items() if i not in previous])
+        ordered = [solution[i] if i in solution else next(replacements, None) for i in previous]
+        self.selected = [r for r in ordered if r is not None] + list(replacements)
+        return self.selected
@@ -1,8 +1,20 @@
+import atexit
 import json
+import math
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
 
 import requests
 
-from utils import TQDM, cached, display_progress
+from cache import entity_type
+from cassette import Cassette
+from decoding import decode
+from ratelimit import RateLimiter, retry_after
+from utils import TQDM, RequestMemo, cached, display_progress
+
+# requests that can be sent again after a 503 without risking a second write; a 429 was never processed
+IDEMPOTENT_METHODS = ('GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE')
 
 
 class TandoorAPI:
@@ -13,10 +25,15 @@ class TandoorAPI:
         if self.logger.loglevel != 10:
             self.progress = TQDM(total=100)
         self.ttl = kwargs.get('cache', 240)
+        # results already fetched during this run, in front of the persistent cache
+        self.memo = RequestMemo()
         self.token = token
         self.page_size = kwargs.get('page_size', 100)
         self.include_children = kwargs.get('include_children', True)
-        if url and url[-1] == '/':
+        if not url:
+            # offline and replayed runs take the url of their snapshot or cassette, if it has one
+            self.url = None
+        elif url[-1] == '/':
             self.url = f"{url}api/"
         else:
             self.url = f"{url}/api/"
@@ -24,47 +41,123 @@ class TandoorAPI:
             'Content-Type': 'application/json',
             'Authorization': f'Bearer {self.token}'
         }
+        self.session = requests.Session()
+        # shared by every request so concurrent fetching stays within the limits
+        self.max_concurrency = max(1, int(kwargs.get('max_concurrency', 1) or 1))
+        self.limiter = RateLimiter(rate=kwargs.get('rate_limit', 0), max_concurrency=self.max_concurrency)
+        self.retries = int(kwargs.get('retries', 3))
+        # offline runs are served entirely from the results of a snapshot
+        self.offline = False
+        if snapshot := kwargs.get('snapshot', None):
+            self.offline = True
+            self.ttl = 0
+            self.url = snapshot['url']
+            self.memo.preload(snapshot['requests'])
+        # every request recorded to, or replayed from, a cassette file
+        self.cassette = None
+        if path := kwargs.get('replay', None):
+            self.cassette = Cassette(path, 'replay', latency=kwargs.get('replay_latency', 0))
+            self.url = self.cassette.url
+            # a replay answers every request from the cassette, results cached by earlier runs would skip it
+            self.ttl = 0
+        elif path := kwargs.get('record', None):
+            self.cassette = Cassette(path, 'record', url=self.url)
+        if self.cassette:
+            atexit.register(self.close)
+
+    def request(self, method, url, **kwargs):
+        """
+        Send a request within the rate limit, backing off and retrying when the server responds 429, or 503
+        to an idempotent request; a POST or PATCH that timed out on the server may already have been applied.
+        Returns:
+            requests.Response: The final response.
+        """
+        if self.offline:
+            raise RuntimeError(f'Running offline, {method} {url} {kwargs.get("params", None) or ""} is not in the snapshot.')
+        for attempt in range(self.retries + 1):
+            self.limiter.acquire()
+            start = time.monotonic()
+            throttled = False
+            try:
+                if self.cassette:
+                    response = self.cassette.send(self.session, method, url, headers=self.headers, **kwargs)
+                else:
+                    response = self.session.request(method, url, headers=self.headers, **kwargs)
+                throttled = response.status_code in (429, 503)
+            finally:
+                self.limiter.release(latency=time.monotonic() - start, throttled=throttled)
+            retry = response.status_code == 429 or method.upper() in IDEMPOTENT_METHODS
+            if not throttled or not retry or attempt == self.retries:
+                return response
+            delay = retry_after(response, default=2 ** attempt)
+            self.logger.debug(f'Server responded {response.status_code}, retrying {url} in {delay:.1f} seconds.')
+            self.limiter.pause(delay)
+        return response
+
+    def close(self):
+        if not self.cassette:
+            return
+        if count := self.cassette.save():
+            self.logger.info(f'Recorded {count} requests to {self.cassette.path}.')
+        self.logger.info(f'Tandoor API: {self.cassette.summary()}')
+        self.cassette = None
 
     def update_progress(self):
         if self.progress:
             self.progress.update_step()
 
     @display_progress
-    @cached
+    @cached(entity=entity_type)
     def get_paged_results(self, url, params, **kwargs):
         results = []
+        base_url, first_page = url, True
         while url:
             self.logger.debug(f'Connecting to tandoor api at url: {url}')
             self.logger.debug(f'Connecting with params: {str(params)}')
             if '?' in url:
                 params = None
-            response = requests.get(url, headers=self.headers, params=params)
-            content = json.loads(response.content)
+            content = self.get_page(url, params)
+            if isinstance(content, list):
+                # endpoints that aren't paginated answer with every result at once
+                return results + content
             new_results = content.get('results', [])
             self.logger.debug(f'Retrieved {len(new_results)} results.')
             results = results + new_results
             url = content.get('next', None)
 
-            if response.status_code != 200:
-                self.logger.info(f"Failed to fetch recipes. Status code: {response.status_code}: {response.text}")
-                raise Exception(f"Failed to fetch recipes. Status code: {response.status_code}: {response.text}")
+            if first_page and url and params is not None and self.max_concurrency > 1 and new_results:
+                # the page count is known after the first page, fetch the rest concurrently
+                pages = math.ceil(content.get('count', 0) / len(new_results))
+                with ThreadPoolExecutor(max_workers=self.max_concurrency) as pool:
+                    for page in pool.map(lambda p: self.get_page(base_url, {**params, 'page': p}), range(2, pages + 1)):
+                        results = results + page.get('results', [])
+                self.logger.debug(f'Retrieved {len(results)} results from {pages} pages.')
+                break
+            first_page = False
         return results
 
+    def get_page(self, url, params):
+        response = self.request('GET', url, params=params)
+        if response.status_code != 200:
+            self.logger.info(f"Failed to fetch recipes. Status code: {response.status_code}: {response.text}")
+            raise Exception(f"Failed to fetch recipes. Status code: {response.status_code}: {response.text}")
+        return decode(response.content, url)
+
     @display_progress
-    @cached
+    @cached(entity=entity_type)
     def get_unpaged_results(self, url, obj_id, **kwargs):
         url = f'{url}{obj_id}'
         self.logger.debug(f'Connecting to tandoor api at url: {url}')
-        response = requests.get(url, headers=self.headers)
+        response = self.request('GET', url)
 
         if response.status_code != 200:
             self.logger.info(f"Failed to fetch recipes. Status code: {response.status_code}: {response.text}")
             raise Exception(f"Failed to fetch recipes. Status code: {response.status_code}: {response.text}")
-        return json.loads(response.content)
+        return decode(response.content, url)
 
     def create_object(self, url, data, **kwargs):
         self.logger.debug(f'Create object with tandoor api at url: {url}')
-        response = requests.post(url, headers=self.headers, json=data)
+        response = self.request('POST', url, json=data)
 
         if response.status_code == 201:
             return response.json()
@@ -72,9 +165,19 @@ class TandoorAPI:
             self.logger.info(f'Error creating object: {response.text}')
             raise RuntimeError(f'Error creating object: {response.text}')
 
+    def update_object(self, url, obj_id, data, **kwargs):
+        self.logger.debug(f'Update object with tandoor api at url: {url}')
+        response = self.request('PATCH', f'{url}{obj_id}/', json=data)
+
+        if response.status_code == 200:
+            return response.json()
+        else:
+            self.logger.info(f'Error updating object: {response.text}')
+            raise RuntimeError(f'Error updating object: {response.text}')
+
     def delete_object(self, url, obj_id, **kwargs):
         self.logger.debug(f'Deleteing object with tandoor api at url: {url}')
-        response = requests.delete(f'{url}{obj_id}', headers=self.headers)
+        response = self.request('DELETE', f'{url}{obj_id}')
 
         if response.status_code != 204:
             self.logger.info(f'Error deleting object: {response.text}')
@@ -91,7 +194,8 @@ class TandoorAPI:
         if params or kwargs.get('all_recipes', False):
             params['include_children'] = self.include_children
             params['page_size'] = self.page_size
-            recipes = self.get_paged_results(url, params, **kwargs)
+            # copy, memoized results are shared between callers
+            recipes = list(self.get_paged_results(url, params, **kwargs))
 
         if not isinstance(filters, list):
             filters = [filters]
@@ -103,7 +207,7 @@ class TandoorAPI:
 
     @display_progress
     @cached
-    def get_recipe_details(self, recipe_id):
+    def get_recipe_details(self, recipe_id, **kwargs):
         """
         Fetch details of a specific recipe by its ID.
         Args:
@@ -112,7 +216,7 @@ class TandoorAPI:
             dict: Details of the recipe in JSON-LD format.
         """
         url = f"{self.url}recipe/{recipe_id}"
-        response = requests.get(url, headers=self.headers)
+        response = self.request('GET', url)
 
         if response.status_code == 200:
             return response.json()
@@ -149,6 +253,19 @@ class TandoorAPI:
         self.logger.debug(f'Returning {len(foods)} total food.')
         return foods
 
+    def get_foods(self, params={}, **kwargs):
+        """
+        Fetch all foods from the API.
+        Returns:
+            list: A list of food objects in tandoor format.
+        """
+
+        url = f"{self.url}food/"
+        foods = self.get_paged_results(url, {**params, 'page_size': self.page_size}, **kwargs)
+
+        self.logger.debug(f'Returning {len(foods)} total foods.')
+        return foods
+
     def get_food(self, food_id, params={}, **kwargs):
         """
         Fetch a food and it's descendants from the API.
@@ -176,7 +293,7 @@ class TandoorAPI:
         return book
 
     @display_progress
-    @cached
+    @cached(entity='recipe')
     def get_book_recipes(self, book, params={}, **kwargs):
         """
         Fetch all recipes in a book from the API.
@@ -193,6 +310,17 @@ class TandoorAPI:
         self.logger.debug(f'Returning book {book.id}: {book.name} with {len(recipes)} recipes.')
         return recipes
 
+    def get_book_entries(self, book_id, **kwargs):
+        """
+        Fetch the entries of a book page by page, without the recipes' other results.
+        Returns:
+            list: Book entries in tandoor format.
+        """
+        url = f"{self.url}recipe-book-entry/"
+        entries = self.get_paged_results(url, {'book': book_id, 'page_size': self.page_size})
+        self.logger.debug(f'Returning {len(entries)} entries of book {book_id}.')
+        return entries
+
     def get_mealplan_recipes(self, mealtype_id=[], date=None, params={}, **kwargs):
         """
         Fetch all recipes of mealtype.
@@ -228,7 +356,7 @@ class TandoorAPI:
                 'shared': shared,
                 'from_date': date.strftime('%Y-%m-%d'),
                 'to_date': date.strftime('%Y-%m-%d'),
-                'meal_type': self.get_unpaged_results(f'{self.url}meal-type/', type)
+                'meal_type': self.get_meal_type(type)
             }
         )
 
@@ -236,10 +364,61 @@ class TandoorAPI:
 
         return plan
 
+    def get_meal_type(self, type_id, **kwargs):
+        url = f"{self.url}meal-type/"
+        return self.get_unpaged_results(url, type_id, **kwargs)
+
     def get_meal_plans(self, date, **kwargs):
         url = f"{self.url}meal-plan/?from_date={date.strftime('%Y-%m-%d')}"
         return self.get_unpaged_results(url, '', **kwargs)
 
+    def get_meal_plan_range(self, from_date, to_date, **kwargs):
+        url = f"{self.url}meal-plan/?from_date={from_date.strftime('%Y-%m-%d')}&to_date={to_date.strftime('%Y-%m-%d')}"
+        return self.get_unpaged_results(url, '', **kwargs)
+
+    def get_cook_log(self, since=None):
+        """
+        Fetch cook log entries, newest first, until the first page reaching back to since.
+        Returns:
+            list: Cook log entries in tandoor format.
+        """
+        url = f"{self.url}cook-log/"
+        params = {'page_size': self.page_size}
+        logs = []
+        while url:
+            content = self.get_page(url, None if '?' in url else params)
+            page = content.get('results', [])
+            logs += page
+            if since and any(datetime.fromisoformat(c['created_at']) <= since for c in page):
+                break
+            url = content.get('next', None)
+        self.logger.debug(f'Retrieved {len(logs)} cook log entries.')
+        return logs
+
+    def update_meal_plan(self, obj_id, recipe=None, title=None, servings=1, date=None, note=None, shared=None, **kwargs):
+        url = f"{self.url}meal-plan/"
+        data = {
+            'title': title,
+            'recipe': {
+                'id': recipe.id,
+                'name': recipe.name,
+                'keywords': []
+            },
+            'servings': servings
+        }
+        # everything else is only changed when given
+        if date:
+            data['from_date'] = data['to_date'] = date.strftime('%Y-%m-%d')
+        if note is not None:
+            data['note'] = note
+        if shared is not None:
+            data['shared'] = shared
+        plan = self.update_object(url, obj_id, data)
+
+        self.logger.debug(f'Succesfully updated meal plan {obj_id}: {title}')
+
+        return plan
+
     def delete_meal_plan(self, obj_id, **kwargs):
         url = f"{self.url}meal-plan/"
         self.delete_object(url, obj_id)
@@ -250,7 +429,7 @@ class TandoorAPI:
     def get_food_substitutes(self, id, substitute):
         url = f"{self.url}{substitute}/{id}/substitutes/"
         self.logger.debug(f'Connecting to tandoor api at url: {url}')
-        response = requests.get(url, headers=self.headers, params={'onhand': 1})
+        response = self.request('GET', url, params={'onhand': 1})
 
         if response.status_code != 200:
             self.logger.info(f"Failed to fetch food substitutes. Status code: {response.status_code}: {response.text}")
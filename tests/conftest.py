@@ -0,0 +1,130 @@
+import json
+import logging
+import os
+import sys
+from datetime import datetime, timedelta
+from urllib.parse import urlsplit
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from cache import caches  # noqa: E402
+
+
+@pytest.fixture(autouse=True)
+def cache_store(tmp_path, monkeypatch):
+    '''
+    every test runs in its own directory with its own cache store
+    '''
+    monkeypatch.chdir(tmp_path)
+    caches.close()
+    monkeypatch.setattr(caches, 'path', str(tmp_path / 'caches.sqlite3'))
+    yield caches
+    caches.close()
+
+
+@pytest.fixture
+def logger():
+    logger = logging.getLogger('tests')
+    logger.loglevel = logging.INFO
+    return logger
+
+
+def recipe_json(recipe_id, **fields):
+    return {
+        'id': recipe_id, 'name': f'Recipe {recipe_id}', 'description': '', 'new': False, 'servings': 2, 'keywords': [],
+        'last_cooked': None, 'created_at': (datetime.now() - timedelta(days=100)).isoformat(), 'updated_at': None, 'rating': None,
+        **fields
+    }
+
+
+def food_json(food_id, onhand=False, **fields):
+    return {
+        'id': food_id, 'name': f'f{food_id}', 'shopping': False, 'recipe': None, 'food_onhand': onhand, 'ignore_shopping': False,
+        'parent': None, 'substitute': [], 'substitute_onhand': False, 'substitute_siblings': False, 'substitute_children': False,
+        **fields
+    }
+
+
+class FakeTandoor:
+    """
+    Stands in for TandoorAPI with fixed recipes, cook logs and meal plans, and counts the requests made.
+    """
+    url = 'http://tandoor.example/api/'
+
+    def __init__(self, recipes=[], cook_log=[], meal_plans=[], foods=[], details={}, offline=False):
+        self.recipes = recipes
+        self.cook_log = cook_log
+        self.meal_plans = meal_plans
+        # food json by id and recipe details by recipe id
+        self.foods = {f['id']: f for f in foods}
+        self.details = details
+        self.offline = offline
+        self.progress = None
+        self.max_concurrency = 1
+        self.calls = []
+
+    def get_recipes(self, params={}, filters=[], **kwargs):
+        self.calls.append(('get_recipes', params, filters))
+        return list(self.recipes)
+
+    def get_recipe_details(self, recipe_id, **kwargs):
+        self.calls.append(('get_recipe_details', recipe_id))
+        return self.details[recipe_id]
+
+    def update_progress(self):
+        pass
+
+    def get_keyword_tree(self, keyword_id):
+        self.calls.append(('get_keyword_tree', keyword_id))
+        return [{'id': keyword_id, 'name': f'Keyword {keyword_id}'}]
+
+    def get_mealplan_recipes(self, mealtype_id=None, date=None, params=None):
+        return []
+
+    def get_cook_log(self, since=None):
+        self.calls.append(('get_cook_log', since))
+        return [c for c in self.cook_log if since is None or datetime.fromisoformat(c['created_at']) >= since]
+
+    def get_meal_plan_range(self, from_date, to_date, **kwargs):
+        self.calls.append(('get_meal_plan_range', from_date, to_date))
+        return [p for p in self.meal_plans if from_date.date() <= datetime.fromisoformat(p['from_date']).date() <= to_date.date()]
+
+
+class Response:
+    def __init__(self, status_code, body=None):
+        self.status_code = status_code
+        self.content = json.dumps(body).encode('utf-8')
+        self.text = self.content.decode('utf-8')
+        self.headers = {}
+        self.elapsed = timedelta(0)
+
+    def json(self):
+        return json.loads(self.content)
+
+
+class Server:
+    """
+    Stands in for the requests session of a TandoorAPI, answering GETs of the paths in routes and 404 otherwise.
+    """
+    def __init__(self, routes={}):
+        self.routes = routes
+        self.sent = []
+
+    def request(self, method, url, **kwargs):
+        self.sent.append((method, url, kwargs.get('params', None)))
+        path = urlsplit(url).path
+        return Response(200, self.routes[path]) if method == 'GET' and path in self.routes else Response(404, {'detail': 'Not found.'})
+
+
+def tandoor_api(logger, routes={}, url='http://tandoor.example/', **kwargs):
+    '''
+    Returns:
+        a TandoorAPI sending its requests to a Server with routes
+    '''
+    from tandoor_api import TandoorAPI
+    logger.loglevel = logging.DEBUG
+    api = TandoorAPI(url, 'x', logger, **kwargs)
+    api.session = Server(routes)
+    return api
@@ -0,0 +1,96 @@
+import pytest
+
+import batch
+from batch import MenuBatch, read_profiles
+from conftest import FakeTandoor, recipe_json
+
+CONFIG = '''[create-menu]
+url: http://tandoor.example/
+token: x
+choices: 2
+seed: 1
+[menufile]
+file_format: ["PDF"]
+[profile:dinner]
+choices: 3
+[profile:lunch]
+token: y
+[profile:breakfast]
+file_format: ["PNG"]
+[profile:snack]
+cache: 0
+'''
+
+
+@pytest.fixture
+def config(tmp_path):
+    path = tmp_path / 'batch.ini'
+    path.write_text(CONFIG)
+    return str(path)
+
+
+def test_profiles_are_layered_over_the_shared_sections(config):
+    profiles = dict(read_profiles(config))
+    assert list(profiles) == [f'{config}#dinner', f'{config}#lunch', f'{config}#breakfast', f'{config}#snack']
+    dinner, lunch, breakfast, snack = profiles.values()
+    assert (dinner.choices, dinner.token, dinner.file_format) == ('3', 'x', ['PDF'])
+    assert (lunch.choices, lunch.token) == ('2', 'y')
+    assert breakfast.file_format == ['PNG']
+    assert (snack.cache, snack.file_format) == ('0', ['PDF'])
+
+    assert [name for name, _ in read_profiles(f'{config}#lunch')] == [f'{config}#lunch']
+    with pytest.raises(RuntimeError, match='no section'):
+        read_profiles(f'{config}#supper')
+
+
+def test_a_file_without_profiles_is_one_profile(tmp_path):
+    (path := tmp_path / 'config.ini').write_text('[create-menu]\nurl: http://tandoor.example/\ntoken: x\nchoices: 4\n')
+    [(name, options)] = read_profiles(str(path))
+    assert name == str(path) and options.choices == '4'
+
+
+def test_profiles_of_the_same_server_share_an_api(config, logger):
+    logger.loglevel = 10
+    menus = dict(MenuBatch(read_profiles(config), logger).menus)
+    dinner, lunch, breakfast, snack = menus.values()
+    assert dinner.tandoor is breakfast.tandoor
+    assert lunch.tandoor is not dinner.tandoor
+    assert snack.tandoor is not dinner.tandoor
+
+
+def test_profiles_are_selected_concurrently(config, logger):
+    logger.loglevel = 10
+    runs = []
+    for _ in range(2):
+        runner = MenuBatch(read_profiles(config), logger, workers=4)
+        tandoor = FakeTandoor(recipes=[recipe_json(i) for i in range(4)])
+        for _, menu in runner.menus:
+            menu.tandoor = tandoor
+        runner.menus[0][1].choices = 5
+        runner.prepare_data()
+        runs.append({name: [r.id for r in recipes] for name, _, recipes in runner.select_recipes()})
+    # the dinner profile asks for more recipes than there are and is skipped
+    assert [name.split('#')[1] for name in runs[0]] == ['lunch', 'breakfast', 'snack']
+    assert all(len(ids) == 2 for ids in runs[0].values())
+    # seeded profiles select the same recipes every time
+    assert runs[0] == runs[1]
+
+
+def test_menu_files_use_the_profiles_generator(config, logger, monkeypatch):
+    logger.loglevel = 10
+    created = []
+
+    class Generator:
+        def __init__(self, api, options, logger, pantry=None, rng=None):
+            created.append(rng)
+            self.fonts, self.template_dir = [], ''
+
+        def prepare_menu(self, recipes):
+            return []
+
+    monkeypatch.setattr(batch, 'MenuGenerator', Generator)
+    runner = MenuBatch(read_profiles(f'{config}#dinner'), logger)
+    menu = runner.menus[0][1]
+    menu.options.create_file = True
+    runner.generate_menu_files([('dinner', menu, [])])
+    assert created == [menu.random]
@@ -0,0 +1,130 @@
+import shelve
+import threading
+import time
+from datetime import datetime, timedelta
+
+import pytest
+
+import cache
+from cache import CacheStore, decode, encode, load_or_fetch, load_result, open_cache, prune_entities, store_result
+
+
+def test_entity_results_share_rows(cache_store):
+    expired = datetime.now() + timedelta(hours=1)
+    store_result('a', [{'id': 1, 'name': 'one'}, {'id': 2, 'name': 'two'}], expired, entity='recipe')
+    store_result('b', {'id': 2, 'name': 'two, updated'}, expired, entity='recipe')
+    assert load_result('a') == [{'id': 1, 'name': 'one'}, {'id': 2, 'name': 'two, updated'}]
+    assert load_result('b') == {'id': 2, 'name': 'two, updated'}
+    assert cache_store['a'] == {'entity': 'recipe', 'ids': [1, 2], 'many': True, 'expired': expired}
+
+    del cache_store['a']
+    prune_entities()
+    assert cache_store.get_entities('recipe', ['1', '2']) == {'2': {'id': 2, 'name': 'two, updated'}}
+    # a result whose entities are gone is a miss
+    cache_store.prune({})
+    with pytest.raises(KeyError):
+        load_result('b')
+
+
+def test_expired_results_are_misses_unless_stale(cache_store):
+    store_result('a', {'value': 1}, datetime.now() - timedelta(seconds=1))
+    with pytest.raises(KeyError):
+        load_result('a')
+    assert load_result('a', stale=True) == {'value': 1}
+
+
+def test_entity_tables_of_the_old_layout_are_split_into_rows(tmp_path):
+    path = str(tmp_path / 'old.sqlite3')
+    store = CacheStore(path)
+    store['entity:recipe'] = {'data': {'1': {'id': 1}, '2': {'id': 2}}, 'expired': datetime.max}
+    store.close()
+    store = CacheStore(path)
+    assert 'entity:recipe' not in store
+    assert store.get_entities('recipe', ['1', '2', '3']) == {'1': {'id': 1}, '2': {'id': 2}}
+    store.close()
+
+
+def test_only_one_thread_refills_a_key(cache_store, monkeypatch):
+    monkeypatch.setattr(cache, 'LEASE_POLL', 0.01)
+    calls, results = [], []
+
+    def _loader():
+        calls.append(1)
+        time.sleep(0.2)
+        return {'value': len(calls)}
+
+    threads = [threading.Thread(target=lambda: results.append(load_or_fetch('k', _loader, timedelta(hours=1)))) for _ in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert len(calls) == 1
+    assert results == [{'value': 1}] * 4
+
+
+def test_an_expired_result_is_served_while_another_thread_refills_it(cache_store):
+    store_result('k', {'value': 'old'}, datetime.now() - timedelta(seconds=1))
+    assert cache_store.acquire_lease('k')
+    served = []
+    thread = threading.Thread(target=lambda: served.append(load_or_fetch('k', lambda: {'value': 'new'}, timedelta(hours=1))))
+    thread.start()
+    thread.join()
+    assert served == [{'value': 'old'}]
+
+
+def test_a_key_leased_without_an_expired_result_is_fetched_after_a_short_wait(cache_store, monkeypatch):
+    monkeypatch.setattr(cache, 'LEASE_POLL', 0.01)
+    monkeypatch.setattr(cache, 'LEASE_WAIT', 0.2)
+    # held by a process that hangs, the lease runs for LEASE_SECONDS
+    assert cache_store.acquire_lease('k')
+    served, start = [], time.monotonic()
+    thread = threading.Thread(target=lambda: served.append(load_or_fetch('k', lambda: {'value': 'new'}, timedelta(hours=1))))
+    thread.start()
+    thread.join()
+    assert served == [{'value': 'new'}]
+    assert 0.2 <= time.monotonic() - start < 2
+    assert load_result('k') == {'value': 'new'}
+
+
+def test_undecodable_records_are_dropped(cache_store):
+    cache_store['a'] = {'data': 1, 'expired': datetime.max}
+    cache_store.db.execute('UPDATE cache SET value = ?, version = ? WHERE key = ?', (b'JZ' + b'not zlib', 'other', 'a'))
+    assert cache_store.get('a', None) is None
+    assert 'a' not in cache_store
+
+
+def test_the_legacy_cache_is_set_aside_on_first_use(tmp_path):
+    with shelve.open(str(tmp_path / 'caches.db')) as legacy:
+        legacy['key'] = {'data': 1, 'expired': datetime.max}
+    (tmp_path / 'caches.db.dir.migrated').write_bytes(b'')
+    legacy_files = {f.name for f in tmp_path.iterdir() if f.name.startswith('caches.db') and not f.name.endswith('.migrated')}
+    store = open_cache(str(tmp_path / 'caches.sqlite3'), str(tmp_path / 'caches.db'))
+    assert len(store) == 0
+    assert {f.name for f in tmp_path.iterdir() if f.name.startswith('caches.db')} == {
+        'caches.db.dir.migrated', *(f'{f}.old' for f in legacy_files)
+    }
+    store.close()
+
+
+@pytest.mark.parametrize('size', [10, 10000])
+def test_codecs_fall_back_to_json_and_zlib(monkeypatch, size):
+    monkeypatch.setattr(cache, 'msgpack', None)
+    monkeypatch.setattr(cache, 'zstandard', None)
+    value = {'text': 'x' * size, 'list': [1, 2.5, None, True]}
+    blob = encode(value)
+    assert blob[:2] == (b'JZ' if size > cache.COMPRESS_THRESHOLD else b'JN')
+    assert decode(blob) == value
+
+
+def test_records_of_missing_codecs_are_fetched_again(cache_store, monkeypatch):
+    monkeypatch.setattr(cache, 'msgpack', None)
+    monkeypatch.setattr(cache, 'zstandard', None)
+    with pytest.raises(RuntimeError, match='zstandard'):
+        decode(b'JS' + b'payload')
+    with pytest.raises(RuntimeError, match='msgpack'):
+        decode(b'MN' + b'payload')
+    cache_store['a'] = {'data': 1, 'expired': datetime.max}
+    cache_store.db.execute('UPDATE cache SET value = ?, version = ? WHERE key = ?', (b'MN' + b'payload', 'other', 'a'))
+    with pytest.raises(KeyError):
+        load_result('a')
+    assert 'a' not in cache_store
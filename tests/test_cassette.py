@@ -0,0 +1,61 @@
+from cache import caches
+from cassette import Cassette, interaction_key
+from conftest import Response, Server, recipe_json, tandoor_api
+
+ROUTES = {
+    '/api/recipe/': {'count': 2, 'next': None, 'previous': None, 'results': [recipe_json(1), recipe_json(2)]},
+}
+
+
+def test_interaction_key_ignores_parameter_order():
+    assert interaction_key('GET', 'http://a/api/recipe/?b=2&a=1') == interaction_key('GET', 'http://a/api/recipe/', {'a': 1, 'b': 2})
+    assert interaction_key('GET', 'http://a/api/recipe/', {'k': [1, 2]})[0] == 'GET /api/recipe/?k=1&k=2'
+    assert interaction_key('POST', 'http://a/api/x/', body={'b': 1, 'a': 2})[1] == 'POST /api/x/ {"a": 2, "b": 1}'
+
+
+def test_replay_serves_a_recording_without_the_server(logger, tmp_path):
+    path = str(tmp_path / 'run.cassette')
+    api = tandoor_api(logger, ROUTES, cache=0, record=path)
+    recipes = api.get_recipes(all_recipes=True)
+    api.close()
+
+    replay = tandoor_api(logger, cache=0, replay=path)
+    assert replay.get_recipes(all_recipes=True) == recipes
+    assert replay.session.sent == []
+    assert replay.cassette.misses == 0
+    assert 'GET 1' in replay.cassette.summary()
+
+
+def test_replay_bypasses_the_persistent_cache(logger, tmp_path):
+    path = str(tmp_path / 'run.cassette')
+    api = tandoor_api(logger, ROUTES, cache=0, record=path)
+    recipes = api.get_recipes(all_recipes=True)
+    api.close()
+    # an earlier run cached other results for the same request
+    changed = {'/api/recipe/': {**ROUTES['/api/recipe/'], 'count': 1, 'results': [recipe_json(3)]}}
+    assert tandoor_api(logger, changed).get_recipes(all_recipes=True) != recipes
+    cached = len(caches)
+
+    replay = tandoor_api(logger, replay=path)
+    assert replay.get_recipes(all_recipes=True) == recipes
+    assert replay.cassette.misses == 0
+    assert len(caches) == cached
+
+
+def test_identical_requests_replay_in_order(tmp_path):
+    path = str(tmp_path / 'run.cassette')
+    cassette = Cassette(path, 'record', url='http://a/api/')
+    server = Server()
+    for status, body in [(200, {'id': 1}), (201, {'id': 2}), (201, {'id': 3})]:
+        server.request = lambda method, url, response=Response(status, body), **kwargs: response
+        cassette.send(server, 'POST', 'http://a/api/meal-plan/', json={'day': status})
+    assert cassette.save() == 3
+
+    replay = Cassette(path, 'replay')
+    # the exact body first, then any recording of the same request, the last one repeating once used up
+    assert replay.send(None, 'POST', 'http://a/api/meal-plan/', json={'day': 200}).json() == {'id': 1}
+    assert replay.send(None, 'POST', 'http://a/api/meal-plan/', json={'day': 999}).json() == {'id': 2}
+    assert replay.send(None, 'POST', 'http://a/api/meal-plan/', json={'day': 201}).json() == {'id': 3}
+    assert replay.send(None, 'POST', 'http://a/api/meal-plan/', json={'day': 201}).json() == {'id': 3}
+    missing = replay.send(None, 'GET', 'http://a/api/food/')
+    assert missing.status_code == 404 and replay.misses == 1
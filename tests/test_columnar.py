@@ -0,0 +1,75 @@
+import math
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+import columnar
+from columnar import RecipeColumns, write_columns
+from conftest import recipe_json
+from models import ColumnarRecipe, Recipe
+
+FIELDS = ('id', 'name', 'description', 'new', 'servings', 'keywords', 'rating')
+DATES = ('createdon', 'cookedon', 'updatedon')
+
+
+def recipes():
+    # Tandoor's dates carry their time zone
+    created = (datetime.now() - timedelta(days=100)).astimezone().isoformat()
+    cooked = datetime(2026, 3, 1, 18, 30, tzinfo=timezone(timedelta(hours=2))).isoformat()
+    return [Recipe(recipe_json(created_at=created, **fields)) for fields in (
+        {'recipe_id': 1, 'keywords': [{'id': 3}, {'id': 7}], 'rating': 4, 'last_cooked': cooked, 'updated_at': cooked},
+        {'recipe_id': 2, 'name': 'Crème brûlée 🍮', 'description': '<b>rich</b>', 'new': True, 'servings': 6, 'rating': 2.5},
+        {'recipe_id': 3, 'name': '', 'keywords': [{'id': 7}], 'rating': 0},
+        {'recipe_id': 2 ** 40, 'rating': -1, 'last_cooked': '2025-12-31T23:59:59.250000-05:00'},
+    )]
+
+
+@pytest.fixture(params=['numpy', 'memoryview'])
+def reader(request, monkeypatch):
+    if request.param == 'numpy':
+        if columnar.numpy is None:
+            pytest.skip('NumPy is not installed')
+    else:
+        monkeypatch.setattr(columnar, 'numpy', None)
+    return request.param
+
+
+def test_columns_read_back_every_field(reader):
+    expected = recipes()
+    write_columns('recipes.columns', expected)
+    columns = RecipeColumns('recipes.columns')
+    assert len(columns) == len(expected)
+    for original, mapped in zip(expected, columns.recipes()):
+        assert isinstance(mapped, ColumnarRecipe)
+        assert {f: getattr(mapped, f) for f in FIELDS} == {f: getattr(original, f) for f in FIELDS}
+        assert [type(getattr(mapped, f)) for f in ('id', 'new', 'servings')] == [int, bool, int]
+        for field in DATES:
+            date = getattr(original, field)
+            if date is None:
+                assert getattr(mapped, field) is None
+            else:
+                # the same moment, read back in UTC
+                assert getattr(mapped, field) == date
+                assert math.isclose(getattr(mapped, field).timestamp(), date.timestamp())
+
+
+def test_recipes_are_filtered_alike(reader):
+    expected = recipes()
+    write_columns('recipes.columns', expected)
+    mapped = RecipeColumns('recipes.columns').recipes()
+    keyword = type('Keyword', (), {'id': 7})
+
+    def ids(found):
+        return [r.id for r in found]
+    assert ids(Recipe.recipesWithKeyword(mapped, [keyword])) == ids(Recipe.recipesWithKeyword(expected, [keyword])) == [1, 3]
+    assert ids(Recipe.recipesWithRating(mapped, 2)) == ids(Recipe.recipesWithRating(expected, 2)) == [1, 2]
+    assert ids(Recipe.recipesWithRating(mapped, -3)) == ids(Recipe.recipesWithRating(expected, -3)) == [2]
+    since = datetime(2025, 1, 1, tzinfo=timezone.utc)
+    assert ids(Recipe.recipesWithDate(mapped, 'cookedon', since)) == ids(Recipe.recipesWithDate(expected, 'cookedon', since))
+
+
+def test_other_files_are_refused():
+    with open('recipes.columns', 'wb') as f:
+        f.write(b'\x00' * 64)
+    with pytest.raises(RuntimeError):
+        RecipeColumns('recipes.columns')
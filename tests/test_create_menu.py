@@ -0,0 +1,199 @@
+import json
+import os
+import random
+from datetime import datetime, timedelta
+
+import pytest
+
+from conftest import FakeTandoor, food_json, recipe_json, tandoor_api
+from create_menu import Menu, MenuSession, parse_args, validate_args
+from menu import MenuGenerator
+from snapshot import read_snapshot, write_snapshot
+
+
+def write_config():
+    with open('config.ini', 'w') as f:
+        f.write('[defaults]\nurl = http://tandoor.example/\ntoken = x\n')
+
+
+def options(*argv):
+    write_config()
+    return parse_args(list(argv))
+
+
+def test_recently_cooked_recipe_is_excluded():
+    yesterday = (datetime.now() - timedelta(days=1)).astimezone().isoformat()
+    tandoor = FakeTandoor(
+        recipes=[recipe_json(1), recipe_json(2)],
+        cook_log=[{'id': 10, 'recipe': 1, 'created_at': yesterday}]
+    )
+    session = MenuSession(options('--choices', '1', '--cookcount', "{'condition': '30days', 'times': 1, 'count': 1, 'operator': '=='}"), tandoor=tandoor)
+    for seed in range(10):
+        assert [r.id for r in session.select(seed=seed)] == [2]
+    # synced once for the session, not once per selection
+    assert len([c for c in tandoor.calls if c[0] == 'get_cook_log']) == 1
+
+
+def test_constraints_of_a_selection_sync_the_history():
+    yesterday = (datetime.now() - timedelta(days=1)).astimezone().isoformat()
+    tandoor = FakeTandoor(
+        recipes=[recipe_json(1), recipe_json(2)],
+        cook_log=[{'id': 10, 'recipe': 2, 'created_at': yesterday}]
+    )
+    session = MenuSession(options('--choices', '1'), tandoor=tandoor)
+    constraints = {'cookcount': [{'condition': '30days', 'times': 1, 'count': 1, 'operator': '=='}]}
+    for seed in range(10):
+        assert [r.id for r in session.select(constraints, seed=seed)] == [1]
+
+
+def test_export_snapshot_resolves_cached_constraints_again():
+    tandoor = FakeTandoor(recipes=[recipe_json(1, keywords=[{'id': 7}]), recipe_json(2)])
+    keyword = ['--choices', '1', '--keyword', "{'condition': 7, 'count': 1, 'operator': '>='}"]
+    menu = Menu(options(*keyword), tandoor=tandoor)
+    menu.prepare_data()
+    menu.select_recipes()
+    assert len([c for c in tandoor.calls if c[0] == 'get_keyword_tree']) == 1
+
+    menu = Menu(options(*keyword), tandoor=tandoor)
+    menu.prepare_data()
+    assert menu.keyword_constraints[0]['resolved'] == {1}
+    assert len([c for c in tandoor.calls if c[0] == 'get_keyword_tree']) == 1
+
+    menu = Menu(options(*keyword, '--export_snapshot', 'snapshot.bin'), tandoor=tandoor)
+    menu.prepare_data()
+    assert menu.keyword_constraints[0].get('resolved', None) is None
+    assert len([c for c in tandoor.calls if c[0] == 'get_keyword_tree']) == 2
+
+
+def test_seed_leaves_the_random_module_alone():
+    tandoor = FakeTandoor(recipes=[recipe_json(i) for i in range(20)])
+    state = random.getstate()
+    selections = []
+    for _ in range(2):
+        menu = Menu(options('--seed', '3'), tandoor=tandoor)
+        menu.prepare_data()
+        selections.append([r.id for r in menu.select_recipes()])
+    assert random.getstate() == state
+    assert selections[0] == selections[1]
+
+
+def test_session_closes_when_a_run_ends_early(monkeypatch):
+    closed = []
+    monkeypatch.setattr(MenuSession, 'close', lambda self: closed.append(self))
+    session = MenuSession(options('--import_snapshot', 'missing.bin'), tandoor=FakeTandoor())
+    with pytest.raises(OSError):
+        session.run()
+    assert closed == [session]
+    session = MenuSession(options('--choices', '3'), tandoor=FakeTandoor(recipes=[recipe_json(1)]))
+    session.run()
+    assert closed[-1] is session
+
+
+def test_from_config_validates_its_own_options():
+    write_config()
+    session = MenuSession.from_config('config.ini', choices=2)
+    assert isinstance(session.options.mp_date, datetime)
+
+
+def test_a_session_renders_more_than_once(monkeypatch):
+    os.makedirs('templates')
+    with open(os.path.join('templates', 't.svg'), 'w') as f:
+        f.write('<svg xmlns="http://www.w3.org/2000/svg" width="200" height="100"><text>NAME_PLACEHOLDER</text><text>INGREDIENTS_PLACEHOLDER</text></svg>')
+    rendered = []
+    monkeypatch.setattr(MenuGenerator, 'archive', lambda self, data, target: target.endswith('.svg') and rendered.append(data))
+    food = food_json(1, onhand=True)
+    tandoor = FakeTandoor(recipes=[recipe_json(1)], details={1: {'steps': [{'ingredients': [{'food': food}]}]}})
+    replace_text = json.dumps({'recipe_text': [{'name': 'NAME_PLACEHOLDER', 'ingredients': ['INGREDIENTS_PLACEHOLDER']}]})
+    session = MenuSession(options('--choices', '1', '--create_file', '--file_format', 'PDF', '--file_template', 't.svg', '--replace_text', replace_text), tandoor=tandoor)
+    for _ in range(2):
+        session.select()
+        session.render()
+    assert len(rendered) == 2 and rendered[0] == rendered[1]
+    assert b'>f1<' in rendered[1]
+    assert [i.name for i in session.recipes[0].ingredients] == ['f1']
+
+
+def test_data_version_does_not_depend_on_how_recipes_are_read():
+    cooked = datetime(2026, 3, 1, 18, 30).astimezone()
+    tandoor = FakeTandoor(recipes=[
+        recipe_json(1, rating=4, last_cooked=cooked.isoformat(), updated_at=cooked.isoformat()),
+        recipe_json(2, rating=None),
+    ])
+    versions = []
+    for _ in range(2):
+        # the first menu writes the columns, the second one reads its recipes from them
+        menu = Menu(options('--columnar', 'recipes.columns'), tandoor=tandoor)
+        menu.prepare_recipes()
+        versions.append(menu.__data_version__())
+    assert len([c for c in tandoor.calls if c[0] == 'get_recipes']) == 1
+    assert type(menu.recipes[0]).__name__ == 'ColumnarRecipe'
+    assert versions[0] == versions[1]
+
+
+def test_resolved_constraints_depend_on_the_indexes():
+    tandoor = FakeTandoor(recipes=[recipe_json(1)])
+    keys = []
+    for flags in ([], ['--food_index'], ['--book_index']):
+        menu = Menu(options('--food', "{'condition': 1, 'count': 1, 'operator': '>='}", *flags), tandoor=tandoor)
+        menu.prepare_recipes()
+        menu.__load_resolved__()
+        keys.append(menu.food_constraints[0]['key'])
+    assert len(set(keys)) == 3
+
+
+def test_reroll_replaces_only_the_rejected_recipes_of_the_saved_selection():
+    tandoor = FakeTandoor(recipes=[recipe_json(i) for i in range(1, 11)])
+    menu = Menu(options('--choices', '3', '--seed', '1'), tandoor=tandoor)
+    menu.prepare_data()
+    with pytest.raises(RuntimeError):
+        menu.load_selection()
+    first = [r.id for r in menu.select_recipes()]
+    menu.save_selection(menu.recipe_picker.selected, {first[0]: 50, first[1]: 51})
+    assert menu.load_selection() == (first, set(), {first[0]: 50, first[1]: 51})
+
+    menu = Menu(options('--choices', '3', '--seed', '2'), tandoor=tandoor)
+    menu.prepare_data()
+    selection, replaced = menu.reroll([first[1]])
+    assert [r.id for r in selection][::2] == first[::2]
+    assert selection[1].id != first[1]
+    assert replaced == {first[1]: selection[1]}
+    menu.save_selection(selection)
+
+    # the rejected recipe stays out of later rerolls
+    menu = Menu(options('--choices', '3', '--seed', '2'), tandoor=tandoor)
+    menu.prepare_data()
+    again, _ = menu.reroll([selection[0].id, selection[1].id])
+    assert first[1] not in [r.id for r in again]
+    assert again[2].id == first[2]
+
+
+def test_offline_run_without_a_url(capsys, logger):
+    api = tandoor_api(logger, {'/api/recipe/': {'count': 2, 'next': None, 'previous': None, 'results': [recipe_json(1), recipe_json(2)]}}, cache=0)
+    Menu(options('--choices', '1'), tandoor=api, logger=logger).prepare_data()
+    write_snapshot('menu.snapshot', api)
+
+    with open('config.ini', 'w') as f:
+        f.write('[defaults]\n')
+    args = parse_args(['--choices', '1', '--offline', 'menu.snapshot'])
+    validate_args(args)
+    menu = Menu(args, tandoor=tandoor_api(logger, url=args.url, snapshot=read_snapshot('menu.snapshot')), logger=logger)
+    # the links and the saved selection are those of the server the snapshot was taken from
+    assert menu.tandoor.url == api.url
+    menu.prepare_data()
+    recipes = menu.select_recipes()
+    menu.print_selection(recipes)
+    assert f'Recipe: <{recipes[0].id}> Recipe {recipes[0].id}: http://tandoor.example/view/recipe/{recipes[0].id}\n' in capsys.readouterr().out
+    menu.save_selection(recipes)
+    assert menu.load_selection()[0] == [recipes[0].id]
+
+
+def test_selection_without_a_url(capsys, logger):
+    tandoor = FakeTandoor(recipes=[recipe_json(1)])
+    tandoor.url = None
+    menu = Menu(options('--choices', '1'), tandoor=tandoor, logger=logger)
+    menu.prepare_data()
+    recipes = menu.select_recipes()
+    menu.print_selection(recipes)
+    assert 'Recipe: <1> Recipe 1\n' in capsys.readouterr().out
+    menu.save_selection(recipes)
+    assert menu.load_selection()[0] == [1]
@@ -0,0 +1,55 @@
+import json
+
+import pytest
+
+import decoding
+from conftest import recipe_json
+from decoding import decode, projection
+
+RECIPE = {**recipe_json(1, keywords=[{'id': 7, 'name': 'k', 'label': 'k', 'description': ''}]), 'steps': [{'id': 1}], 'image': 'x.png'}
+PROJECTED = {k: v for k, v in RECIPE.items() if k not in ('steps', 'image')}
+PROJECTED['keywords'] = [{'id': 7, 'name': 'k'}]
+
+
+@pytest.fixture(params=['orjson', 'json'])
+def decoder(request, monkeypatch):
+    if request.param == 'json':
+        monkeypatch.setattr(decoding, 'orjson', None)
+    elif decoding.orjson is None:
+        pytest.skip('orjson is not installed')
+    return request.param
+
+
+def test_projection_of_urls():
+    assert projection('http://a/api/recipe/?page=2') is decoding.RECIPE
+    assert projection('http://a/api/recipe/12') is None
+    assert projection('http://a/api/meal-plan/?from_date=2026-01-01') is decoding.PROJECTIONS['meal-plan']
+    assert projection('http://a/api/unknown/') is None
+    assert projection('http://a/other/') is None
+
+
+def test_pages_are_projected(decoder):
+    page = {'count': 1, 'next': 'http://a/api/recipe/?page=2', 'previous': None, 'results': [RECIPE]}
+    decoded = decode(json.dumps(page, indent=2).encode('utf-8'), 'http://a/api/recipe/')
+    assert decoded == {**page, 'results': [PROJECTED]}
+
+
+def test_lists_are_projected(decoder):
+    assert decode(json.dumps([RECIPE, RECIPE]).encode('utf-8'), 'http://a/api/recipe/') == [PROJECTED, PROJECTED]
+    assert decode(b' [ ] ', 'http://a/api/recipe/') == []
+    assert decode(b'{}', 'http://a/api/recipe/') == {}
+
+
+def test_single_objects_are_decoded_as_is(decoder):
+    assert decode(json.dumps(RECIPE).encode('utf-8'), 'http://a/api/recipe/1') == RECIPE
+    assert decode(json.dumps({'detail': 'Not found.'}).encode('utf-8'), 'http://a/api/recipe/') == {'detail': 'Not found.'}
+
+
+def test_nested_items_are_projected(decoder):
+    plan = {'id': 1, 'title': 't', 'recipe': RECIPE, 'servings': 2, 'note': '', 'shared': [], 'from_date': '2026-01-01',
+            'to_date': '2026-01-01', 'meal_type': {'id': 1}, 'created_by': 1}
+    assert decode(json.dumps([plan]).encode('utf-8'), 'http://a/api/meal-plan/') == [
+        {**{k: v for k, v in plan.items() if k != 'created_by'}, 'recipe': PROJECTED}
+    ]
+    # a recipe that is null or just an id is kept as is
+    assert decode(json.dumps([{'id': 1, 'recipe': None}]).encode('utf-8'), 'http://a/api/meal-plan/') == [{'id': 1, 'recipe': None}]
@@ -0,0 +1,188 @@
+import random
+from datetime import datetime, timedelta, timezone
+
+from conftest import FakeTandoor, food_json, recipe_json
+from indexes import BookIndex, HistoryIndex, IngredientIndex, Pantry
+from models import Book, Recipe
+
+
+class DetailsTandoor(FakeTandoor):
+    def get_recipe_details(self, recipe_id, **kwargs):
+        self.calls.append(('get_recipe_details', recipe_id))
+        return {'steps': [{'ingredients': [{'food': {'id': recipe_id * 10}}]}]}
+
+
+class PantryTandoor(FakeTandoor):
+    # on hand substitutes as the substitutes api answers them
+    substitutes = {1: [2, 3, 9], 4: [2, 3], 5: [6, 7]}
+
+    def get_foods(self, **kwargs):
+        self.calls.append(('get_foods',))
+        return list(self.foods.values())
+
+    def get_food_substitutes(self, food_id, substitute='food'):
+        self.calls.append(('get_food_substitutes', food_id))
+        return [self.foods[i] for i in self.substitutes.get(food_id, [])]
+
+    def get_food(self, food_id):
+        self.calls.append(('get_food', food_id))
+        return self.foods[food_id]
+
+
+def pantry_tandoor():
+    foods = [
+        # 2, 3 and 4 are children of 1, 9 of 3
+        food_json(1, substitute_children=True), food_json(2, onhand=True, parent=1), food_json(3, onhand=True, parent={'id': 1}),
+        food_json(4, parent=1, substitute_siblings=True), food_json(9, onhand=True, parent=3),
+        food_json(5, substitute=[{'id': 6}, {'id': 7}, {'id': 8}]), food_json(6, onhand=True), food_json(7, onhand=True), food_json(8),
+        food_json(10)
+    ]
+    ingredients = [1, 4, 5, 10, 2, 1, 5]
+    details = {1: {'steps': [{'ingredients': [{'food': food_json(i)} for i in ingredients] + [{'food': None}]}]}}
+    return PantryTandoor(recipes=[recipe_json(1)], foods=foods, details=details)
+
+
+def test_pantry_resolves_substitutes_like_the_api(logger):
+    api = pantry_tandoor()
+    pantry = Pantry(api, logger)
+    for food_id in api.foods:
+        assert pantry.substitutes(food_id) == api.substitutes.get(food_id, [])
+    assert pantry.substitutes(404) == []
+    assert pantry.can_cook([1, 2, 4, 5])
+    assert not pantry.can_cook([2, 10])
+    assert not pantry.can_cook(None)
+    assert pantry.can_cook([])
+
+
+def test_pantry_substitutes_as_the_api_would_with_the_same_seed(logger):
+    api = pantry_tandoor()
+    chosen = []
+    for seed in range(10):
+        local, remote = Recipe(recipe_json(1)), Recipe(recipe_json(1))
+        local.addDetails(api, pantry=Pantry(api, logger, seed=seed))
+        remote.addDetails(api, rng=random.Random(seed))
+        assert [f.id for f in local.ingredients] == [f.id for f in remote.ingredients]
+        assert local.ingredients[3].id == 10 and local.ingredients[4].id == 2
+        chosen.append(local)
+    # different seeds pick different substitutes
+    assert len({tuple(f.id for f in r.ingredients) for r in chosen}) > 1
+    # the pantry answers without requests of its own
+    api.calls = []
+    Recipe(recipe_json(1)).addDetails(api, pantry=Pantry(api, logger, seed=0))
+    assert [c[0] for c in api.calls] == ['get_foods', 'get_recipe_details']
+
+
+def test_ingredient_index_compares_moments_not_time_zones(logger):
+    updated = datetime(2026, 5, 1, 12, 0, tzinfo=timezone(timedelta(hours=2)))
+    api = DetailsTandoor()
+    recipe = Recipe(recipe_json(1, updated_at=updated.isoformat()))
+    assert IngredientIndex(api, logger).update([recipe]) == 1
+
+    # the same moment in UTC, as read back from columns, isn't stale
+    recipe.updatedon = updated.astimezone(timezone.utc)
+    assert IngredientIndex(api, logger).update([recipe]) == 0
+    # entries indexed with ISO dates are still fresh
+    index = IngredientIndex(api, logger)
+    index.recipes['1']['updated'] = updated.isoformat()
+    assert index.update([recipe]) == 0
+
+    recipe.updatedon = updated + timedelta(seconds=1)
+    assert IngredientIndex(api, logger).update([recipe]) == 1
+    assert len([c for c in api.calls if c[0] == 'get_recipe_details']) == 2
+
+
+def test_history_sync_of_an_empty_history(logger):
+    api = FakeTandoor()
+    history = HistoryIndex(api, logger)
+    assert history.sync() == 0
+    assert history.cooked == [] and history.planned == []
+    assert history.cooked_since(datetime.now() - timedelta(days=30)) == set()
+    assert history.times_cooked(1, datetime.now() - timedelta(days=30)) == 0
+    # synced once per index
+    assert history.sync() == 0
+    assert [c[0] for c in api.calls] == ['get_cook_log', 'get_meal_plan_range']
+    assert HistoryIndex(api, logger).planned_until == history.planned_until
+
+
+def test_history_sync_reads_only_new_cook_logs(logger):
+    now = datetime.now().astimezone()
+    api = FakeTandoor(cook_log=[
+        {'id': 1, 'recipe': 5, 'created_at': (now - timedelta(days=3)).isoformat()},
+        {'id': 2, 'recipe': {'id': 6}, 'created_at': (now - timedelta(days=1)).isoformat()},
+        {'id': 3, 'recipe': None, 'created_at': (now - timedelta(days=1)).isoformat()},
+    ])
+    assert HistoryIndex(api, logger).sync() == 2
+
+    api.cook_log.append({'id': 4, 'recipe': 5, 'created_at': now.isoformat()})
+    history = HistoryIndex(api, logger)
+    assert history.sync() == 1
+    since = [c[1] for c in api.calls if c[0] == 'get_cook_log']
+    assert since[0] is None and since[1] == datetime.fromtimestamp(history.cooked[-2][0]).astimezone()
+    assert history.times_cooked(5, now - timedelta(days=7)) == 2
+    assert history.cooked_since(now - timedelta(days=2)) == {5, 6}
+
+
+def test_history_sync_rereads_recent_meal_plans(logger):
+    today = datetime.now().astimezone().replace(hour=0, minute=0, second=0, microsecond=0)
+
+    def _plan(plan_id, recipe_id, days):
+        return {'id': plan_id, 'recipe': recipe_id, 'from_date': (today + timedelta(days=days)).isoformat(), 'meal_type': {'id': 1}}
+
+    api = FakeTandoor(meal_plans=[_plan(1, 5, -100), _plan(2, 6, -3), _plan(3, None, -2)])
+    history = HistoryIndex(api, logger)
+    history.sync()
+    assert api.calls[-1][1] == today - timedelta(days=HistoryIndex.history_days)
+    assert history.planned_between(today - timedelta(days=200)) == {5, 6}
+
+    # the recent plan was moved, older ones are kept without reading them again
+    api.meal_plans = [_plan(1, 5, -100), _plan(2, 6, -1)]
+    history = HistoryIndex(api, logger)
+    history.sync()
+    assert api.calls[-1][1] == today - timedelta(days=HistoryIndex.replan_days)
+    assert [p[2] for p in history.planned] == [1, 2]
+    assert history.planned_between(today - timedelta(days=2), today, meal_type=1) == {6}
+    assert history.planned_between(today - timedelta(days=2), today, meal_type=2) == set()
+
+
+def test_history_is_not_synced_offline(logger, caplog):
+    api = FakeTandoor(offline=True, cook_log=[{'id': 1, 'recipe': 5, 'created_at': datetime.now().astimezone().isoformat()}])
+    history = HistoryIndex(api, logger)
+    assert history.sync() == 0
+    assert api.calls == []
+    assert 'not synced' in caplog.text
+
+
+class BookTandoor(FakeTandoor):
+    def __init__(self, entries, **kwargs):
+        super().__init__(**kwargs)
+        self.entries = entries
+
+    def get_book_entries(self, book_id):
+        self.calls.append(('get_book_entries', book_id))
+        return [{'recipe': r} for r in self.entries.get(book_id, [])]
+
+
+def test_book_index_reads_only_stale_books(logger):
+    api = BookTandoor({1: [10, {'id': 11}], 2: [20]}, recipes=[recipe_json(30)])
+    books = [Book({'id': 1, 'name': 'a'}), Book({'id': 2, 'name': 'b', 'filter': {'id': 7}})]
+    assert BookIndex(api, logger, max_age=timedelta(hours=1)).sync(books) == 2
+    assert BookIndex(api, logger, max_age=timedelta(hours=1)).sync(books) == 0
+
+    index = BookIndex(api, logger, max_age=timedelta(hours=1))
+    assert index.recipes_of(books[0]) == {10, 11}
+    assert index.recipes_of(books[1]) == {20, 30}
+    assert index.recipes_in(books, exclude=[books[0]]) == {20, 30}
+
+    # a changed filter or an entry older than max_age is read again
+    books[1].filter = 8
+    assert BookIndex(api, logger, max_age=timedelta(hours=1)).sync(books) == 1
+    assert BookIndex(api, logger, max_age=timedelta(0)).sync(books) == 2
+    assert [c[1] for c in api.calls if c[0] == 'get_book_entries'] == [1, 2, 2, 1, 2]
+
+
+def test_book_index_is_not_synced_offline(logger):
+    api = BookTandoor({1: [10]}, offline=True)
+    index = BookIndex(api, logger)
+    assert index.sync([Book({'id': 1, 'name': 'a'})]) == 0
+    assert index.recipes_of(Book({'id': 1, 'name': 'a'})) == set()
+    assert api.calls == []
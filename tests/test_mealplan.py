@@ -0,0 +1,57 @@
+from datetime import datetime, timedelta
+
+from conftest import FakeTandoor, recipe_json
+from mealplan import MealPlanManager
+from models import Recipe
+
+
+class MealPlanTandoor(FakeTandoor):
+    def get_meal_plans(self, date, **kwargs):
+        return list(self.meal_plans)
+
+    def get_meal_plan_range(self, from_date, to_date, **kwargs):
+        return list(self.meal_plans)
+
+    def update_meal_plan(self, obj_id, recipe=None, **kwargs):
+        self.calls.append(('update', obj_id, recipe.id))
+        return {'id': obj_id}
+
+    def create_meal_plan(self, recipe=None, **kwargs):
+        self.calls.append(('create', recipe.id))
+        return {'id': 100 + recipe.id}
+
+    def delete_meal_plan(self, obj_id, **kwargs):
+        self.calls.append(('delete', obj_id))
+
+
+def plan(plan_id, recipe_id, date, note='note'):
+    return {
+        'id': plan_id, 'recipe': recipe_json(recipe_id) if recipe_id else None, 'from_date': date.strftime('%Y-%m-%d'),
+        'servings': 2, 'note': note, 'shared': [], 'meal_type': {'id': 1}
+    }
+
+
+def test_reconcile_leaves_plans_without_a_recipe_alone(logger):
+    today = datetime.now().astimezone()
+    api = MealPlanTandoor(meal_plans=[plan(1, 1, today), plan(2, None, today), plan(3, 3, today), plan(4, None, today)])
+    recipes = [Recipe(recipe_json(1)), Recipe(recipe_json(2))]
+    plans = MealPlanManager(api, logger).reconcile(recipes, 1, today, note='note', cleanup_date=today - timedelta(days=7))
+    assert plans == {1: 1, 2: 3}
+    assert [c for c in api.calls if c[0] != 'get_recipes'] == [('update', 3, 2)]
+
+
+def test_reconcile_deletes_only_left_over_plans_with_a_recipe(logger):
+    today = datetime.now().astimezone()
+    api = MealPlanTandoor(meal_plans=[plan(1, 1, today), plan(2, None, today), plan(3, 3, today)])
+    plans = MealPlanManager(api, logger).reconcile([Recipe(recipe_json(1))], 1, today, note='note', cleanup_date=today - timedelta(days=7))
+    assert plans == {1: 1}
+    assert [c for c in api.calls if c[0] != 'get_recipes'] == [('delete', 3)]
+
+
+def test_replace_recipes_changes_only_the_plans_of_replaced_recipes(logger):
+    api = MealPlanTandoor()
+    today = datetime.now().astimezone()
+    new = {1: Recipe(recipe_json(5)), 3: Recipe(recipe_json(6))}
+    plans = MealPlanManager(api, logger).replace_recipes({1: 11, 2: 12}, new, 1, today)
+    assert plans == {2: 12, 5: 11, 6: 106}
+    assert api.calls == [('update', 11, 5), ('create', 6)]
@@ -0,0 +1,162 @@
+import itertools
+import os
+import random
+import re
+from types import SimpleNamespace
+
+import pytest
+
+from conftest import FakeTandoor, recipe_json
+import menu as menu_module
+from menu import CompiledTemplate, MenuGenerator, RecipeText, TextSlot, assign_slots, render_drawing, render_tasks
+from models import Recipe
+
+SVG = '<svg xmlns="http://www.w3.org/2000/svg" width="100" height="100"><text x="10" y="10">RECIPE_1</text></svg>'
+PLACEHOLDERS = ['RECIPE_1', 'RECIPE_10', 'ING_1_1', 'ING_1_2', 'DATE']
+
+
+def generator(logger, **options):
+    os.makedirs('templates', exist_ok=True)
+    defaults = {
+        'output_dir': None, 'file_template': 'menu.svg', 'file_format': 'pdf', 'file_dpi': None, 'fonts': [], 'seperator': ', ',
+        'replace_text': {'recipe_text': [{'name': 'RECIPE_1', 'ingredients': ['ING_1_1', 'ING_1_2']}]}, 'mp_date': None
+    }
+    return MenuGenerator(FakeTandoor(), SimpleNamespace(**{**defaults, **options}), logger)
+
+
+def slot(name_capacity, *line_capacities):
+    return TextSlot('N' * name_capacity, ['L' * c for c in line_capacities])
+
+
+def test_layout_drops_trailing_ingredients_until_the_rest_fit():
+    text = RecipeText('Soup', ['salt', 'pepper', 'olive oil'], ', ')
+    assert text.layout((12,)) == (['salt, pepper'], len('olive oil'))
+    assert text.layout((6, 9)) == (['salt,', 'pepper'], len('olive oil'))
+    assert text.layout((12, 9)) == (['salt, pepper', 'olive oil'], 0)
+
+
+def test_recipes_are_moved_to_slots_they_fit():
+    slots = [slot(10, 5, 5), slot(20, 30, 30)]
+    long = RecipeText('Lasagne al forno', ['flour sugar', 'eggs butter milk'], ', ')
+    short = RecipeText('Tea', ['water'], ', ')
+    assert assign_slots([long, short], slots) == [short, long]
+    # the order is kept when nothing is truncated either way
+    assert assign_slots([short, long], slots) == [short, long]
+
+
+def test_assignment_minimizes_truncation():
+    rng = random.Random(5)
+    words = ['salt', 'pepper', 'olive oil', 'garlic', 'onion', 'tomato paste', 'basil']
+    for _ in range(10):
+        slots = [slot(rng.randint(4, 16), *[rng.randint(4, 24) for _ in range(rng.randint(1, 3))]) for _ in range(4)]
+        texts = [
+            RecipeText('R' * rng.randint(3, 16), rng.sample(words, rng.randint(0, 5)), ', ')
+            for _ in range(rng.randint(2, 4))
+        ]
+        assigned = assign_slots(texts, slots)
+        # every recipe lands in exactly one slot, the others stay empty
+        assert sorted(map(id, filter(None, assigned))) == sorted(map(id, texts))
+        cost = sum(t.cost(s) for t, s in zip(assigned, slots) if t is not None)
+        best = min(
+            sum(t.cost(slots[j]) for t, j in zip(texts, order))
+            for order in itertools.permutations(range(len(slots)), len(texts))
+        )
+        assert cost == best
+
+
+def test_compiled_template_matches_replacing_one_placeholder_after_another():
+    rng = random.Random(3)
+    for _ in range(20):
+        pieces = [rng.choice(PLACEHOLDERS + ['<text>', ' x ', '&amp;', '\n']) for _ in range(rng.randint(0, 30))]
+        template = ''.join(pieces)
+        # replacements without placeholders, so the order of the old substitutions doesn't matter
+        replacements = {p: rng.choice(['', 'Soup', 'salt, pepper', 'a\\1 b']) for p in PLACEHOLDERS if p != 'RECIPE_1'}
+        expected = template
+        # the old substitution, one scan per placeholder, longest first so RECIPE_10 isn't taken for RECIPE_1
+        for k in sorted(replacements, key=len, reverse=True):
+            expected = re.sub(re.escape(k), lambda _: replacements[k], expected)
+        assert CompiledTemplate.compile(template, PLACEHOLDERS).render(replacements) == expected
+
+
+def test_compiled_template_is_compiled_again_when_the_template_changes(logger):
+    menu = generator(logger)
+    with open('templates/menu.svg', 'w') as f:
+        f.write('<svg>RECIPE_1</svg>')
+    assert menu.compile_template('menu.svg').render({'RECIPE_1': 'Soup'}) == '<svg>Soup</svg>'
+    # kept in the cache store for the next run
+    assert generator(logger).compile_template('menu.svg').slots == ['RECIPE_1']
+
+    with open('templates/menu.svg', 'w') as f:
+        f.write('<svg>ING_1_1 RECIPE_1</svg>')
+    os.utime('templates/menu.svg', (1, 1))
+    assert generator(logger).compile_template('menu.svg').render({'RECIPE_1': 'Soup', 'ING_1_1': 'salt'}) == '<svg>salt Soup</svg>'
+
+
+def test_write_file_replaces_the_file_and_leaves_no_temp_files(logger):
+    menu = generator(logger)
+    menu.write_file('menu.pdf', b'old')
+    menu.write_file('menu.pdf', b'new')
+    with open('menu.pdf', 'rb') as f:
+        assert f.read() == b'new'
+    # a failed write leaves the last file as it was
+    with pytest.raises(TypeError):
+        menu.write_file('menu.pdf', 'not bytes')
+    with open('menu.pdf', 'rb') as f:
+        assert f.read() == b'new'
+    assert sorted(os.listdir('.')) == ['menu.pdf', 'templates']
+
+
+def test_menu_is_rendered_without_temp_files(logger):
+    menu = generator(logger, output_dir='out', replace_text={'recipe_text': [{'name': 'RECIPE_1'}]})
+    os.makedirs('out')
+    with open('templates/menu.svg', 'w') as f:
+        f.write(SVG)
+    menu.write_menu([Recipe(recipe_json(1))])
+    assert os.listdir('out') == ['menu.pdf']
+    with open('out/menu.pdf', 'rb') as f:
+        assert f.read().startswith(b'%PDF')
+    assert sorted(os.listdir('templates')) == ['menu.svg']
+
+
+def test_every_template_is_rendered_in_every_format_and_resolution(logger):
+    menu = generator(
+        logger, output_dir='out', file_template=['a.svg', 'b.svg'], file_format=['pdf', 'png'], file_dpi=['72', '150'],
+        replace_text={'recipe_text': [{'name': 'RECIPE_1'}]}
+    )
+    for template in ('a.svg', 'b.svg'):
+        with open(os.path.join('templates', template), 'w') as f:
+            f.write(SVG)
+    tasks = menu.prepare_menu([Recipe(recipe_json(1))])
+    assert [(fmt, dpi, path) for _, fmt, dpi, path in tasks] == [
+        (fmt, dpi, os.path.join('out', name)) for template in ('a', 'b') for fmt, dpi, name in (
+            ('pdf', 72, f'{template}.pdf'), ('png', 72, f'{template}-72dpi.png'), ('png', 150, f'{template}-150dpi.png')
+        )
+    ]
+    # each template is parsed once for all of its files
+    assert len({id(drawing) for drawing, _, _, _ in tasks}) == 2
+
+
+def test_files_are_rendered_in_parallel_in_the_order_of_the_tasks(logger, monkeypatch):
+    menu = generator(logger, file_template=['a.svg', 'b.svg'], replace_text={'recipe_text': [{'name': 'RECIPE_1'}]})
+    for template, text in (('a.svg', 'first'), ('b.svg', 'second')):
+        with open(os.path.join('templates', template), 'w') as f:
+            f.write(SVG.replace('RECIPE_1', text))
+    tasks = menu.prepare_menu([Recipe(recipe_json(1))])
+    monkeypatch.setattr(menu_module.os, 'cpu_count', lambda: 2)
+    monkeypatch.setattr(menu_module, 'render_pool', None)
+    try:
+        results = render_tasks(tasks, [([], 'templates')], logger)
+        assert menu_module.render_pool is not None
+        # the pool is kept for the next render
+        pool = menu_module.render_pool
+        assert len(render_tasks(tasks, [([], 'templates')], logger)) == 2
+        assert menu_module.render_pool is pool
+    finally:
+        if menu_module.render_pool is not None:
+            menu_module.render_pool.shutdown()
+    # the same files as rendered one after another, but for their timestamps and document ids
+    expected = [render_drawing(drawing, fmt, dpi) for drawing, fmt, dpi, _ in tasks]
+    def masked(pdf):
+        return re.sub(rb'D:\d+|<[0-9a-f]{32}>', b'', pdf)
+    assert [masked(r) for r in results] == [masked(r) for r in expected]
+    assert masked(results[0]) != masked(results[1])
@@ -0,0 +1,45 @@
+import threading
+
+from profiling import Profiler
+
+
+def test_threads_keep_their_own_phases(tmp_path):
+    profiler = Profiler(str(tmp_path), interval=0.001)
+    barrier = threading.Barrier(2)
+    seen = {}
+
+    def _run(name):
+        with profiler.phase(name):
+            with profiler.phase('inner'):
+                barrier.wait()
+                seen[name] = profiler.current[threading.get_ident()]
+                barrier.wait()
+        seen[f'{name} after'] = profiler.current.get(threading.get_ident(), None)
+
+    threads = [threading.Thread(target=_run, args=(name,)) for name in ('a', 'b')]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    phases = dict(profiler.close())
+
+    assert seen == {'a': ('a', 'inner'), 'b': ('b', 'inner'), 'a after': None, 'b after': None}
+    assert set(phases) == {'a', 'b'}
+    assert len(list(tmp_path.glob('*.pstats'))) == 2
+
+
+def test_a_phase_run_by_several_threads_is_saved_once(tmp_path):
+    profiler = Profiler(str(tmp_path))
+
+    def _run():
+        with profiler.phase('solve'):
+            sum(range(10000))
+
+    threads = [threading.Thread(target=_run) for _ in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert [name for name, _ in profiler.close()] == ['solve']
+    assert len(profiler.profiles['solve']) == 4
+    assert (tmp_path / 'stacks.collapsed').exists()
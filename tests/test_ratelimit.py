@@ -0,0 +1,79 @@
+import threading
+import time
+from email.utils import formatdate
+from types import SimpleNamespace
+
+import pytest
+
+from ratelimit import RateLimiter, retry_after
+
+
+def request(limiter, latency=None, throttled=False):
+    limiter.acquire()
+    limiter.release(latency=latency, throttled=throttled)
+
+
+def test_concurrency_halves_when_throttled_and_grows_back():
+    limiter = RateLimiter(max_concurrency=8)
+    request(limiter, throttled=True)
+    assert limiter.concurrency == 4
+    request(limiter, throttled=True)
+    request(limiter, throttled=True)
+    request(limiter, throttled=True)
+    assert limiter.concurrency == 1
+    # one more per window of as many fast responses as requests may run at once
+    for expected in (2, 3, 4):
+        for _ in range(limiter.concurrency):
+            request(limiter, latency=0.1)
+        assert limiter.concurrency == expected
+    for _ in range(100):
+        request(limiter, latency=0.1)
+    assert limiter.concurrency == 8
+
+
+def test_concurrency_halves_when_responses_slow_down():
+    limiter = RateLimiter(max_concurrency=8)
+    for _ in range(10):
+        request(limiter, latency=0.1)
+    assert limiter.concurrency == 8
+    for _ in range(3):
+        request(limiter, latency=1.0)
+    assert limiter.concurrency < 8
+
+
+def test_acquire_waits_for_a_free_slot():
+    limiter = RateLimiter(max_concurrency=1)
+    limiter.acquire()
+    acquired = threading.Event()
+    thread = threading.Thread(target=lambda: (limiter.acquire(), acquired.set()))
+    thread.start()
+    assert not acquired.wait(0.1)
+    limiter.release()
+    assert acquired.wait(5)
+    thread.join()
+    assert limiter.active == 1
+
+
+def test_pause_holds_back_requests():
+    limiter = RateLimiter(max_concurrency=4)
+    limiter.pause(0.2)
+    start = time.monotonic()
+    request(limiter)
+    assert time.monotonic() - start >= 0.2
+
+
+def response(value=None):
+    return SimpleNamespace(headers={} if value is None else {'Retry-After': value})
+
+
+def test_retry_after_in_seconds():
+    assert retry_after(response('7'), default=1) == 7
+    assert retry_after(response('1.5'), default=1) == 1.5
+    assert retry_after(response('-3'), default=1) == 0
+    assert retry_after(response(), default=4) == 4
+    assert retry_after(response('soon'), default=4) == 4
+
+
+def test_retry_after_as_http_date():
+    assert retry_after(response(formatdate(time.time() + 30, usegmt=True)), default=1) == pytest.approx(30, abs=2)
+    assert retry_after(response(formatdate(time.time() - 30, usegmt=True)), default=1) == 0
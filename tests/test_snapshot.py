@@ -0,0 +1,54 @@
+import pytest
+
+from conftest import recipe_json, tandoor_api
+from snapshot import SNAPSHOT_MAGIC, import_snapshot, read_snapshot, write_snapshot
+
+ROUTES = {
+    '/api/recipe/': {'count': 2, 'next': None, 'previous': None, 'results': [recipe_json(1), recipe_json(2)]},
+}
+
+
+def test_snapshot_round_trip(logger, tmp_path):
+    api = tandoor_api(logger, ROUTES, cache=0)
+    recipes = api.get_recipes(all_recipes=True)
+    path = tmp_path / 'menu.snapshot'
+    assert write_snapshot(str(path), api) == 1
+
+    snapshot = read_snapshot(str(path))
+    assert snapshot['url'] == 'http://tandoor.example/api/'
+    offline = tandoor_api(logger, url='http://elsewhere.example/', snapshot=snapshot)
+    assert offline.offline and offline.url == api.url
+    assert offline.get_recipes(all_recipes=True) == recipes
+    assert offline.session.sent == []
+
+
+def test_offline_miss_is_an_error(logger, tmp_path):
+    api = tandoor_api(logger, ROUTES, cache=0)
+    api.get_recipes(all_recipes=True)
+    write_snapshot(str(tmp_path / 'menu.snapshot'), api)
+    offline = tandoor_api(logger, snapshot=read_snapshot(str(tmp_path / 'menu.snapshot')))
+    with pytest.raises(RuntimeError, match='not in the snapshot'):
+        offline.get_recipes(params={'keywords': 3})
+    assert offline.session.sent == []
+
+
+def test_imported_snapshot_warms_the_cache(logger, tmp_path):
+    api = tandoor_api(logger, ROUTES, cache=0)
+    recipes = api.get_recipes(all_recipes=True)
+    write_snapshot(str(tmp_path / 'menu.snapshot'), api)
+    with pytest.raises(RuntimeError):
+        import_snapshot(read_snapshot(str(tmp_path / 'menu.snapshot')), 0)
+    assert import_snapshot(read_snapshot(str(tmp_path / 'menu.snapshot')), 60) == 1
+
+    warm = tandoor_api(logger, cache=60)
+    assert warm.get_recipes(all_recipes=True) == recipes
+    assert warm.session.sent == []
+
+
+def test_files_that_are_not_snapshots_are_refused(tmp_path):
+    (path := tmp_path / 'other').write_bytes(b'{}')
+    with pytest.raises(RuntimeError, match='not a menu snapshot'):
+        read_snapshot(str(path))
+    path.write_bytes(SNAPSHOT_MAGIC + b'JN{"version": 0}')
+    with pytest.raises(RuntimeError, match='version 1 is required'):
+        read_snapshot(str(path))
@@ -0,0 +1,125 @@
+import logging
+import random
+from types import SimpleNamespace
+
+import pytest
+from pulp import LpBinary, LpMaximize, LpProblem, LpStatusOptimal, LpVariable, lpSum, value
+from pulp.apis import PULP_CBC_CMD
+
+from solver import RecipePicker
+
+OPERATORS = ('>=', '<=', '==')
+
+
+def instance(seed):
+    '''
+    Returns:
+        a small random library, menu size and constraints as (recipe ids, operator, count)
+    '''
+    rng = random.Random(seed)
+    recipes = [SimpleNamespace(id=i) for i in range(rng.randint(4, 12))]
+    numrecipes = rng.randint(1, 4)
+    constraints = []
+    for _ in range(rng.randint(1, 4)):
+        members = rng.sample(recipes, rng.randint(0, len(recipes)))
+        constraints.append((members, rng.choice(OPERATORS), rng.randint(0, 4)))
+    return recipes, numrecipes, constraints
+
+
+def naive(recipes, numrecipes, constraints, weights):
+    '''
+    one binary variable per recipe and one row per constraint, no presolve
+
+    Returns:
+        the best objective, None when there is no solution
+    '''
+    problem = LpProblem('Naive', LpMaximize)
+    x = {r.id: LpVariable(f'Recipe_{r.id}', cat=LpBinary) for r in recipes}
+    problem += lpSum(weights[i] * v for i, v in x.items())
+    problem += lpSum(x.values()) == numrecipes
+    for members, operator, count in constraints:
+        expression = lpSum(x[r.id] for r in members)
+        if operator == '>=':
+            problem += expression >= count
+        elif operator == '<=':
+            problem += expression <= count
+        elif operator == '==':
+            problem += expression == count
+    problem.solve(PULP_CBC_CMD(msg=False))
+    if problem.status != LpStatusOptimal:
+        return None
+    return value(problem.objective) or 0
+
+
+def picker(recipes, numrecipes, constraints, logger, seed=0):
+    picker = RecipePicker(recipes, numrecipes, logger=logger, rng=random.Random(seed))
+    for members, operator, count in constraints:
+        picker.add_keyword_constraint(members, count, operator)
+    return picker
+
+
+def satisfies(selected, numrecipes, constraints):
+    ids = {r.id for r in selected}
+    if len(ids) != numrecipes:
+        return False
+    for members, operator, count in constraints:
+        n = len(ids & {r.id for r in members})
+        if (operator == '>=' and n < count) or (operator == '<=' and n > count) or (operator == '==' and n != count):
+            return False
+    return True
+
+
+@pytest.mark.parametrize('seed', range(40))
+def test_presolved_model_matches_naive_model(seed, logger):
+    recipes, numrecipes, constraints = instance(seed)
+    p = picker(recipes, numrecipes, constraints, logger)
+    best = naive(recipes, numrecipes, constraints, p.weights)
+    if best is None:
+        with pytest.raises(RuntimeError):
+            p.solve()
+        return
+    selected = p.solve()
+    assert satisfies(selected, numrecipes, constraints)
+    assert sum(p.weights[r.id] for r in selected) == pytest.approx(best)
+
+
+def test_infeasible_rows(logger):
+    recipes = [SimpleNamespace(id=i) for i in range(6)]
+    # more than a condition can give
+    with pytest.raises(RuntimeError):
+        picker(recipes, 3, [(recipes[:2], '>=', 3)], logger).solve()
+    # two conditions on the same recipes asking for different counts
+    with pytest.raises(RuntimeError):
+        picker(recipes, 3, [(recipes[:4], '==', 1), (recipes[:4], '==', 2)], logger).solve()
+    # fixed by one condition and excluded by another
+    with pytest.raises(RuntimeError):
+        picker(recipes, 3, [(recipes[:2], '==', 2), (recipes[1:3], '==', 0)], logger).solve()
+
+
+def test_not_equal_is_ignored_with_a_warning(logger, caplog):
+    recipes = [SimpleNamespace(id=i) for i in range(6)]
+    constraints = [(recipes[:3], '>=', 1)]
+    expected = picker(recipes, 2, constraints, logger).solve()
+    with caplog.at_level(logging.WARNING, logger='tests'):
+        selected = picker(recipes, 2, constraints + [(recipes[:3], '!=', 1)], logger).solve()
+    assert selected == expected
+    assert 'operator != are not supported' in caplog.text
+    # the naive model doesn't know != either, both find the same best menu
+    p = picker(recipes, 2, constraints + [(recipes[:3], '!=', 1)], logger)
+    assert sum(p.weights[r.id] for r in p.solve()) == pytest.approx(naive(recipes, 2, constraints, p.weights))
+
+
+def test_reroll_keeps_the_other_recipes_in_place(logger):
+    recipes = [SimpleNamespace(id=i) for i in range(12)]
+    constraints = [(recipes[:6], '>=', 2)]
+    p = picker(recipes, 4, constraints, logger)
+    first = [r.id for r in p.solve()]
+    rejected = first[1:3]
+    second = [r.id for r in p.reroll(rejected)]
+    assert [second[0], second[3]] == [first[0], first[3]]
+    assert not set(second) & set(rejected)
+    assert satisfies(p.selected, 4, constraints)
+    # recipes rejected before aren't chosen again
+    third = [r.id for r in p.reroll([second[0]])]
+    assert third[1:] == second[1:]
+    assert not set(third) & set(rejected + [second[0]])
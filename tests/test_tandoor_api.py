@@ -0,0 +1,53 @@
+import pytest
+
+from conftest import tandoor_api
+from tandoor_api import TandoorAPI
+
+
+class Response:
+    def __init__(self, status_code):
+        self.status_code = status_code
+        self.headers = {'Retry-After': '0'}
+
+
+class Session:
+    def __init__(self, statuses):
+        self.statuses = list(statuses)
+        self.sent = []
+
+    def request(self, method, url, **kwargs):
+        self.sent.append(method)
+        return Response(self.statuses.pop(0))
+
+
+def api(logger, statuses):
+    logger.loglevel = 10
+    tandoor = TandoorAPI('http://tandoor.example/', 'x', logger, retries=3)
+    tandoor.session = Session(statuses)
+    return tandoor
+
+
+@pytest.mark.parametrize('method', ['GET', 'PUT', 'DELETE'])
+def test_idempotent_requests_are_retried(logger, method):
+    tandoor = api(logger, [503, 429, 200])
+    assert tandoor.request(method, 'http://tandoor.example/api/recipe/').status_code == 200
+    assert tandoor.session.sent == [method] * 3
+
+
+@pytest.mark.parametrize('method', ['POST', 'PATCH'])
+def test_writes_are_only_retried_when_throttled(logger, method):
+    tandoor = api(logger, [429, 503, 200])
+    assert tandoor.request(method, 'http://tandoor.example/api/meal-plan/').status_code == 503
+    assert tandoor.session.sent == [method] * 2
+
+
+def test_throttled_requests_lower_the_concurrency(logger):
+    tandoor = api(logger, [429, 200])
+    tandoor.limiter.max_concurrency = tandoor.limiter.concurrency = 4
+    assert tandoor.request('GET', 'http://tandoor.example/api/recipe/').status_code == 200
+    assert tandoor.limiter.concurrency == 2
+
+
+def test_no_url_is_not_made_into_one(logger):
+    assert tandoor_api(logger, url=None).url is None
+    assert tandoor_api(logger, url='http://tandoor.example').url == 'http://tandoor.example/api/'
@@ -0,0 +1,70 @@
+import threading
+import time
+
+import pytest
+
+from utils import RequestMemo
+
+
+def test_identical_requests_are_fetched_once():
+    memo, calls, results = RequestMemo(), [], []
+
+    def _loader():
+        calls.append(1)
+        time.sleep(0.1)
+        return [{'id': 1}]
+
+    threads = [threading.Thread(target=lambda: results.append(memo.fetch('k', _loader, entity='recipe'))) for _ in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert len(calls) == 1
+    assert results == [[{'id': 1}]] * 4
+    assert 'k' in memo
+    assert memo.entries() == [{'key': 'k', 'entity': 'recipe', 'data': [{'id': 1}]}]
+
+
+def test_a_failed_fetch_is_retried_by_a_waiting_caller():
+    memo, calls = RequestMemo(), []
+    started = threading.Event()
+
+    def _failing():
+        calls.append('failed')
+        started.set()
+        time.sleep(0.1)
+        raise RuntimeError('server error')
+
+    def _loader():
+        calls.append('loaded')
+        return [{'id': 2}]
+
+    errors, results = [], []
+
+    def _first():
+        try:
+            memo.fetch('k', _failing, entity='food')
+        except RuntimeError as e:
+            errors.append(e)
+
+    first = threading.Thread(target=_first)
+    first.start()
+    started.wait()
+    second = threading.Thread(target=lambda: results.append(memo.fetch('k', _loader, entity='food')))
+    second.start()
+    first.join()
+    second.join()
+    assert len(errors) == 1 and calls == ['failed', 'loaded']
+    assert results == [[{'id': 2}]]
+    # the retried result keeps its entity type
+    assert memo.entries() == [{'key': 'k', 'entity': 'food', 'data': [{'id': 2}]}]
+
+
+def test_preload_and_clear():
+    memo = RequestMemo()
+    memo.preload([{'key': 'k', 'entity': 'book', 'data': [{'id': 3}]}])
+    assert memo.fetch('k', lambda: pytest.fail('preloaded results are not fetched')) == [{'id': 3}]
+    assert memo.entries() == [{'key': 'k', 'entity': 'book', 'data': [{'id': 3}]}]
+    memo.clear()
+    assert 'k' not in memo and memo.entries() == []
+    assert memo.fetch('k', lambda: [{'id': 4}]) == [{'id': 4}]
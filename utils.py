@@ -1,7 +1,8 @@
+import json
 import logging
 import re
-import shelve
 import sys
+import threading
 from datetime import datetime, timedelta
 from functools import wraps
 from uuid import NAMESPACE_OID, uuid3
@@ -9,13 +10,65 @@ from uuid import NAMESPACE_OID, uuid3
 from tqdm import tqdm
 from tzlocal import get_localzone
 
-try:
-    caches = shelve.open('caches.db', writeback=True)
-    for key in caches:
-        if caches[key]['expired'] < datetime.now():
-            caches.pop(key)
-except FileNotFoundError:
-    caches = {}
+from cache import load_or_fetch
+
+
+class RequestMemo:
+    """
+    In-memory, per-run memo of API results keyed on the normalized request.
+    Identical requests made concurrently collapse into a single in-flight fetch.
+    """
+    def __init__(self):
+        self.results = {}
+        # entity type of each result, see cache.store_result
+        self.entities = {}
+        self.inflight = {}
+        self.lock = threading.Lock()
+
+    def __contains__(self, key):
+        return key in self.results
+
+    def fetch(self, key, loader, entity=None):
+        with self.lock:
+            if key in self.results:
+                return self.results[key]
+            if owner := key not in self.inflight:
+                self.inflight[key] = threading.Event()
+            event = self.inflight[key]
+
+        if not owner:
+            event.wait()
+            with self.lock:
+                if key in self.results:
+                    return self.results[key]
+            # the in-flight fetch failed, try it again
+            return self.fetch(key, loader, entity=entity)
+
+        try:
+            result = loader()
+            with self.lock:
+                self.results[key] = result
+                self.entities[key] = entity
+            return result
+        finally:
+            with self.lock:
+                self.inflight.pop(key, None)
+            event.set()
+
+    def entries(self):
+        with self.lock:
+            return [{'key': k, 'entity': self.entities.get(k, None), 'data': v} for k, v in self.results.items()]
+
+    def preload(self, entries):
+        with self.lock:
+            for e in entries:
+                self.results[e['key']] = e['data']
+                self.entities[e['key']] = e['entity']
+
+    def clear(self):
+        with self.lock:
+            self.results = {}
+            self.entities = {}
 
 
 class InfoFilter(logging.Filter):
@@ -201,22 +254,45 @@ def display_progress(func):
     return wrapper
 
 
-def cached(func):
+def request_key(name, args, kwargs):
+    """
+    Normalized key for an API request; caching switches are not part of the request.
+    """
+    kwargs = {k: v for k, v in kwargs.items() if k not in ('ttl', 'cache')}
+    return f'{name}:{json.dumps([args, kwargs], sort_keys=True, default=repr)}'
+
+
+def persistent_key(key):
+    # uuid's are consistent across runs, hash() is not
+    return str(uuid3(NAMESPACE_OID, key))
+
+
+def cached(func=None, *, entity=None):
+    """
+    entity: entity type of the results or a callable that returns it from the call arguments,
+        entity results are stored once in the entity table and referenced by ID
+    """
+    if func is None:
+        return lambda f: cached(f, entity=entity)
+
     @wraps(func)
     def wrapper(self, *args, **kwargs):
-        if ttl := kwargs.get('ttl', None) is None:
-            try:
-                ttl = self.ttl
-            except NameError:
-                ttl = 240
-        if not ttl or ttl <= 0:
+        ttl = kwargs.get('ttl', kwargs.get('cache', None))
+        if ttl is not None and not ttl:
+            # caching explicitly disabled for this request
             return func(self, *args, **kwargs)
-        expire_after = timedelta(minutes=ttl)
-        # uuid's are consistent across runs, hash() is not
-        key = str(uuid3(NAMESPACE_OID, ''.join([str(x) for x in args]) + str(kwargs)))
-        if key not in caches or caches[key]['expired'] < datetime.now():
-            caches[key] = {'data': func(self, *args, **kwargs), 'expired': datetime.now() + expire_after}
-            caches.sync()
-
-        return caches[key]['data']
+        if ttl is None or ttl is True:
+            ttl = getattr(self, 'ttl', 240)
+
+        key = request_key(func.__name__, args, kwargs)
+        entity_name = entity(*args) if callable(entity) else entity
+
+        def _fetch():
+            if not ttl or ttl <= 0:
+                return func(self, *args, **kwargs)
+            return load_or_fetch(persistent_key(key), lambda: func(self, *args, **kwargs), timedelta(minutes=ttl), entity=entity_name)
+
+        if (memo := getattr(self, 'memo', None)) is None:
+            return _fetch()
+        return memo.fetch(key, _fetch, entity=entity_name)
     return wrapper